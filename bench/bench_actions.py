@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+
+"""
+Times a chain of 10 actions over many names with the parsed action objects
+against the old ( action_name, arguments... ) tuples that were dispatched on
+the action name and ran re.sub on the pattern string.
+
+bench_actions.py [--names=N]
+"""
+
+
+from getopt import getopt
+import time
+import sys
+import os
+import re
+
+sys.path.append( os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'src' ) )
+
+import main
+
+
+RAW_ACTIONS = [
+  'r:episode ([0-9]+):E\\1',
+  'd:\\[random crap\\]',
+  'r:show name:Show Name',
+  'd:  +',
+  'r:\\.mkv$:.mkv',
+  'i:0:new ',
+  'a: (1080p)',
+  'r:([0-9]{2})([0-9])?:\\1',
+  'd:^new ',
+  'i:-4:!',
+]
+
+
+def TupleAction( action ):
+  """
+  Returns the tuple the old ParseAction made for an action object
+  """
+  if action.name == 'remove':
+    return ( 'remove', action.pattern )
+  elif action.name == 'replace':
+    return ( 'replace', action.pattern, action.replacement )
+  elif action.name == 'insert':
+    return ( 'insert', action.position, action.text )
+  else:
+    return ( 'append', action.text )
+
+
+def TupleDoAction( action, file, partial=False ):
+  """
+  DoAction as it was before actions were parsed into objects
+  """
+  new_file = None
+
+  if action[0] == 'remove':
+    new_file = re.sub( action[1], '', file )
+
+    if not partial and new_file == file:
+      return None
+
+  elif action[0] == 'replace':
+    new_file = re.sub( action[1], action[2], file )
+
+    if not partial and new_file == file:
+      return None
+
+  elif action[0] == 'insert':
+    if action[1] > 0:
+      if action[1] >= len( file ):
+        new_file = file
+    else:
+      if action[1]*-1 >= len( file ):
+        new_file = file
+
+    if new_file is None:
+      prefix = file[ 0:action[1] ]
+      suffix = file[ action[1]: ]
+      new_file = prefix + action[2] + suffix
+
+    if not partial and new_file == file:
+      return None
+
+  elif action[0] == 'append':
+    ext_i = file.rfind( os.path.extsep )
+    extension = ''
+
+    if ext_i < 0:
+      new_file = file
+    else:
+      extension = file[ ext_i: ]
+      new_file  = file[ 0 : ext_i ]
+
+    new_file += action[1] + extension
+
+  return new_file
+
+
+def TupleRename( actions, file ):
+  new_file = file
+
+  for action in actions:
+    new_file = TupleDoAction( action, new_file, partial=True )
+
+  return new_file
+
+
+def Main():
+  opts, args = getopt( sys.argv[1:], '', [ 'names=' ] )
+  count = 1000000
+
+  for opt, arg in opts:
+    if opt == '--names':
+      count = int( arg )
+
+  actions = [ main.ParseAction( raw ) for raw in RAW_ACTIONS ]
+  tuples  = [ TupleAction( action ) for action in actions ]
+  names   = [ 'show name episode {} [random crap].mkv'.format( i ) for i in range( count ) ]
+
+  start = time.perf_counter()
+  old = [ TupleRename( tuples, name ) for name in names ]
+  tuple_time = time.perf_counter() - start
+
+  start = time.perf_counter()
+  new = [ main.ApplyActions( actions, name, partial=True ) for name in names ]
+  object_time = time.perf_counter() - start
+
+  if old != new:
+    raise Exception( "action objects renamed differently than tuples" )
+
+  print( "names    {}".format( count ) )
+  print( "actions  {}".format( len( actions ) ) )
+  print( "tuples   {:.3f}s".format( tuple_time ) )
+  print( "objects  {:.3f}s".format( object_time ) )
+  print( "speedup  {:.2f}x".format( tuple_time / object_time ) )
+
+
+if __name__ == '__main__':
+  Main()
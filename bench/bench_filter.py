@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+
+"""
+Times filtering many paths with a growing number of patterns, using
+re.match on each pattern string (how -f and -R used to work) against a
+filters.Filter made once from all of them.
+
+The paths are made a million at a time and filtered again for each million,
+so the test doesn't need them all in memory.
+
+bench_filter.py [--paths=N] [--patterns=MAX]
+"""
+
+
+from getopt import getopt
+import time
+import sys
+import os
+import re
+
+sys.path.append( os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'src' ) )
+
+import filters
+
+
+CHUNK = 1000000
+
+# a mix of filters people use, extension and prefix ones can skip the regex engine
+PATTERNS = [
+  r'.*\.mkv$',
+  r'shows/',
+  r'.*\.srt$',
+  r'.*S[0-9]{2}E[0-9]{2}',
+  r'movies/.*',
+  r'.*\.mp4$',
+  r'.*sample',
+  r'music/[a-z]+/[0-9]+ ',
+]
+
+DIRECTORIES = [ 'shows/dexter/', 'movies/', 'music/band/', 'downloads/misc/' ]
+EXTENSIONS  = [ '.mkv', '.srt', '.mp4', '.nfo', '.mp3' ]
+
+
+def Paths( count ):
+  """
+  Returns count synthetic paths
+  """
+  return [
+    '{}{} name S{:02}E{:02}{}'.format(
+      DIRECTORIES[ i % len( DIRECTORIES ) ], i, i % 30, i % 24, EXTENSIONS[ i % len( EXTENSIONS ) ] )
+    for i in range( count ) ]
+
+
+def OldFilter( patterns, paths ):
+  """
+  Counts the matches the way FilterFiles used to, re.match per pattern string
+  """
+  return sum( 1 for path in paths if any( re.match( p, path ) for p in patterns ) )
+
+
+def NewFilter( patterns, paths ):
+  return sum( 1 for path in filters.Filter( patterns ).filter( paths ) )
+
+
+def Time( function, patterns, count ):
+  """
+  Returns ( seconds, matches ) for filtering count paths
+  """
+  seconds = 0
+  matches = 0
+  chunk   = Paths( min( count, CHUNK ) )
+
+  done = 0
+  while done < count:
+    paths = chunk if count - done >= len( chunk ) else chunk[ 0 : count - done ]
+
+    start = time.perf_counter()
+    matches += function( patterns, paths )
+    seconds += time.perf_counter() - start
+
+    done += len( paths )
+
+  return ( seconds, matches )
+
+
+def Main():
+  opts, args = getopt( sys.argv[1:], '', [ 'paths=', 'patterns=' ] )
+  count    = 10000000
+  patterns = len( PATTERNS )
+
+  for opt, arg in opts:
+    if opt == '--paths':
+      count = int( arg )
+    elif opt == '--patterns':
+      patterns = int( arg )
+
+  print( "paths  {}".format( count ) )
+  print( "{:>8} {:>10} {:>10} {:>8}".format( 'patterns', 're.match', 'Filter', 'speedup' ) )
+
+  n = 1
+  while n <= patterns:
+    old_time, old_matches = Time( OldFilter, PATTERNS[0:n], count )
+    new_time, new_matches = Time( NewFilter, PATTERNS[0:n], count )
+
+    if old_matches != new_matches:
+      raise Exception( "Filter matched differently than re.match", PATTERNS[0:n] )
+
+    print( "{:>8} {:>9.3f}s {:>9.3f}s {:>7.2f}x".format( n, old_time, new_time, old_time / new_time ) )
+    n *= 2
+
+
+if __name__ == '__main__':
+  Main()
@@ -0,0 +1,175 @@
+#!/usr/bin/python3
+
+"""
+Times each phase of a run on synthetic trees: walking the tree (fs.GetFiles),
+making the renames with a chain of actions (main.GenerateRenames), filtering
+them by result (main.FilterRenames), checking and ordering them (planner) and
+doing them (main.DoRenames).
+
+Prints the times as JSON so runs from different releases can be compared.
+
+With --baseline, the output of an earlier run, how much slower or faster each
+phase was is printed too.
+
+bench_phases.py [--files=N] [--trees=flat,deep-narrow,...] [--jobs=N] [--output=file] [--baseline=file]
+"""
+
+
+from getopt import getopt
+import platform
+import json
+import time
+import sys
+import os
+
+sys.path.append( os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'src' ) )
+sys.path.append( os.path.dirname( os.path.abspath( __file__ ) ) )
+
+import planner
+import trees
+import main
+import log
+import fs
+
+
+# the example from the README, and a few more like it
+RAW_ACTIONS = [
+  'r:episode ([0-9]+):E\\1',
+  'd: \\[random crap\\]',
+  'r:show name:Show Name',
+  'a: (1080p)',
+]
+
+RESULT_RE = r'.*E[0-9]+ \(1080p\)\.(mkv|mp4)$'
+
+
+def Phases( root, actions, jobs ):
+  """
+  Runs every phase on the tree at root, renaming the files in it.
+
+  Returns a dict of { phase: seconds } and a dict of { phase: how many files or renames it made }
+  """
+  seconds = {}
+  counts  = {}
+
+  start = time.perf_counter()
+  index = fs.DirectoryIndex()
+  files = list( fs.GetFiles( [ root ], recursive=True, jobs=jobs, index=index ) )
+  seconds['walk'] = time.perf_counter() - start
+  counts['walk']  = len( files )
+
+  start = time.perf_counter()
+  renames = main.GenerateRenames( actions, files, partial=True, index=index, recursive=True )
+  seconds['generate'] = time.perf_counter() - start
+  counts['generate']  = len( renames )
+
+  start = time.perf_counter()
+  renames = main.FilterRenames( renames, RESULT_RE )
+  seconds['filter'] = time.perf_counter() - start
+  counts['filter']  = len( renames )
+
+  start = time.perf_counter()
+  renames = planner.ResolveRenames( renames, index )
+  renames = planner.OrderRenames( renames, index )
+  seconds['plan'] = time.perf_counter() - start
+  counts['plan']  = len( renames )
+
+  start = time.perf_counter()
+  counts['apply']  = main.DoRenames( renames, jobs=jobs )
+  seconds['apply'] = time.perf_counter() - start
+
+  return ( seconds, counts )
+
+
+def Compare( results, baseline ):
+  """
+  Prints how long each phase took against the same phase in baseline
+  """
+  print( "{:<18} {:<10} {:>10} {:>10} {:>8}".format( 'tree', 'phase', 'baseline', 'now', 'ratio' ), file=sys.stderr )
+
+  for shape, tree in results['trees'].items():
+    before = baseline['trees'].get( shape )
+    if before is None:
+      continue
+
+    for phase, seconds in tree['seconds'].items():
+      if phase not in before['seconds']:
+        continue
+
+      old = before['seconds'][phase]
+      print( "{:<18} {:<10} {:>9.3f}s {:>9.3f}s {:>7.2f}x".format(
+        shape, phase, old, seconds, seconds / old if old > 0 else 0 ), file=sys.stderr )
+
+
+def Main():
+  opts, args = getopt( sys.argv[1:], '', [ 'files=', 'trees=', 'jobs=', 'output=', 'baseline=' ] )
+  count    = 1000000
+  shapes   = list( trees.SHAPES )
+  jobs     = 1
+  output   = None
+  baseline = None
+
+  for opt, arg in opts:
+    if opt == '--files':
+      count = int( arg )
+    elif opt == '--trees':
+      shapes = arg.split( ',' )
+    elif opt == '--jobs':
+      jobs = int( arg )
+    elif opt == '--output':
+      output = arg
+    elif opt == '--baseline':
+      with open( arg ) as f:
+        baseline = json.load( f )
+
+  for shape in shapes:
+    if shape not in trees.SHAPES:
+      raise Exception( "unknown tree", shape, list( trees.SHAPES ) )
+
+  actions = [ main.ParseAction( raw ) for raw in RAW_ACTIONS ]
+  results = {
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'files': count,
+    'jobs': jobs,
+    'actions': RAW_ACTIONS,
+    'trees': {},
+  }
+
+  for shape in shapes:
+    root = trees.TempRoot()
+
+    try:
+      made = trees.CreateShape( root, shape, count )
+      print( "created {} files in '{}'".format( made, root ), file=sys.stderr )
+
+      # a message for every dropped rename would be timed with the phases
+      level     = log.level
+      log.level = log.ERROR
+      try:
+        seconds, counts = Phases( root, actions, jobs )
+      finally:
+        log.level = level
+      results['trees'][shape] = {
+        'files': made,
+        'seconds': seconds,
+        'counts': counts,
+      }
+
+    finally:
+      trees.RemoveTree( root )
+
+  if baseline is not None:
+    Compare( results, baseline )
+
+  text = json.dumps( results, indent=2 )
+
+  if output is None:
+    print( text )
+  else:
+    with open( output, 'w' ) as f:
+      f.write( text + '\n' )
+
+
+if __name__ == '__main__':
+  Main()
@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+
+"""
+Times the serial directory walk against the walk that reads directories at
+the same time (-j). Most useful when the tree is on a slow network file system,
+see --path.
+
+bench_walk.py [--files=N] [--jobs=N] [--path=existing_tree]
+"""
+
+
+from getopt import getopt
+import time
+import sys
+import os
+
+sys.path.append( os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'src' ) )
+sys.path.append( os.path.dirname( os.path.abspath( __file__ ) ) )
+
+import trees
+import fs
+
+
+def TimeWalk( path, jobs ):
+  """
+  Returns ( seconds, files ) for one recursive walk of path
+  """
+  start = time.perf_counter()
+  files = list( fs.GetFiles( [ path ], recursive=True, jobs=jobs ) )
+
+  return ( time.perf_counter() - start, files )
+
+
+def Main():
+  opts, args = getopt( sys.argv[1:], '', [ 'files=', 'jobs=', 'path=' ] )
+  count = 100000
+  jobs  = 8
+  path  = None
+
+  for opt, arg in opts:
+    if opt == '--files':
+      count = int( arg )
+    elif opt == '--jobs':
+      jobs = int( arg )
+    elif opt == '--path':
+      path = arg
+
+  root = None
+  if path is None:
+    # 10 x 10 x 10 directories with the files split between them
+    root = trees.TempRoot()
+    made = trees.CreateTree( root, 10, max( 1, count // 1000 ), depth=3 )
+    print( "created {} files in '{}'".format( made, root ) )
+    path = root
+
+  try:
+    serial, serial_files = TimeWalk( path, 1 )
+    parallel, parallel_files = TimeWalk( path, jobs )
+
+    if serial_files != parallel_files:
+      raise Exception( "parallel walk listed files in a different order" )
+
+    print( "files          {}".format( len( serial_files ) ) )
+    print( "serial         {:.3f}s".format( serial ) )
+    print( "jobs={:<9} {:.3f}s".format( jobs, parallel ) )
+    print( "speedup        {:.2f}x".format( serial / parallel ) )
+
+  finally:
+    if root is not None:
+      trees.RemoveTree( root )
+
+
+if __name__ == '__main__':
+  Main()
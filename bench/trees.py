@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+
+"""
+Creates synthetic directory trees for the benchmarks.
+"""
+
+
+import tempfile
+import shutil
+import os
+
+
+def TempRoot():
+  """
+  Makes an empty directory to build a tree in.
+  Uses a tmpfs (/dev/shm) if there is one so the disk doesn't get timed.
+
+  Returns the path of the directory
+  """
+  parent = None
+  if os.path.isdir( '/dev/shm' ) and os.access( '/dev/shm', os.W_OK ):
+    parent = '/dev/shm'
+
+  return tempfile.mkdtemp( prefix='renamer-bench-', dir=parent )
+
+
+def CreateTree( root, dirs, files, depth=1, extensions=( '.mkv', ) ):
+  """
+  Fills root with a tree of empty files.
+
+  root       | the directory to build in
+  dirs       | how many directories are in each directory above the bottom
+  files      | how many files are in each directory at the bottom
+  depth      | how many levels of directories there are
+  extensions | the file extensions are taken from this in turn
+
+  Returns the number of files created
+  """
+  if depth == 0:
+    for i in range( files ):
+      ext = extensions[ i % len( extensions ) ]
+      open( os.path.join( root, 'show name episode {} [random crap]{}'.format( i, ext ) ), 'w' ).close()
+
+    return files
+
+  count = 0
+  for i in range( dirs ):
+    path = os.path.join( root, 'Season {:02}'.format( i ) )
+    os.mkdir( path )
+    count += CreateTree( path, dirs, files, depth=depth-1, extensions=extensions )
+
+  return count
+
+
+# how the benchmark trees are laid out, the files are split between the bottom directories
+#   name: ( directories in each directory, depth, extensions )
+SHAPES = {
+  # every file in one directory
+  'flat': ( 0, 0, ( '.mkv', ) ),
+  # 2 directories in each, 10 deep
+  'deep-narrow': ( 2, 10, ( '.mkv', ) ),
+  # 1000 directories with the files split between them
+  'wide-shallow': ( 1000, 1, ( '.mkv', ) ),
+  # 10 x 10 directories of many kinds of files
+  'mixed-extensions': ( 10, 2, ( '.mkv', '.srt', '.mp4', '.nfo', '.jpg', '.txt', '.mp3' ) ),
+}
+
+
+def CreateShape( root, shape, count ):
+  """
+  Fills root with one of the SHAPES, with about count files.
+
+  Returns the number of files created
+  """
+  dirs, depth, extensions = SHAPES[shape]
+  bottom = dirs ** depth
+
+  return CreateTree( root, dirs, max( 1, count // bottom ), depth=depth, extensions=extensions )
+
+
+def RemoveTree( root ):
+  shutil.rmtree( root, ignore_errors=True )
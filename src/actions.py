@@ -0,0 +1,143 @@
+#!/bin/python3
+
+"""
+The actions that can be done to a file name, parsed once and then applied to
+every file.
+"""
+
+
+import os
+import re
+
+
+class Action:
+  """
+  An action with everything it needs prepared ahead of time.
+
+  Subclasses list their arguments in fields; they are what makes two actions equal.
+  """
+  __slots__ = ()
+  name   = None
+  fields = ()
+
+  def apply( self, file, partial=False ):
+    """
+    Does the action to the file name.
+
+    file    | the file path or name to change
+    partial | if false, returns None when the action doesn't change the name
+
+    Returns the changed file name.
+    """
+    raise NotImplementedError
+
+  def __eq__( self, other ):
+    if type( self ) is not type( other ):
+      return NotImplemented
+
+    return all( getattr( self, f ) == getattr( other, f ) for f in self.fields )
+
+  def __hash__( self ):
+    return hash( ( self.name, *( getattr( self, f ) for f in self.fields ) ) )
+
+  def __repr__( self ):
+    return "{}( {} )".format( type( self ).__name__, ', '.join( repr( getattr( self, f ) ) for f in self.fields ) )
+
+
+class Remove( Action ):
+  """
+  Removes all occurances of a regex.
+  """
+  __slots__ = ( 'pattern', 'regex', 'sub' )
+  name   = 'remove'
+  fields = ( 'pattern', )
+
+  def __init__( self, pattern ):
+    self.pattern = pattern
+    self.regex   = re.compile( pattern )
+    self.sub     = self.regex.sub
+
+  def apply( self, file, partial=False ):
+    # didn't see a remove function so actually just replacing with nothing
+    new_file = self.sub( '', file )
+
+    if not partial and new_file == file:
+      return None
+
+    return new_file
+
+
+class Replace( Action ):
+  """
+  Replaces all occurances of a regex with some text (which can use the regex's groups).
+  """
+  __slots__ = ( 'pattern', 'replacement', 'regex', 'sub' )
+  name   = 'replace'
+  fields = ( 'pattern', 'replacement' )
+
+  def __init__( self, pattern, replacement ):
+    self.pattern     = pattern
+    self.replacement = replacement
+    self.regex       = re.compile( pattern )
+    self.sub         = self.regex.sub
+
+  def apply( self, file, partial=False ):
+    new_file = self.sub( self.replacement, file )
+
+    if not partial and new_file == file:
+      return None
+
+    return new_file
+
+
+class Insert( Action ):
+  """
+  Inserts some text at a position, negative positions are from the end.
+  """
+  __slots__ = ( 'position', 'text' )
+  name   = 'insert'
+  fields = ( 'position', 'text' )
+
+  def __init__( self, position, text ):
+    self.position = position
+    self.text     = text
+
+  def apply( self, file, partial=False ):
+    position = self.position
+
+    # if the insert position is outside of the file name
+    if position > 0:
+      outside = position >= len( file )
+    else:
+      outside = -position >= len( file )
+
+    # if the insert position is a real position in the file name, insert the stuff there
+    if outside:
+      new_file = file
+    else:
+      new_file = file[ 0:position ] + self.text + file[ position: ]
+
+    if not partial and new_file == file:
+      return None
+
+    return new_file
+
+
+class Append( Action ):
+  """
+  Appends some text to the end of the name, before the extension (if any).
+  """
+  __slots__ = ( 'text', )
+  name   = 'append'
+  fields = ( 'text', )
+
+  def __init__( self, text ):
+    self.text = text
+
+  def apply( self, file, partial=False ):
+    ext_i = file.rfind( os.path.extsep )
+
+    if ext_i < 0:
+      return file + self.text
+
+    return file[ 0 : ext_i ] + self.text + file[ ext_i: ]
@@ -0,0 +1,273 @@
+#!/bin/python3
+
+r"""
+Does actions to many names at once. The names are joined into one string with
+a newline between each, every regex action is run once over the whole string,
+and the result is split back into names. This saves a call to re.sub from
+Python for every name and action.
+
+A regex is only run over the joined names if it can't tell it isn't looking
+at one name: it can't match a newline, doesn't look behind or ahead, and uses
+^ and $ (run with re.MULTILINE, so they match at each name) but not \A or \Z.
+Its replacement can only use groups, no other escapes. Other regexes, and the
+actions that aren't regexes, are done to each name on its own.
+"""
+
+
+import time
+import re
+
+from actions import Remove, Replace
+
+# re's parser, renamed in python 3.11
+try:
+  from re import _parser as sre_parse
+  from re import _constants as sre_constants
+except ImportError:
+  import sre_parse
+  import sre_constants
+
+
+DELIMITER = '\n'
+
+# what the categories (\s, \D, ...) in a parsed regex match
+CATEGORIES = {
+  sre_constants.CATEGORY_SPACE: re.compile( r'\s' ),
+  sre_constants.CATEGORY_NOT_SPACE: re.compile( r'\S' ),
+  sre_constants.CATEGORY_DIGIT: re.compile( r'\d' ),
+  sre_constants.CATEGORY_NOT_DIGIT: re.compile( r'\D' ),
+  sre_constants.CATEGORY_WORD: re.compile( r'\w' ),
+  sre_constants.CATEGORY_NOT_WORD: re.compile( r'\W' ),
+  sre_constants.CATEGORY_LINEBREAK: re.compile( r'\n' ),
+  sre_constants.CATEGORY_NOT_LINEBREAK: re.compile( r'[^\n]' ),
+}
+
+REPEATS = set( getattr( sre_constants, name ) for name in
+  [ 'MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT' ] if hasattr( sre_constants, name ) )
+
+# { action: compiled regex to run over the joined names, or None if it can't be }
+_joined = {}
+
+
+def _ClassMatches( items, char ):
+  r"""
+  Returns True if a character class ([...], \s, ...) can match char, as a number
+  """
+  negate = False
+  found  = False
+
+  for op, av in items:
+    if op == sre_constants.NEGATE:
+      negate = True
+
+    elif op == sre_constants.LITERAL:
+      found = found or av == char
+
+    elif op in ( sre_constants.RANGE, getattr( sre_constants, 'RANGE_UNI_IGNORE', None ) ):
+      found = found or av[0] <= char <= av[1]
+
+    elif op == sre_constants.CATEGORY and av in CATEGORIES:
+      found = found or CATEGORIES[av].match( chr( char ) ) is not None
+
+    else:
+      # something new, assume the worst
+      return True
+
+  return found != negate
+
+
+def _Local( parsed, char, dotall, string_anchors ):
+  """
+  Returns True if a parsed regex can't match char and doesn't look behind or
+  ahead, so it finds the same matches in the pieces of a string split at char
+  as in the whole string (apart from at the ends of the pieces).
+
+  parsed         | a list of ( op, argument ) from sre_parse
+  char           | the character, as a number
+  dotall         | if '.' matches a newline where parsed is
+  string_anchors | if false, \\A and \\Z aren't allowed either
+  """
+  for op, av in parsed:
+    if op == sre_constants.LITERAL:
+      if av == char:
+        return False
+
+    elif op == sre_constants.NOT_LITERAL:
+      if av != char:
+        return False
+
+    elif op == sre_constants.ANY:
+      if dotall or char != ord( '\n' ):
+        return False
+
+    elif op == sre_constants.IN:
+      if _ClassMatches( av, char ):
+        return False
+
+    elif op == sre_constants.AT:
+      if not string_anchors and av in ( sre_constants.AT_BEGINNING_STRING, sre_constants.AT_END_STRING ):
+        return False
+
+    elif op in REPEATS:
+      if not _Local( av[2], char, dotall, string_anchors ):
+        return False
+
+    elif op == sre_constants.SUBPATTERN:
+      group, add_flags, del_flags, sub = av
+      inner = ( dotall or add_flags & re.DOTALL ) and not del_flags & re.DOTALL
+      if not _Local( sub, char, inner, string_anchors ):
+        return False
+
+    elif op == getattr( sre_constants, 'ATOMIC_GROUP', None ):
+      if not _Local( av, char, dotall, string_anchors ):
+        return False
+
+    elif op == sre_constants.BRANCH:
+      if not all( _Local( branch, char, dotall, string_anchors ) for branch in av[1] ):
+        return False
+
+    elif op == sre_constants.GROUPREF_EXISTS:
+      group, yes, no = av
+      if not _Local( yes, char, dotall, string_anchors ) or ( no is not None and not _Local( no, char, dotall, string_anchors ) ):
+        return False
+
+    elif op == sre_constants.GROUPREF:
+      # whatever the group matched, which was checked already
+      pass
+
+    else:
+      # looking behind or ahead, or something new
+      return False
+
+  return True
+
+
+def Local( regex, char, string_anchors=True ):
+  """
+  Returns True if a compiled regex can't match char and doesn't look behind or
+  ahead (see _Local)
+  """
+  try:
+    parsed = sre_parse.parse( regex.pattern, regex.flags )
+  except ( re.error, RecursionError ):
+    return False
+
+  return _Local( parsed, ord( char ), regex.flags & re.DOTALL, string_anchors )
+
+
+def _SafeReplacement( replacement ):
+  """
+  Returns True if a replacement can't put a newline in a name
+  """
+  return DELIMITER not in replacement and re.search( r'\\(?![1-9]|g<)', replacement ) is None
+
+
+def JoinedRegex( action ):
+  """
+  Returns the regex to run over joined names for an action, or None if it has
+  to be done to each name on its own
+  """
+  if action in _joined:
+    return _joined[action]
+
+  regex = None
+
+  if type( action ) in ( Remove, Replace ) and ( type( action ) is Remove or _SafeReplacement( action.replacement ) ):
+    if Local( action.regex, DELIMITER, string_anchors=False ):
+      regex = re.compile( action.pattern, action.regex.flags | re.MULTILINE )
+
+  _joined[action] = regex
+  return regex
+
+
+def ApplyEach( actions, names, partial=True, collected=None, bits=True ):
+  """
+  Does a list of actions to many names, each action run over the names joined
+  together when it can be (see JoinedRegex) and to each name on its own when not.
+
+  actions   | a list of actions.Action
+  names     | a list of file names or paths
+  partial   | if false, a name an action doesn't change is dropped, and the
+              actions after it aren't done to it
+  collected | an optional stats.Stats to time each action on each name in. the
+              names are never joined then, so each action is timed on its own name
+  bits      | if false, which actions changed each name isn't worked out
+
+  Returns ( a list of the new names in the same order, None for names that
+  were dropped, a list of the bits of the actions that changed each name:
+  1 << i for actions[i], or None without bits )
+  """
+  # only names without newlines can be joined
+  joinable = collected is None and DELIMITER.join( names ).count( DELIMITER ) == len( names ) - 1
+
+  # the names still being changed, where they were in names and which actions changed them
+  current = list( names )
+  where   = range( len( names ) )
+  changed = [ 0 ] * len( names )
+
+  for bit, action in enumerate( actions ):
+    regex     = JoinedRegex( action ) if joinable else None
+    new_names = None
+
+    if regex is not None:
+      replacement = action.replacement if type( action ) is Replace else ''
+      new_names   = regex.sub( replacement, DELIMITER.join( current ) ).split( DELIMITER )
+
+      if len( new_names ) != len( current ):
+        # can't happen, but a wrong name would be much worse than a slow one
+        new_names = None
+
+      elif not partial:
+        new_names = [ new if new != old else None for new, old in zip( new_names, current ) ]
+
+    if new_names is None and collected is None:
+      new_names = [ action.apply( name, partial ) for name in current ]
+
+    elif new_names is None:
+      clock     = time.perf_counter
+      new_names = []
+      for name in current:
+        start = clock()
+        new_names.append( action.apply( name, partial ) )
+        collected.Sample( action, clock() - start )
+
+    if bits:
+      flag    = 1 << bit
+      changed = [ c | flag if new != old else c for c, new, old in zip( changed, new_names, current ) ]
+
+    # drop the names the action couldn't be done to
+    if None in new_names:
+      if bits:
+        changed = [ c for c, new in zip( changed, new_names ) if new is not None ]
+
+      where   = [ i for i, new in zip( where, new_names ) if new is not None ]
+      current = [ new for new in new_names if new is not None ]
+    else:
+      current = new_names
+
+  results = [ None ] * len( names )
+  for i, name in zip( where, current ):
+    results[i] = name
+
+  if not bits:
+    return ( results, None )
+
+  done = [ 0 ] * len( names )
+  for i, c in zip( where, changed ):
+    done[i] = c
+
+  return ( results, done )
+
+
+def ApplyBatch( actions, names, partial=False ):
+  """
+  Does a list of actions to many names, see main.ApplyActions and ApplyEach.
+
+  actions | a list of actions.Action
+  names   | a list of file names or paths
+  partial | if false, a name an action doesn't change isn't renamed
+
+  Returns a list of the new names in the same order, None for names an action
+  couldn't be done to
+  """
+  return ApplyEach( actions, names, partial=partial, bits=False )[0]
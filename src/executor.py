@@ -0,0 +1,194 @@
+#!/bin/python3
+
+"""
+Does renames relative to open directories, so each directory's path is only
+looked up once instead of on every rename in it.
+
+Renames that mustn't overwrite anything use renameat2( RENAME_NOREPLACE ) where
+the C library and file system have it, so a file that appears at the new name
+after the renames were planned is never replaced. Otherwise the new name is
+checked right before renaming, which leaves a small window for a race.
+"""
+
+
+from collections import OrderedDict
+import errno
+import sys
+import os
+
+import stats
+
+
+RENAME_NOREPLACE = 1
+
+# the most directories kept open at once
+MAX_OPEN = 256
+
+# False once renameat2 is known not to work, None until it has been tried
+_renameat2 = None
+
+
+def _RenameAt2():
+  """
+  Returns the C library's renameat2, or False if it doesn't have one
+  """
+  global _renameat2
+
+  if _renameat2 is None:
+    _renameat2 = False
+
+    if sys.platform.startswith( 'linux' ):
+      import ctypes.util
+      import ctypes
+
+      try:
+        libc = ctypes.CDLL( ctypes.util.find_library( 'c' ), use_errno=True )
+        _renameat2 = libc.renameat2
+        _renameat2.argtypes = [ ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint ]
+      except ( OSError, AttributeError ):
+        # glibc older than 2.28, or not glibc
+        _renameat2 = False
+
+  return _renameat2
+
+
+def Shards( renames ):
+  """
+  Splits ordered renames into groups that can be done at the same time.
+
+  Renames that touch the same directory, as their old or new name, are kept in
+  one group in the order they were given, so a rename that needs another out of
+  the way (see planner.OrderRenames) is still done after it.
+
+  renames | a list of ( current_name, desired_name ) in the order they will be done
+
+  Returns a list of lists of ( n, rename ), n being the rename's place in renames
+  """
+  parent = {}
+
+  def Dir( path ):
+    return os.path.normpath( os.path.dirname( path ) )
+
+  def Find( d ):
+    root = d
+    while parent[root] != root:
+      root = parent[root]
+
+    # point everything on the way straight at the root
+    while parent[d] != root:
+      parent[d], d = root, parent[d]
+
+    return root
+
+  for old, new in renames:
+    a = Dir( old )
+    b = Dir( new )
+    parent.setdefault( a, a )
+    parent.setdefault( b, b )
+    a = Find( a )
+    b = Find( b )
+    if a != b:
+      parent[b] = a
+
+  shards = OrderedDict()
+  for n, rename in enumerate( renames ):
+    shards.setdefault( Find( Dir( rename[0] ) ), [] ).append( ( n, rename ) )
+
+  return list( shards.values() )
+
+
+class Executor:
+  """
+  Renames files, keeping the directories they are in open.
+  """
+  def __init__( self, overwrite=False ):
+    """
+    overwrite | if true, renames can replace existing files
+    """
+    self.overwrite = overwrite
+    self.dirs      = OrderedDict()
+    self.dir_fd    = os.rename in os.supports_dir_fd
+
+  def _Dir( self, path ):
+    """
+    Returns a file descriptor of the directory, opening it if it isn't open
+    """
+    fd = self.dirs.get( path )
+    if fd is not None:
+      self.dirs.move_to_end( path )
+      return fd
+
+    if stats.current is not None:
+      stats.current.Count( 'directories opened' )
+
+    fd = os.open( path or '.', os.O_RDONLY | getattr( os, 'O_DIRECTORY', 0 ) | getattr( os, 'O_CLOEXEC', 0 ) )
+    self.dirs[path] = fd
+
+    if len( self.dirs ) > MAX_OPEN:
+      os.close( self.dirs.popitem( last=False )[1] )
+
+    return fd
+
+  def _Exists( self, name, fd ):
+    if stats.current is not None:
+      stats.current.Count( 'stat calls' )
+
+    try:
+      os.stat( name, dir_fd=fd, follow_symlinks=False )
+    except FileNotFoundError:
+      return False
+    return True
+
+  def Rename( self, old, new ):
+    """
+    Renames a file.
+
+    Raises FileExistsError if new exists and overwrite is off, or another
+    OSError if the rename couldn't be done
+    """
+    global _renameat2
+
+    if stats.current is not None:
+      stats.current.Count( 'renames' )
+
+    if not self.dir_fd:
+      if not self.overwrite and os.path.lexists( new ):
+        raise FileExistsError( errno.EEXIST, os.strerror( errno.EEXIST ), old, None, new )
+      os.rename( old, new )
+      return
+
+    old_dir, old_name = os.path.split( old )
+    new_dir, new_name = os.path.split( new )
+    old_fd = self._Dir( old_dir )
+    new_fd = self._Dir( new_dir )
+
+    if not self.overwrite:
+      renameat2 = _RenameAt2()
+
+      if renameat2:
+        import ctypes
+
+        if renameat2( old_fd, os.fsencode( old_name ), new_fd, os.fsencode( new_name ), RENAME_NOREPLACE ) == 0:
+          return
+
+        e = ctypes.get_errno()
+
+        # the file system doesn't have it (some network ones), check by hand from now on
+        if e in ( errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP ):
+          _renameat2 = False
+        else:
+          raise OSError( e, os.strerror( e ), old, None, new )
+
+      if self._Exists( new_name, new_fd ):
+        raise FileExistsError( errno.EEXIST, os.strerror( errno.EEXIST ), old, None, new )
+
+    os.rename( old_name, new_name, src_dir_fd=old_fd, dst_dir_fd=new_fd )
+
+  def Close( self ):
+    """
+    Closes the directories.
+    """
+    for fd in self.dirs.values():
+      os.close( fd )
+
+    self.dirs = OrderedDict()
@@ -0,0 +1,80 @@
+#!/bin/python3
+
+"""
+Sorts more renames than fit in memory, by sorting them a chunk at a time into
+temporary files and merging those.
+"""
+
+
+import tempfile
+import heapq
+import json
+
+
+# how many items are sorted in memory at a time
+CHUNK_SIZE = 200000
+
+
+def _WriteChunk( chunk ):
+  """
+  Writes sorted items to a temporary file, one json list per line.
+
+  Returns the file, ready to be read from the start
+  """
+  f = tempfile.TemporaryFile( mode='w+' )
+
+  for item in chunk:
+    f.write( json.dumps( item ) )
+    f.write( '\n' )
+
+  f.seek( 0 )
+  return f
+
+
+def _ReadChunk( f ):
+  """
+  Yields the items written to f by _WriteChunk, as tuples
+  """
+  for line in f:
+    yield tuple( json.loads( line ) )
+
+
+def Sorted( items, chunk_size=None ):
+  """
+  Sorts items, keeping at most chunk_size of them in memory.
+
+  items      | an iterable of tuples of strings (or anything else json keeps as a list)
+  chunk_size | how many items to sort in memory at a time, CHUNK_SIZE if not given
+
+  Yields the items in order
+  """
+  if chunk_size is None:
+    chunk_size = CHUNK_SIZE
+
+  chunks = []
+  chunk  = []
+
+  try:
+    for item in items:
+      chunk.append( item )
+
+      if len( chunk ) >= chunk_size:
+        chunk.sort()
+        chunks.append( _WriteChunk( chunk ) )
+        chunk = []
+
+    chunk.sort()
+
+    # everything fit in memory
+    if len( chunks ) == 0:
+      yield from chunk
+      return
+
+    chunks.append( _WriteChunk( chunk ) )
+    chunk = []
+
+    yield from heapq.merge( *[ _ReadChunk( f ) for f in chunks ] )
+
+  finally:
+    for f in chunks:
+      f.close()
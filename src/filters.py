@@ -0,0 +1,219 @@
+#!/bin/python3
+
+"""
+Matches names against several regular expressions at once, the way re.match
+would with each of them.
+
+The patterns are compiled once. Patterns that are only a prefix, suffix, whole
+name or piece of text (like 'shows/', '.*\\.mkv$' or '.*sample') are checked
+with string methods instead of the regex engine, and the rest are joined into
+one regex.
+"""
+
+
+import re
+
+
+# characters that mean something in a regex when they aren't escaped
+META = set( '.^$*+?{}[]|()' )
+
+
+def _Tokens( pattern ):
+  """
+  Splits a pattern into ( literal, character ) pairs, literal being False for
+  characters that mean something to the regex engine.
+  """
+  tokens = []
+  i = 0
+
+  while i < len( pattern ):
+    c = pattern[i]
+
+    if c == '\\':
+      # escaped letters and numbers are special (\d, \1, ...), anything else is itself
+      if i+1 >= len( pattern ) or pattern[i+1].isalnum():
+        tokens.append( ( False, pattern[i:i+2] ) )
+      else:
+        tokens.append( ( True, pattern[i+1] ) )
+      i += 2
+      continue
+
+    tokens.append( ( c not in META, c ) )
+    i += 1
+
+  return tokens
+
+
+def Literal( tokens ):
+  """
+  Returns the text the tokens match, or None if they aren't all literal
+  """
+  if not all( literal for literal, c in tokens ):
+    return None
+
+  return ''.join( c for literal, c in tokens )
+
+
+def LiteralPrefix( pattern ):
+  """
+  Returns the text every name re.match( pattern ) matches must start with.
+  Returns '' if there isn't any.
+  """
+  tokens = _Tokens( pattern )
+
+  if ( False, '^' ) in tokens[0:1]:
+    tokens = tokens[1:]
+
+  # an alternation anywhere can match something without the prefix
+  if ( False, '|' ) in tokens:
+    return ''
+
+  prefix = []
+  for i, ( literal, c ) in enumerate( tokens ):
+    if not literal:
+      # the character before a repeat might not be there
+      if c in '*?{' and len( prefix ) > 0:
+        prefix.pop()
+      break
+
+    # a repeat can follow after a literal, like 'a+' (still starts with 'a')
+    prefix.append( c )
+
+  return ''.join( prefix )
+
+
+def _Shape( pattern ):
+  """
+  Works out if a pattern can be matched without the regex engine.
+
+  Returns ( kind, text ), kind being one of 'prefix', 'suffix', 'equal' or
+  'contains', or None if it needs the regex engine
+  """
+  tokens = _Tokens( pattern )
+
+  if tokens[0:1] == [ ( False, '^' ) ]:
+    tokens = tokens[1:]
+
+  any_start = tokens[0:2] == [ ( False, '.' ), ( False, '*' ) ]
+  if any_start:
+    tokens = tokens[2:]
+
+  anchored = tokens[-1:] == [ ( False, '$' ) ]
+  if anchored:
+    tokens = tokens[:-1]
+
+  any_end = tokens[-2:] == [ ( False, '.' ), ( False, '*' ) ]
+  if any_end:
+    tokens = tokens[:-2]
+
+  text = Literal( tokens )
+  if text is None or text == '':
+    return None
+
+  if any_start:
+    if anchored and not any_end:
+      return ( 'suffix', text )
+    return ( 'contains', text )
+
+  if anchored and not any_end:
+    return ( 'equal', text )
+
+  return ( 'prefix', text )
+
+
+class Filter:
+  """
+  A set of patterns; a name matches if re.match would match it with any of them.
+  """
+  __slots__ = ( 'patterns', 'prefixes', 'suffixes', 'equals', 'contains', 'regex', 'regexes', 'fallback' )
+
+  def __init__( self, patterns ):
+    """
+    patterns | a regular expression, or a list of them
+    """
+    if isinstance( patterns, str ):
+      patterns = [ patterns ]
+
+    self.patterns = list( patterns )
+    self.prefixes = []
+    self.suffixes = []
+    self.equals   = set()
+    self.contains = []
+    self.regexes  = []
+
+    # names with new lines in them are always checked with re.match, since
+    # '.' and '$' treat them differently than the string methods
+    self.fallback = [ re.compile( pattern ) for pattern in self.patterns ]
+
+    others = []
+    for pattern in self.patterns:
+      shape = _Shape( pattern )
+
+      if shape is None:
+        others.append( pattern )
+      elif shape[0] == 'prefix':
+        self.prefixes.append( shape[1] )
+      elif shape[0] == 'suffix':
+        self.suffixes.append( shape[1] )
+      elif shape[0] == 'equal':
+        self.equals.add( shape[1] )
+      else:
+        self.contains.append( shape[1] )
+
+    self.prefixes = tuple( self.prefixes )
+    self.suffixes = tuple( self.suffixes )
+    self.regex    = None
+
+    # back references are numbered across the whole regex, so patterns that
+    # use them can't be joined with others
+    joinable = [ p for p in others if not re.search( r'\\[1-9]|\(\?P=', p ) ]
+    separate = [ p for p in others if p not in joinable ]
+
+    if len( joinable ) == 1:
+      self.regex = re.compile( joinable[0] )
+    elif len( joinable ) > 1:
+      try:
+        self.regex = re.compile( '|'.join( '(?:{})'.format( p ) for p in joinable ) )
+      except re.error:
+        # flags or group names that clash, keep them apart
+        separate.extend( joinable )
+
+    self.regexes = [ re.compile( p ) for p in separate ]
+
+  def match( self, name ):
+    """
+    Returns True if name matches any of the patterns
+    """
+    if '\n' in name:
+      return any( regex.match( name ) for regex in self.fallback )
+
+    if self.prefixes and name.startswith( self.prefixes ):
+      return True
+
+    if self.suffixes and name.endswith( self.suffixes ):
+      return True
+
+    if name in self.equals:
+      return True
+
+    for text in self.contains:
+      if text in name:
+        return True
+
+    if self.regex is not None and self.regex.match( name ):
+      return True
+
+    for regex in self.regexes:
+      if regex.match( name ):
+        return True
+
+    return False
+
+  def filter( self, names ):
+    """
+    Yields the names that match
+    """
+    match = self.match
+    for name in names:
+      if match( name ):
+        yield name
@@ -1,7 +1,10 @@
-import sys
+from collections import OrderedDict
+import time
 import os
-import re
-import unittest
+
+import filters
+import stats
+import log
 
 
 global verbose
@@ -24,102 +27,373 @@ def ValidPaths( paths ):
       valid.append( path )
 
     elif verbose:
-      print( "path doesn't exist '{}'".format( path ) )
+      log.Debug( "path doesn't exist '{}'", path )
 
   return valid
 
 
-def WalkDirectory( path, recursive=True ):
+def _ScanDirectory( path ):
   """
-  Lists all files in given path
+  Lists the entries directly inside a directory.
 
-  path      | a file or directory path (returns [path] if it is a file)
-  recursive | if true, all files inside all folders are returned
-              if false, only files directly in path are returned
+  path | a directory path
 
-  Returns a list of files in given path
+  Returns a list of ( kind, entry_path, entry_name ), kind being one of
+    'file' | a file or a link to one
+    'link' | any other link (broken or to a directory)
+    'dir'  | a directory
+    None   | anything else
+  Returns None if the directory can't be read.
   """
-  global verbose
-  files = []
+  entries = []
 
-  if os.path.isfile( path ):
-    return [ path ]
+  try:
+    with os.scandir( path ) as objs:
+      for obj in objs:
+        # keep the names the same as os.listdir gave; no './' in front of
+        # files in the current directory
+        name = obj.path if path != '.' else obj.name
 
-  if verbose:
-    print( "Walking directory: '{}'".format( path ), file=sys.stderr )
+        # DirEntry caches the type from the directory listing, so these only
+        # stat when the file system didn't give a type (or for links)
+        try:
+          if obj.is_file():
+            entries.append( ( 'file', name, obj.name ) )
 
-  try:
-    objs = os.listdir( path )
+          elif obj.is_symlink():
+            entries.append( ( 'link', name, obj.name ) )
+
+          elif obj.is_dir():
+            entries.append( ( 'dir', name, obj.name ) )
+
+          else:
+            entries.append( ( None, name, obj.name ) )
+
+        except OSError:
+          entries.append( ( None, name, obj.name ) )
 
   except PermissionError:
-    print( "Permission Denied '{}'".format( path ), file=sys.stderr )
-    return []
+    log.File( log.WARNING, "Permission Denied '{}'", path )
+    return None
 
-  for obj in objs:
-    if path != '.':
-      obj = os.path.join( path, obj )
+  if stats.current is not None:
+    stats.current.Count( 'directories listed' )
+    stats.current.Count( 'entries listed', len( entries ) )
 
-    if os.path.isfile( obj ):
-      files.append( obj )
+  return entries
 
+
+def _Walk( path, listing, recursive, schedule, index=None, descend=None ):
+  """
+  Goes through a directory listing, depth first.
+
+  path      | the directory being walked
+  listing   | a function that returns the listing of path (see _ScanDirectory)
+  recursive | if true, walks into the directories in path
+  schedule  | a function taking a directory path and returning a listing function for it
+  index     | an optional DirectoryIndex to remember the listing in
+  descend   | an optional function taking a directory path, returning False
+              for directories that shouldn't be walked into
+
+  Yields the files in path
+  """
+  global verbose
+
+  if verbose:
+    log.File( log.DEBUG, "Walking directory: '{}'", path )
+
+  entries = listing()
+  if entries is None:
+    return
+
+  if index is not None:
+    index.AddListing( path, [ name for kind, obj, name in entries ] )
+
+  # ask for all the sub directories before going through this one, so they
+  # can be listed while this one is being used
+  subdirs = {}
+  if recursive:
+    for kind, obj, name in entries:
+      if kind == 'dir' and ( descend is None or descend( obj ) ):
+        subdirs[obj] = schedule( obj )
+
+  for kind, obj, name in entries:
+    if kind == 'file':
       if verbose:
-        print( "file '{}'".format( obj ), file=sys.stderr )
+        log.File( log.DEBUG, "file '{}'", obj )
 
-    elif os.path.islink( obj ):
-      files.append( obj )
+      yield obj
 
+    elif kind == 'link':
       if verbose:
-        print("link file '{}'".format( obj ), file=sys.stderr )
+        log.File( log.DEBUG, "link file '{}'", obj )
 
-    elif os.path.isdir( obj ) and recursive:
-      files.extend( WalkDirectory( obj ) )
+      yield obj
+
+    elif kind == 'dir' and obj in subdirs:
+      yield from _Walk( obj, subdirs[obj], recursive, schedule, index=index, descend=descend )
+
+    elif kind == 'dir':
+      if verbose and recursive:
+        log.File( log.DEBUG, "skipping directory '{}'", obj )
 
     elif verbose:
-      print( "not a file or folder '{}'".format( obj ), file=sys.stderr )
+      log.File( log.DEBUG, "not a file or folder '{}'", obj )
+
+
+def WalkDirectory( path, recursive=True, jobs=1, index=None, descend=None ):
+  """
+  Lists all files in given path as they are found
+
+  path      | a file or directory path (yields only path if it is a file)
+  recursive | if true, all files inside all folders are yielded
+              if false, only files directly in path are yielded
+  jobs      | how many directories can be read at the same time.
+              the files come out in the same order no matter how many.
+  index     | an optional DirectoryIndex to remember the directory listings in
+  descend   | an optional function taking a directory path inside path, returning
+              False for directories that shouldn't be walked into (see DirectoryFilter)
+
+  Yields the files in given path
+  """
+  if os.path.isfile( path ):
+    yield path
+    return
+
+  if jobs <= 1 or not recursive:
+    # read each directory when the walk gets to it
+    def schedule( obj ):
+      return lambda: _ScanDirectory( obj )
+
+    yield from _Walk( path, schedule( path ), recursive, schedule, index=index, descend=descend )
+    return
+
+  # only loaded for walks that use it
+  from concurrent.futures import ThreadPoolExecutor
+  pool = ThreadPoolExecutor( max_workers=jobs )
+
+  # read each directory as soon as its parent has been read. the walk still
+  # goes in order, waiting on a directory if it hasn't been read yet
+  def schedule( obj ):
+    return pool.submit( stats.Bound( _ScanDirectory ), obj ).result
+
+  try:
+    yield from _Walk( path, schedule( path ), recursive, schedule, index=index, descend=descend )
 
-  return files
+  finally:
+    # don't keep reading directories if the walk was stopped early
+    pool.shutdown( wait=True, cancel_futures=True )
 
 
-def ListFiles( paths, recursive=False ):
+def Join( path, name ):
   """
-  Lists all files in given paths.
+  Returns the path of name in directory path, named the way _ScanDirectory does
+  """
+  return name if path == '.' else os.path.join( path, name )
 
-  paths     | a list of file or directory paths
-  recursive | if true, all files inside all folders are returned
-              if false, only files directly in folders specified are returned
 
-  Returns a list files in given paths
+def _WalkChanges( path, state, recursive, now, index=None, descend=None ):
   """
-  files = []
+  Goes through a directory, depth first, only listing it if it changed since
+  the last walk.
 
-  for path in paths:
-    files.extend( WalkDirectory( path, recursive=recursive ) )
+  path      | the directory being walked
+  state     | a scan_state.ScanState
+  recursive | if true, walks into the directories in path
+  now       | the time the walk started, in seconds
+  index     | an optional DirectoryIndex to remember the listing in
+  descend   | an optional function deciding which directories to walk into, see _Walk
+
+  Yields the files in path that weren't there last time
+  """
+  global verbose
+
+  if stats.current is not None:
+    stats.current.Count( 'stat calls' )
+
+  try:
+    mtime = os.stat( path ).st_mtime_ns
+  except OSError:
+    state.Forget( path )
+    return
+
+  stored = state.Get( path )
+
+  if stored is not None and stored[0] == mtime:
+    entries = stored[1]
+    new     = set()
+
+    if stats.current is not None:
+      stats.current.Count( 'directories unchanged' )
+
+  else:
+    if verbose:
+      log.File( log.DEBUG, "Walking changed directory: '{}'", path )
+
+    listing = _ScanDirectory( path )
+    if listing is None:
+      return
+
+    entries = [ ( kind, name ) for kind, obj, name in listing ]
+    old     = set( stored[1] ) if stored is not None else set()
+    new     = set( entries ) - old
+
+    # directories that are gone, or aren't directories anymore
+    for kind, name in old - set( entries ):
+      if kind == 'dir':
+        state.Forget( Join( path, name ) )
+
+    state.Put( path, mtime, entries, now )
+
+  if index is not None:
+    index.AddListing( path, [ name for kind, name in entries ] )
+
+  for kind, name in entries:
+    obj = Join( path, name )
 
-  return files
+    if kind in ( 'file', 'link' ):
+      if ( kind, name ) in new:
+        yield obj
+
+    elif kind == 'dir' and recursive:
+      if descend is None or descend( obj ):
+        yield from _WalkChanges( obj, state, recursive, now, index=index, descend=descend )
+
+      elif verbose:
+        log.File( log.DEBUG, "skipping directory '{}'", obj )
+
+
+def WalkChanges( path, state, recursive=True, index=None, descend=None ):
+  """
+  Lists the files in given path that are new since the last walk with the
+  same state. Directories whose modification time is the same as last time
+  aren't listed again, so files whose contents changed aren't found.
+
+  path      | a file or directory path (yields only path if it is a file)
+  state     | a scan_state.ScanState, updated with what was found
+  recursive | if true, all new files inside all folders are yielded
+  index     | an optional DirectoryIndex to remember the directory listings in
+  descend   | an optional function deciding which directories to walk into, see WalkDirectory
+
+  Yields the new files in given path
+  """
+  if os.path.isfile( path ):
+    yield path
+    return
+
+  yield from _WalkChanges( path, state, recursive, time.time(), index=index, descend=descend )
+
+
+def ListFiles( paths, recursive=False, jobs=1, index=None, descend=None, state=None ):
+  """
+  Lists all files in given paths.
+
+  paths     | a list of file or directory paths
+  recursive | if true, all files inside all folders are yielded
+              if false, only files directly in folders specified are yielded
+  jobs      | how many directories can be read at the same time
+  index     | an optional DirectoryIndex to remember the directory listings in
+  descend   | an optional function deciding which directories to walk into, see WalkDirectory
+  state     | an optional scan_state.ScanState; if given only files that are
+              new since the last walk are yielded (see WalkChanges), and jobs is ignored
+
+  Yields the files in given paths
+  """
+  for path in paths:
+    if state is not None:
+      yield from WalkChanges( path, state, recursive=recursive, index=index, descend=descend )
+    else:
+      yield from WalkDirectory( path, recursive=recursive, jobs=jobs, index=index, descend=descend )
 
 
 def FilterFiles( files, filter ):
+  """
+  Yields the files that match the filter.
+
+  files  | an iterable of file paths
+  filter | a regular expression, a list of them (any can match), or a filters.Filter
+  """
   global verbose
-  new_files = []
+
+  if not isinstance( filter, filters.Filter ):
+    filter = filters.Filter( filter )
+
+  if not verbose:
+    yield from filter.filter( files )
+    return
 
   for file in files:
-    if re.match( filter, file ):
-      new_files.append( file )
+    if filter.match( file ):
+      yield file
 
-    elif verbose:
-      print( "file doesn't match filter '{}'".format( arg ) )
+    else:
+      log.File( log.DEBUG, "file doesn't match filter '{}'", file )
 
-  return new_files
 
+def DirectoryFilter( filter_re=None, prune_re=None ):
+  """
+  Decides which directories a walk can skip.
+
+  filter_re | a regular expression, a list of them or a filters.Filter, that files have to match.
+              directories that can't have a matching file in them are skipped
+  prune_re  | a regular expression, or a list of them. directories whose path
+              matches are skipped
 
-def GetFiles( args, filter_re=None, recursive=False ):
+  Returns a function taking a directory path and returning False if it can be
+  skipped, or None if every directory has to be walked.
+  """
+  prefixes = None
+  if isinstance( filter_re, filters.Filter ):
+    filter_re = filter_re.patterns
+
+  if filter_re is not None:
+    if isinstance( filter_re, str ):
+      filter_re = [ filter_re ]
+
+    prefixes = [ filters.LiteralPrefix( pattern ) for pattern in filter_re ]
+
+    # a pattern without a literal start can match files anywhere
+    if '' in prefixes:
+      prefixes = None
+
+  prune = None
+  if prune_re is not None:
+    prune = filters.Filter( prune_re ).match
+
+  if prefixes is None and prune is None:
+    return None
+
+  def Descend( directory ):
+    if prune is not None and prune( directory ):
+      return False
+
+    if prefixes is not None:
+      # the files in the directory all start with this, so one of the
+      # prefixes has to either start with it or be the start of it
+      start = directory + os.sep
+      return any( prefix.startswith( start ) or start.startswith( prefix ) for prefix in prefixes )
+
+    return True
+
+  return Descend
+
+
+def GetFiles( args, filter_re=None, recursive=False, jobs=1, index=None, prune_re=None, state=None ):
   """
   Lists args that are files and match the filter expression.
 
   args      | a list of file paths and possibly other junk. only files that exist are returned.
-  filter_re | a regular expression used to filter out args
-
-  Returns a list of the args that are existing files and that match filter_re.
+  filter_re | a regular expression, or a list of them, used to filter out args.
+              directories that no file in could match aren't walked into
+  recursive | if true, files inside all folders are listed
+  jobs      | how many directories can be read at the same time
+  index     | an optional DirectoryIndex to remember the directory listings in
+  prune_re  | a regular expression, or a list of them. directories that match
+              aren't walked into
+  state     | an optional scan_state.ScanState, if given only files that are new
+              since the last walk with it are listed
+
+  Returns an iterator over the args that are existing files and that match filter_re.
   """
   global verbose
 
@@ -127,13 +401,14 @@ def GetFiles( args, filter_re=None, recursive=False ):
     args = (args, )
 
   if verbose:
-    print("Args: '{}'", args, file=sys.stderr )
+    log.Debug( "Args: {}", args )
 
   paths = ValidPaths( args )
   if verbose:
-    print("Valid paths in arguments:\n", paths, file=sys.stderr )
+    log.Debug( "Valid paths in arguments: {}", paths )
 
-  paths = ListFiles( args, recursive=recursive )
+  descend = DirectoryFilter( filter_re, prune_re )
+  paths = ListFiles( paths, recursive=recursive, jobs=jobs, index=index, descend=descend, state=state )
 
   if filter_re is not None:
     paths = FilterFiles( paths, filter_re )
@@ -141,18 +416,196 @@ def GetFiles( args, filter_re=None, recursive=False ):
   return paths
 
 
-class TestGetFiles(unittest.TestCase):
-  def test_recursive(self):
-    # Assert that there are more than 5 files in the parent directory.
-    # This is used to ensure that recursive mode is actually traversing directories.
-    self.assertTrue(len(GetFiles("../tests", recursive=True)) > len(GetFiles("../tests", recursive=False)))
+class DirectoryIndex:
+  """
+  The names in each directory, so checking if a file exists doesn't need a stat.
 
+  Directories are remembered as they are walked (see GetFiles), and others are
+  listed the first time something in them is looked up.
+  Paths are only compared after os.path.normpath, so the same directory spelt
+  two different ways (relative and absolute) is listed twice.
+  """
+  def __init__( self, max_dirs=None ):
+    """
+    max_dirs | the most directory listings to remember, the least recently
+               used are forgotten first and listed again if they are needed.
+               None to remember every directory. The renames planned into a
+               directory are kept until Unplan, so a forgotten directory
+               can't be given the same new name twice.
+    """
+    self.max_dirs = max_dirs
+    self.dirs     = OrderedDict()
+    self.planned  = {}
+
+  def _Split( self, path ):
+    """
+    Returns ( directory, name ) of path
+    """
+    directory, name = os.path.split( os.path.normpath( path ) )
+    if directory == '':
+      directory = '.'
+
+    return ( directory, name )
+
+  def _Remember( self, directory, names ):
+    self.dirs[directory] = names
+
+    if self.max_dirs is not None:
+      self.dirs.move_to_end( directory )
+
+      while len( self.dirs ) > self.max_dirs:
+        self.dirs.popitem( last=False )
+
+  def _Names( self, directory ):
+    """
+    Returns the set of names in directory, listing it if it hasn't been.
+    Returns None if it can't be listed.
+    """
+    names = self.dirs.get( directory )
+    if names is not None:
+      if self.max_dirs is not None:
+        self.dirs.move_to_end( directory )
+
+      return names
+
+    if stats.current is not None:
+      stats.current.Count( 'directories listed' )
+
+    try:
+      names = set( os.listdir( directory ) )
+
+    except ( FileNotFoundError, NotADirectoryError ):
+      names = set()
+
+    except OSError:
+      return None
+
+    self._Remember( directory, names )
+    return names
+
+  def AddListing( self, path, names ):
+    """
+    Remembers the names in a directory that has just been listed.
+    """
+    self._Remember( os.path.normpath( path ), set( names ) )
+
+  def Exists( self, path ):
+    """
+    Returns True if there is a file, directory or anything else at path
+    """
+    directory, name = self._Split( path )
+    names = self._Names( directory )
+
+    # the directory couldn't be listed, ask the file system
+    if names is None:
+      if stats.current is not None:
+        stats.current.Count( 'stat calls' )
+      return os.path.lexists( path )
+
+    return name in names
+
+  def Moved( self, old, new ):
+    """
+    Updates the names after old has been renamed to new.
+    """
+    directory, name = self._Split( old )
+    names = self._Names( directory )
+    if names is not None:
+      names.discard( name )
+
+    directory, name = self._Split( new )
+    names = self._Names( directory )
+    if names is not None:
+      names.add( name )
+
+  def Plan( self, path ):
+    """
+    Marks path as being taken by a rename that hasn't been done yet.
+    Exists still only says what is there now.
+    """
+    directory, name = self._Split( path )
+    self.planned.setdefault( directory, set() ).add( name )
+
+  def Unplan( self, path ):
+    """
+    Forgets a rename planned to path, once it has been done (so Exists finds
+    it, even in a forgotten directory) or dropped.
+    """
+    directory, name = self._Split( path )
+    names = self.planned.get( directory )
+    if names is None:
+      return
+
+    names.discard( name )
+    if len( names ) == 0:
+      del self.planned[directory]
+
+  def Planned( self, path ):
+    """
+    Returns True if path is already taken by another rename
+    """
+    directory, name = self._Split( path )
+    return name in self.planned.get( directory, () )
+
+
+def LastSeparator( path ):
+  """
+  Returns where the last os.sep or os.altsep in a path is, -1 if there isn't one
+  """
+  i = path.rfind( os.sep )
+  if os.altsep is not None:
+    i = max( i, path.rfind( os.altsep ) )
 
-class TestFilterFiles(unittest.TestCase):
-  def test_filter(self):
-    files = [
-      'file_one.jpeg',
-      'file_two.jpeg',
-      'file_three.jpg',
-      ]
-    self.assertTrue(len(FilterFiles(files, '[a-z_]+\.jpeg')) == 2)
+  return i
+
+
+def SplitName( path ):
+  """
+  Returns ( directory, name ) of a path, the directory ending in its separator
+  ('' if there isn't one), so directory + name is the path again
+  """
+  i = LastSeparator( path )
+  return ( path[:i + 1], path[i + 1:] )
+
+
+class DirectoryTable:
+  """
+  Each directory files are in, kept once. A file can then be kept as
+  ( directory number, name ), so only its name is given the actions and every
+  file in a directory shares one copy of the directory's path.
+
+  The numbers are only kept until Clear, so the table doesn't grow with every
+  directory walked.
+  """
+  def __init__( self ):
+    self.paths   = []
+    self.numbers = {}
+
+  def Split( self, path ):
+    """
+    Returns ( directory number, name ) of a path, see SplitName
+    """
+    i = LastSeparator( path )
+
+    directory = path[:i + 1]
+    number    = self.numbers.get( directory )
+
+    if number is None:
+      number = len( self.paths )
+      self.numbers[directory] = number
+      self.paths.append( directory )
+
+    return ( number, path[i + 1:] )
+
+  def Clear( self ):
+    """
+    Forgets every directory, the numbers Split gave out can't be joined any more
+    """
+    self.paths   = []
+    self.numbers = {}
+
+  def Join( self, number, name ):
+    """
+    Returns the path of name in a directory from Split
+    """
+    return self.paths[number] + name
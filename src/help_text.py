@@ -5,20 +5,15 @@ Written by Terrence, eightys3v3n@gmail.com
 """
 
 
-from getopt import getopt
-import unittest
 import textwrap
-import shutil
 import sys
 import os
-import re
 
 # appends the path of the script to the path environment
 # this allows the script to be run from working directories other than where it is
 sys.path.append( os.path.dirname( os.path.abspath( __file__ ) ) )
 
 import keyword_replacer
-import fs
 
 
 def AlignOptions( options, padding='  ' ):
@@ -89,13 +84,31 @@ def PrintHelp( options ):
   options = [
     [ '-h', '--help'     , "prints help text then exits." ],
     [ '-v', '--verbose'  , "prints more verbose messages. a really long description that should be wrapped." ],
+    [ '-q', '--quiet'    , "only prints warnings and errors, besides the renames of a dry run." ],
     [ '-d', '--do'       , "actually renames files; does dry run by default." ],
-    [ '-f', '--filter='  , "only works with files that match this regex." ],
-    [ '-R', '--result='  , "only performs renames that result in a file that matches this regex." ],
+    [ '-f', '--filter='  , "only works with files that match this regex. can be given more than once to match any of them." ],
+    [ '-R', '--result='  , "only performs renames that result in a file that matches this regex. can be given more than once to match any of them." ],
     [ '-a', '--action='  , "add an action to be performed on file names. actions are done in the order they are specified. (see actions)" ],
     [ '-p', '--partial'  , "allows for only some of the specified actions to be applied to file names" ],
     [ '-r', '--recursive', "scan directories recursively" ],
 	[ '-o', '--overwrite', "overwrite files if the destination file name already exists" ],
+    [ '-j', '--jobs='    , "read up to this many directories at the same time when scanning recursively, probe up to this many files for keywords at the same time, and rename in up to this many directories at the same time. the files stay in the same order, and so do the renames in each directory." ],
+    [ ''  , '--full-path'    , "do the actions to the whole path of each file, not only its name." ],
+    [ ''  , '--no-cache'     , "don't use or update the cache of probed files (for %res, ...)." ],
+    [ ''  , '--refresh-cache', "probe every file for keywords again and update the cache." ],
+    [ ''  , '--journal='      , "with -d, write every rename to this file before doing it, and mark each one when it is done." ],
+    [ ''  , '--resume='       , "finish the renames in a journal that was interrupted, then exit." ],
+    [ ''  , '--undo='         , "reverse the renames in a complete journal, then exit. the reversed renames are journaled in the same file with '.undo' added." ],
+    [ ''  , '--stream'       , "rename (or print) each file as soon as it is found, keeping little in memory. renames are unsorted, and can't go to the name of a file that is renamed later. a dry run, or one with --overwrite, still keeps every new name." ],
+    [ ''  , '--sort'         , "with --stream, sort the renames first, in temporary files if there are too many." ],
+    [ ''  , '--watch'        , "keep running, renaming files as they arrive in the directories given (written and closed, or moved in). Linux only." ],
+    [ ''  , '--rules='       , "rename with the named rule sets in this JSON (or .toml) file, instead of -a, -f and -R. the files are found once and each goes to the first rule set whose filter matches it. see rules.py for the format." ],
+    [ ''  , '--state='       , "remember each directory's listing in this file, and next time only use files that are new since then. directories that haven't changed aren't listed again. only saved when renames are done (-d). directories are walked one at a time with it, -j only applies to probing and renaming." ],
+    [ ''  , '--prune='       , "don't walk into directories whose path matches this regex. can be given more than once. directories that can't hold a file matching --filter are skipped without this." ],
+    [ ''  , '--stats='       , "after the run, print how long each phase took, how often files were listed, checked, renamed and probed, and how long each action took, to stderr. 'table' or 'json'. the actions are done to one name at a time to time them, instead of joined in batches." ],
+    [ ''  , '--profile='     , "write a cProfile of the run to this file, see python -m pstats." ],
+    [ ''  , '--json'         , "print the renames of a dry run, and the messages, as json lines." ],
+    [ ''  , '--log-limit='    , "print at most this many of each kind of message about single files (100 by default), and how many more there were at the end. 0 for no limit." ],
   ]
   replacements = []
   for keyword, func in keyword_replacer.KEYWORDS.items():
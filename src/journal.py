@@ -0,0 +1,362 @@
+#!/bin/python3
+
+"""
+A journal of renames, so a batch that was interrupted can be finished and a
+finished batch can be undone.
+
+The journal is a file of json lines:
+  { "journal": 1, "cwd": ..., "overwrite": ... }  what the paths are relative to
+  { "plan": n, "from": ..., "to": ... }            every rename, in an order they can be done
+  { "planned": count }                              written before any file is renamed
+  { "done": n }                                     after rename n is done, not
+                                                    always in order (see --jobs)
+  { "complete": true }                              after the last rename
+
+Done records are only forced to the disk every FSYNC_EVERY renames, so after a
+crash the last few renames might be done without a record. Those are found
+when resuming by their new name already being there.
+"""
+
+
+import json
+import os
+
+import log
+
+
+VERSION = 1
+
+# how many renames between each fsync of the journal
+FSYNC_EVERY = 1000
+
+# how much of the journal is read at a time when reading it backwards
+BLOCK_SIZE = 1 << 16
+
+
+def _Sync( path ):
+  """
+  Makes sure a new file's directory entry is on the disk.
+  """
+  fd = os.open( os.path.dirname( os.path.abspath( path ) ), os.O_RDONLY )
+  try:
+    os.fsync( fd )
+  finally:
+    os.close( fd )
+
+
+class Journal:
+  """
+  Writes a journal while renames are being done.
+  """
+  def __init__( self, path, overwrite=False, cwd=None, append=False ):
+    """
+    path      | the journal file, which must not exist yet
+    overwrite | if the renames are allowed to overwrite files
+    cwd       | the directory the paths are relative to, the current one if not given
+    append    | if true, adds to an existing journal instead
+    """
+    self.path    = path
+    self.file    = open( path, 'a' if append else 'x' )
+    self.pending = 0
+
+    if append:
+      # a run that was stopped might have left half a line at the end
+      if self.file.tell() > 0:
+        with open( path, 'rb' ) as f:
+          f.seek( -1, os.SEEK_END )
+          if f.read( 1 ) != b'\n':
+            self.file.write( '\n' )
+
+      return
+
+    self._Write( {
+      'journal': VERSION,
+      'cwd': cwd if cwd is not None else os.getcwd(),
+      'overwrite': overwrite,
+    } )
+
+  def _Write( self, record ):
+    self.file.write( json.dumps( record ) )
+    self.file.write( '\n' )
+
+  def Sync( self ):
+    """
+    Forces everything written so far to the disk.
+    """
+    self.file.flush()
+    os.fsync( self.file.fileno() )
+    self.pending = 0
+
+  def Plan( self, renames ):
+    """
+    Writes all the renames that are going to be done, before doing any of them.
+
+    renames | an iterable of ( current_name, desired_name ) in the order they will be done
+    """
+    count = 0
+    for n, rename in enumerate( renames ):
+      self._Write( { 'plan': n, 'from': rename[0], 'to': rename[1] } )
+      count += 1
+
+    self._Write( { 'planned': count } )
+    self.Sync()
+    _Sync( self.path )
+
+  def Done( self, n ):
+    """
+    Records that rename n was done.
+    """
+    self._Write( { 'done': n } )
+
+    self.pending += 1
+    if self.pending >= FSYNC_EVERY:
+      self.Sync()
+
+  def Close( self, complete=True ):
+    """
+    Closes the journal, marking it complete if all the renames were done.
+    """
+    if complete:
+      self._Write( { 'complete': True } )
+
+    self.Sync()
+    self.file.close()
+
+
+def _Parse( line ):
+  """
+  Returns the record on a line, or None if the line was only partly written
+  when a run was stopped.
+  """
+  try:
+    return json.loads( line )
+  except ValueError:
+    return None
+
+
+def ReadRecords( path ):
+  """
+  Yields each record in a journal, from the start.
+  """
+  with open( path ) as f:
+    for line in f:
+      record = _Parse( line )
+      if record is not None:
+        yield record
+
+
+def _LinesBackwards( f ):
+  """
+  Yields the lines of a binary file from the end, a block at a time.
+  The first thing yielded is whatever is after the last new line.
+  """
+  f.seek( 0, os.SEEK_END )
+  position = f.tell()
+  rest = b''
+
+  while position > 0:
+    size = min( BLOCK_SIZE, position )
+    position -= size
+    f.seek( position )
+
+    lines = ( f.read( size ) + rest ).split( b'\n' )
+
+    # the first line might carry on from the block before this one
+    rest = lines[0]
+    for line in reversed( lines[1:] ):
+      yield line
+
+  yield rest
+
+
+def ReadRecordsBackwards( path ):
+  """
+  Yields each record in a journal, from the end, without reading it all at once.
+  """
+  with open( path, 'rb' ) as f:
+    lines = _LinesBackwards( f )
+
+    # the last line is either empty or was only partly written
+    next( lines )
+
+    for line in lines:
+      record = _Parse( line )
+      if record is not None:
+        yield record
+
+
+class Done:
+  """
+  The numbers of the renames that were done, a bit each so a big journal can
+  be resumed without much memory.
+  """
+  __slots__ = ( 'bits', )
+
+  def __init__( self, planned=0 ):
+    """
+    planned | how many renames were planned
+    """
+    self.bits = bytearray( ( planned + 7 ) // 8 )
+
+  def add( self, n ):
+    if n >> 3 >= len( self.bits ):
+      self.bits.extend( bytes( ( n >> 3 ) + 1 - len( self.bits ) ) )
+
+    self.bits[n >> 3] |= 1 << ( n & 7 )
+
+  def __contains__( self, n ):
+    return n >> 3 < len( self.bits ) and self.bits[n >> 3] & ( 1 << ( n & 7 ) ) != 0
+
+  def __iter__( self ):
+    for i, byte in enumerate( self.bits ):
+      if byte != 0:
+        for bit in range( 8 ):
+          if byte & ( 1 << bit ):
+            yield ( i << 3 ) + bit
+
+
+def Status( path ):
+  """
+  Reads through a journal.
+
+  Returns ( header, planned, done, complete )
+    header   | the first record
+    planned  | how many renames were planned, None if the plan wasn't finished
+    done     | a Done of the numbers of the renames recorded as done, which can
+               be out of order when renames were done on many threads
+    complete | True if every rename was done
+  """
+  header   = None
+  planned  = None
+  done     = Done()
+  complete = False
+
+  for record in ReadRecords( path ):
+    if header is None:
+      if record.get( 'journal' ) != VERSION:
+        raise Exception( "not a journal, or from another version", path )
+      header = record
+
+    elif 'planned' in record:
+      planned = record['planned']
+      done    = Done( planned )
+
+    elif 'done' in record:
+      done.add( record['done'] )
+
+    elif 'complete' in record:
+      complete = True
+
+  if header is None:
+    raise Exception( "empty journal", path )
+
+  return ( header, planned, done, complete )
+
+
+def _Replay( path, header, done, verbose=False ):
+  """
+  Does the planned renames in a journal that aren't in done, recording them in it.
+  They are done with an executor.Executor, so a file that has shown up at a new
+  name is only replaced if the journal was written with overwrite on.
+
+  Returns the number of renames done
+  """
+  import executor
+
+  cwd       = header['cwd']
+  overwrite = header['overwrite']
+  journal   = Journal( path, append=True )
+  renamer   = executor.Executor( overwrite=overwrite )
+  count     = 0
+
+  try:
+    for record in ReadRecords( path ):
+      # all the renames are before the end of the plan
+      if 'planned' in record:
+        break
+
+      if 'plan' not in record or record['plan'] in done:
+        continue
+
+      n   = record['plan']
+      old = os.path.join( cwd, record['from'] )
+      new = os.path.join( cwd, record['to'] )
+
+      # the rename was done but its record never made it to the disk.
+      # a name that was going to be free is only taken if this rename was done
+      if os.path.lexists( new ) and ( not overwrite or not os.path.lexists( old ) ):
+        if verbose:
+          log.File( log.DEBUG, "already renamed '{}' -> '{}'", old, new )
+
+      else:
+        if verbose:
+          log.File( log.DEBUG, "renaming '{}' -> '{}'", old, new )
+
+        try:
+          renamer.Rename( old, new )
+
+        except FileExistsError:
+          # a file showed up there between the check and the rename
+          log.File( log.WARNING, "file already exists '{}', not renaming '{}'", new, old )
+          continue
+
+        count += 1
+
+      journal.Done( n )
+
+  except:
+    journal.Close( complete=False )
+    raise
+
+  finally:
+    renamer.Close()
+
+  journal.Close()
+  return count
+
+
+def Resume( path, verbose=False ):
+  """
+  Finishes the renames in an interrupted journal.
+
+  Returns the number of renames done
+  """
+  header, planned, done, complete = Status( path )
+
+  if complete:
+    log.Warn( "journal '{}' is already complete", path )
+    return 0
+
+  if planned is None:
+    # files are only renamed once the whole plan is written
+    log.Warn( "journal '{}' was stopped while planning, nothing was renamed", path )
+    return 0
+
+  return _Replay( path, header, done, verbose=verbose )
+
+
+def Undo( path, verbose=False ):
+  """
+  Reverses the renames in a complete journal. The reversed renames are written
+  to their own journal, path + '.undo', which can be resumed if it is interrupted.
+
+  Returns the number of renames done
+  """
+  header, planned, done, complete = Status( path )
+
+  if not complete:
+    raise Exception( "journal isn't complete, resume it first", path )
+
+  undo_path = path + '.undo'
+  if os.path.exists( undo_path ):
+    raise Exception( "journal has already been undone, or the undo was interrupted (resume it)", undo_path )
+
+  # the last rename has to be undone first
+  undo = Journal( undo_path, overwrite=header['overwrite'], cwd=header['cwd'] )
+  undo.Plan(
+    ( record['to'], record['from'] )
+    for record in ReadRecordsBackwards( path ) if 'plan' in record )
+  undo.Close( complete=False )
+
+  undo_header, planned, done, complete = Status( undo_path )
+  return _Replay( undo_path, undo_header, Done(), verbose=verbose )
@@ -1,80 +1,253 @@
 #!/bin/python3
 
 
-import subprocess
-import unittest
+from collections import namedtuple
 import re
-import os
-from collections import defaultdict
 
+import stats
 
-def VideoResolution( path ):
-  """ Returns the resolution of a file, 'XxY', as detected by ffprobe
+
+# everything the keywords need to know about a file, from one run of ffprobe
+ProbeRecord = namedtuple( 'ProbeRecord', [
+  'width',
+  'height',
+  'video_codec',
+  'audio_codec',
+  'title',
+  'duration',
+  'bit_rate',
+] )
+
+
+def _Number( value, kind ):
+  """ Returns value converted with kind, or None if it isn't a number
+  """
+  try:
+    return kind( value )
+  except ( TypeError, ValueError ):
+    return None
+
+
+def _Tag( tags, name ):
+  """ Returns a tag's value no matter what case the tag name is in
+  """
+  for key, value in tags.items():
+    if key.lower() == name:
+      return value
+
+  return None
+
+
+def ParseProbe( data ):
+  """ Makes a ProbeRecord from the parsed json output of ffprobe
+  """
+  streams = data.get( 'streams', [] )
+  format  = data.get( 'format', {} )
+
+  video = next( ( s for s in streams if s.get( 'codec_type' ) == 'video' ), {} )
+  audio = next( ( s for s in streams if s.get( 'codec_type' ) == 'audio' ), {} )
+
+  # the title is usually on the container, but some files only have it on a stream
+  title = _Tag( format.get( 'tags', {} ), 'title' )
+  for stream in streams:
+    if title is not None:
+      break
+    title = _Tag( stream.get( 'tags', {} ), 'title' )
+
+  return ProbeRecord(
+    width       = video.get( 'width' ),
+    height      = video.get( 'height' ),
+    video_codec = video.get( 'codec_name' ),
+    audio_codec = audio.get( 'codec_name' ),
+    title       = title,
+    duration    = _Number( format.get( 'duration' ), float ),
+    bit_rate    = _Number( format.get( 'bit_rate' ), int ),
+  )
+
+
+def Probe( path ):
+  """ Runs ffprobe on a file once and returns what was found as a ProbeRecord,
+  or None if ffprobe couldn't read it
   """
-  p = subprocess.Popen( ['ffprobe',path], stderr=subprocess.PIPE )
+  # only loaded once a keyword is used
+  import subprocess
+  import json
 
-  output = p.stderr.read().decode()
-  if 'Invalid data found' in output:
+  if stats.current is not None:
+    stats.current.Count( 'ffprobe runs' )
+
+  p = subprocess.run(
+    [ 'ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_streams', '-show_format', path ],
+    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL )
+
+  if p.returncode != 0:
     return None
 
-  # file all the occurances of two 3 digit numbers seperated by an 'x'
-  reses = re.findall( '[0-9]{3,4}x[0-9]{3,4}', output )
+  try:
+    data = json.loads( p.stdout.decode() )
+  except ValueError:
+    return None
 
-  # split the resolution into y,x
-  ret = reses[0].split('x')
+  return ParseProbe( data )
 
-  # make it x,y instead of y,x
-  ret.reverse()
-  ret = 'x'.join(ret)
 
-  return ret
+def VideoResolution( record ):
+  """ Returns the resolution of a video, 'XxY', as detected by ffprobe
+  """
+  if record.width is None or record.height is None:
+    return None
+
+  return '{}x{}'.format( record.width, record.height )
 
 
-def SongTitle( path ):
+def SongTitle( record ):
   """ Returns the title of a music file as detected by ffprobe
   """
-  p = subprocess.Popen( ['ffprobe',path], stderr=subprocess.PIPE )
+  if record.title is None:
+    return ""
+
+  # only the part of the title that is safe in a file name
+  return re.match( r'[a-zA-Z0-9,\(\) ]*', record.title ).group(0)
+
+
+def Codec( record ):
+  """ Returns the codec of the video, or of the audio if there is no video
+  """
+  if record.video_codec is not None:
+    return record.video_codec
+
+  return record.audio_codec
 
-  output = p.communicate()[1].decode()
-  if 'Invalid data found' in output:
+
+def Duration( record ):
+  """ Returns the length of a file, '1h02m03s'
+  """
+  if record.duration is None:
     return None
 
-  # find the first occurance of "title : stuff" with any number of spaces.
-  res = re.search( r'title\s+:\s+([a-zA-Z0-9,\(\) ]+)', output )
+  minutes, seconds = divmod( int( record.duration ), 60 )
+  hours, minutes   = divmod( minutes, 60 )
 
-  if res is None:
-    return ""
+  if hours > 0:
+    return '{}h{:02}m{:02}s'.format( hours, minutes, seconds )
+
+  return '{}m{:02}s'.format( minutes, seconds )
 
-  ret = res.group(1)
 
-  return ret
+def BitRate( record ):
+  """ Returns the overall bit rate of a file, '1500kbps'
+  """
+  if record.bit_rate is None:
+    return None
+
+  return '{}kbps'.format( record.bit_rate // 1000 )
 
 
 KEYWORD_PREFIX = '%'
 KEYWORDS = {
   'res': VideoResolution,
   'title': SongTitle,
+  'codec': Codec,
+  'duration': Duration,
+  'bitrate': BitRate,
 }
 
+# a metadata_cache.MetadataCache to keep probed files in between runs, or None
+cache = None
+
+
+def ProbeFile( file ):
+  """ Returns the ProbeRecord of file, from the cache if it is there
+  """
+  if cache is not None:
+    found, res = cache.Get( file )
+    if found:
+      return ProbeRecord( **res ) if res is not None else None
+
+  with stats.Phase( 'probe' ):
+    res = Probe( file )
+
+  if cache is not None:
+    cache.Put( file, res._asdict() if res is not None else None )
+
+  return res
+
+
+def ProbeFiles( files, jobs=1 ):
+  """ Probes many files, up to jobs of them at the same time. Files in the cache
+  aren't probed again.
+
+  Returns a dict of { file: ProbeRecord or None }
+  """
+  records = {}
+  missing = []
+
+  # the cache is only used from this thread
+  for file in files:
+    found = False
+    if cache is not None:
+      found, res = cache.Get( file )
+
+    if found:
+      records[file] = ProbeRecord( **res ) if res is not None else None
+    else:
+      missing.append( file )
+
+  if len( missing ) == 0:
+    return records
+
+  from concurrent.futures import ThreadPoolExecutor
+
+  # most of the time is spent waiting on ffprobe, so threads are enough
+  with stats.Phase( 'probe' ), ThreadPoolExecutor( max_workers=jobs ) as pool:
+    for file, res in zip( missing, pool.map( stats.Bound( Probe ), missing ) ):
+      records[file] = res
+
+      if cache is not None:
+        cache.Put( file, res._asdict() if res is not None else None )
+
+  return records
+
+
+def HasKeyWords( new_file ):
+  """ Returns True if there are any keywords in new_file
+  """
+  if KEYWORD_PREFIX not in new_file:
+    return False
+
+  for keyword in KEYWORDS:
+    if f'{KEYWORD_PREFIX}{keyword}' in new_file:
+      return True
+
+  return False
+
+
+def ReplaceKeyWords( new_file, file, records=None ):
+  """ Replaces all the keywords in new_file with their values for file.
+  file is only probed if there is a keyword in new_file and it isn't in records.
+
+  records | optional dict of already probed files, see ProbeFiles
+
+  Returns the new name, or None if a keyword has no value for file
+  """
+  record = None
 
-def ReplaceKeyWords( new_file, file ):
   for keyword, func in KEYWORDS.items():
     trigger_word = f'{KEYWORD_PREFIX}{keyword}'
     if trigger_word in new_file:
-      res = func( file )
-      new_file = new_file.replace( trigger_word, res)
-
-  return new_file
+      if record is None:
+        if records is not None and file in records:
+          record = records[file]
+        else:
+          record = ProbeFile( file )
 
+        if record is None:
+          return None
 
-class Test(unittest.TestCase):
-  SONG_TITLE_FILE = "tests/test_song.mp3"
+      res = func( record )
+      if res is None:
+        return None
 
-  @classmethod
-  def setUpClass(cls):
-    if not os.path.exists(cls.SONG_TITLE_FILE):
-      raise Exception(f"Missing test file '{cls.SONG_TITLE_FILE}'")
+      new_file = new_file.replace( trigger_word, res )
 
-  def test_song_title(self):
-    res = SongTitle(self.SONG_TITLE_FILE)
-    self.assertEqual("Example Title", res)
+  return new_file
@@ -0,0 +1,154 @@
+#!/bin/python3
+
+"""
+Messages for people, kept and written to stderr a batch at a time instead of
+a line at a time.
+
+Messages about single files (see File) are only written for the first limit
+files of each kind, the rest are counted and how many there were is written
+at the end (see Close). With json_lines on, every message is a line of json:
+
+  { "level": "warning", "message": "...", "kind": "...", "args": [ ... ] }
+"""
+
+
+import _thread
+import atexit
+import time
+import sys
+
+
+ERROR   = 40
+WARNING = 30
+INFO    = 20
+DEBUG   = 10
+
+NAMES = { ERROR: 'error', WARNING: 'warning', INFO: 'info', DEBUG: 'debug' }
+
+# messages below this level aren't written
+level = INFO
+
+# how many messages of each kind about single files are written, None for all of them
+limit = 100
+
+# if true, messages are written as json lines
+json_lines = False
+
+# the most messages kept before they are written
+BUFFER_LINES = 1000
+
+# the longest a message is kept before it is written, in seconds
+BUFFER_SECONDS = 0.5
+
+_lines   = []
+_written = time.monotonic()
+_counts  = {}
+_lock    = _thread.allocate_lock()
+
+
+def _Format( lvl, message, args ):
+  """
+  Returns the line for a message
+  """
+  text = message.format( *args ) if len( args ) > 0 else message
+
+  if not json_lines:
+    return text
+
+  import json
+  return json.dumps( { 'level': NAMES[lvl], 'message': text, 'kind': message, 'args': args }, default=str )
+
+
+def _Write():
+  """
+  Writes out the kept messages, with _lock held.
+  """
+  global _lines, _written
+
+  if len( _lines ) > 0:
+    sys.stderr.write( '\n'.join( _lines ) + '\n' )
+    sys.stderr.flush()
+    _lines = []
+
+  _written = time.monotonic()
+
+
+def Write( lvl, message, *args ):
+  """
+  Keeps a message to be written with the next batch.
+
+  lvl     | ERROR, WARNING, INFO or DEBUG
+  message | the text, with {} where each of args go (see str.format)
+  args    | only formatted into message if it is going to be written
+  """
+  if lvl < level:
+    return
+
+  line = _Format( lvl, message, args )
+
+  with _lock:
+    _lines.append( line )
+
+    if lvl >= ERROR or len( _lines ) >= BUFFER_LINES or time.monotonic() - _written >= BUFFER_SECONDS:
+      _Write()
+
+
+def Error( message, *args ):
+  Write( ERROR, message, *args )
+
+
+def Warn( message, *args ):
+  Write( WARNING, message, *args )
+
+
+def Info( message, *args ):
+  Write( INFO, message, *args )
+
+
+def Debug( message, *args ):
+  Write( DEBUG, message, *args )
+
+
+def File( lvl, message, *args ):
+  """
+  Keeps a message about one file, see Write. Messages are counted by their
+  message (before args are put in), and only the first limit of each are written.
+  """
+  if lvl < level:
+    return
+
+  with _lock:
+    count = _counts.get( message, ( lvl, 0 ) )[1] + 1
+    _counts[message] = ( lvl, count )
+
+  if limit is None or count <= limit:
+    Write( lvl, message, *args )
+
+
+def Flush():
+  """
+  Writes out the kept messages.
+  """
+  with _lock:
+    _Write()
+
+
+def Close():
+  """
+  Writes how many messages about files were left out of each kind, then
+  everything that is kept. Counting starts again after.
+  """
+  global _counts
+
+  with _lock:
+    counts  = _counts
+    _counts = {}
+
+  for message, ( lvl, count ) in counts.items():
+    if limit is not None and count > limit:
+      Write( lvl, "and {} more like \"{}\"", count - limit, message )
+
+  Flush()
+
+
+atexit.register( Close )
@@ -6,9 +6,8 @@ Written by Terrence, eightys3v3n@gmail.com
 
 
 from getopt import getopt
-import unittest
-import textwrap
-import shutil
+import itertools
+import time
 import sys
 import os
 import re
@@ -17,8 +16,17 @@ import re
 # this allows the script to be run from working directories other than where it is
 sys.path.append( os.path.dirname( os.path.abspath( __file__ ) ) )
 
-import help_text
+# the modules only some options need (help_text, journal, external_sort,
+# scan_state, watch) or only big runs need (batch, memo) are imported where
+# they are used, so every run doesn't pay for loading them
 import keyword_replacer
+from actions import Remove, Replace, Insert, Append
+import metadata_cache
+import executor
+import planner
+import filters
+import stats
+import log
 import fs
 
 
@@ -27,6 +35,24 @@ true  = True
 false = False
 verbose = false
 
+# if true, a dry run prints the renames as json lines, see PrintRenames
+json_lines = false
+
+# how many files per job are probed for keywords before their renames are passed on
+PROBE_BATCH = 64
+
+# how many files are given actions at a time, joined together (see batch.ApplyBatch)
+BATCH_SIZE = 16384
+
+# the fewest files worth joining together
+BATCH_MIN = 256
+
+# the ends of a path without a file name, see BadName
+BAD_ENDINGS = tuple( sep + end for sep in [ os.sep, os.altsep ] if sep is not None for end in [ '', '.', '..' ] )
+
+# how many directory listings are kept to check for existing files with, when streaming
+STREAM_DIRS = 4096
+
 
 def ParseAction( raw ):
   """
@@ -34,25 +60,17 @@ def ParseAction( raw ):
 
   raw | a string that represents the action that should be taken
 
-  Returns a tuple
+  Returns an actions.Action, ready to be applied to file names
   """
-  # action[0] is always the type of action (remove, replace, ...)
-  # action's length depends on what type of action is being performed.
-  action = [ '' ]
-
   # remove action
   if raw[0:2] == 'd:':
-    # set the type of action
-    action[0] = 'remove'
     raw = raw[2:]
 
     # the rest of the string is the regex that should be removed
-    action.append( raw )
+    return Remove( raw )
 
   # replace action
   elif raw[0:2] == 'r:':
-    # set the type of action
-    action[0] = 'replace'
     raw = raw[2:]
 
     # split the string with ':'
@@ -67,11 +85,10 @@ def ParseAction( raw ):
     res[0] = res[0].replace( '\\:', ':' )   # replace this
     res[1] = res[1].replace( '\\:', ':' )   # with this
 
-    action.extend( res )
+    return Replace( res[0], res[1] )
 
   # insert action
   elif raw[0:2] == 'i:':
-    action[0] = 'insert'
     raw = raw[2:]
 
     # split string with ':'
@@ -80,7 +97,7 @@ def ParseAction( raw ):
 
     # no position to insert at was specified
     if len(res) == 1:
-      action.extend( [ 0, res[0] ] )
+      return Insert( 0, res[0] )
 
     # a position to insert at was specified
     elif len(res) == 2:
@@ -90,149 +107,386 @@ def ParseAction( raw ):
       except ValueError:
         raise Exception( "in 'i:int:abc' int must be a signed integer", res[0] )
 
-      action.extend( [ i, res[1] ] )
+      return Insert( i, res[1] )
 
     else:
       raise Exception( "too many seperators ':'", raw )
 
   elif raw[0:2] == 'a:':
-    action[0] = 'append'
     raw = raw[2:]
 
-    action.append( raw )
+    return Append( raw )
 
   else:
     raise Exception( "invalid action", raw[0:2] )
 
-  return tuple( action )
-
 
 def DoAction( action, file, partial=False ):
   """
   Does the specified action to the file name.
 
-  action | a tuple ( action_to_be_done, arguments_for_that_action )
+  action | an actions.Action, see ParseAction
   file   | the file path or name to change
 
   Returns the changed file name.
   """
-  new_file = None
+  return action.apply( file, partial=partial )
 
-  # remove some stuff
-  if action[0] == 'remove':
-    # didn't see a remove function so actually just replacing with nothing
-    new_file = re.sub( action[1], '', file )
 
-    if not partial and new_file == file:
-      return None
+def ApplyActions( actions, file, partial=False ):
+  """
+  Performs a list of actions on a file name, without replacing keywords.
 
-  # same as above but replace some stuff
-  elif action[0] == 'replace':
-    new_file = re.sub( action[1], action[2], file )
+  actions | a list of actions.Action
+  file    | file name or path to change
 
-    if not partial and new_file == file:
-      return None
+  Returns the new file name, or None if an action couldn't be done.
+  """
+  if stats.current is not None:
+    return _TimedApplyActions( actions, file, partial, stats.current )
 
-  # inserts new stuff at position action[1]
-  elif action[0] == 'insert':
-    # if the insert position is outside of the file name
-    if action[1] > 0:
-      if action[1] >= len( file ):
-        new_file = file
-    else:
-      if action[1]*-1 >= len( file ):
-        new_file = file
+  new_file = file
 
-    # if the insert position is a real position in the file name, insert the stuff there
-    if new_file is None:
-      prefix = file[ 0:action[1] ]
-      suffix = file[ action[1]: ]
-      new_file = prefix + action[2] + suffix
+  for action in actions:
+    new_file = action.apply( new_file, partial )
 
-    if not partial and new_file == file:
+    # if the action didn't change the file name let the calling function deal with it.
+    # stops on first failed action to prevent renaming things you didn't intend to in a wierd way.
+    if new_file is None:
       return None
 
-  # append new stuff at the end of the name, before the extension (if any)
-  elif action[0] == 'append':
-    ext_i = file.rfind( os.path.extsep )
-    extension = ''
+  return new_file
 
-    if ext_i < 0:
-      new_file = file
-    else:
-      extension = file[ ext_i: ]
-      new_file  = file[ 0 : ext_i ]
 
-    new_file += action[1] + extension
+def _TimedApplyActions( actions, file, partial, collected ):
+  """
+  ApplyActions, recording how long each action took in a stats.Stats
+  """
+  new_file = file
+  clock    = time.perf_counter
+
+  for action in actions:
+    start    = clock()
+    new_file = action.apply( new_file, partial )
+    collected.Sample( action, clock() - start )
+
+    if new_file is None:
+      return None
 
   return new_file
 
 
-def GenerateRename( actions, file, partial=False ):
+def GenerateRename( actions, file, partial=False, records=None, full_path=False ):
   """
   Performs a list of actions on a file name.
 
-  actions | a list of ( action_to_be_done, arguments_for_that_action )
-  file    | file name or path to change
+  actions   | a list of actions.Action
+  file      | file name or path to change
+  records   | optional dict of already probed files, see keyword_replacer.ProbeFiles
+  full_path | if true, the actions are done to the whole path instead of only
+              the file's name
 
   Returns the new file name.
   """
-  new_file = file
+  directory, name = ( '', file ) if full_path else fs.SplitName( file )
 
-  for action in actions:
-    new_file = DoAction( action, new_file, partial=partial )
+  new_file = ApplyActions( actions, name, partial=partial )
+  if new_file is None:
+    return None
 
-    # if the action didn't change the file name let the calling function deal with it.
-    # stops on first failed action to prevent renaming things you didn't intend to in a wierd way.
-    if new_file is None:
-      return None
+  # only keywords in what the actions were done to are replaced
+  new_file = keyword_replacer.ReplaceKeyWords( new_file, file, records=records )
+
+  # a keyword couldn't be found for this file
+  if new_file is None:
+    return None
+
+  return ( file, directory + new_file )
+
+
+def _SplitNames( files, table ):
+  """
+  Splits files into what the actions are done to and the directory it goes back in.
+
+  table | an fs.DirectoryTable, or None if the actions are done to the whole paths.
+          it only keeps the directories of these files, the numbers from
+          before can't be joined any more
+
+  Returns ( a list of directory numbers, a list of names ), the numbers are None without a table
+  """
+  if table is None:
+    return ( [ None ] * len( files ), files )
 
-  new_file = keyword_replacer.ReplaceKeyWords( new_file, file )
+  table.Clear()
 
-  return ( file, new_file )
+  split = [ table.Split( file ) for file in files ]
+  return ( [ number for number, name in split ], [ name for number, name in split ] )
 
 
-def GenerateRenames( actions, files, partial=False, overwrite=False ):
+def _JoinName( table, number, new_name ):
+  """
+  Returns the new path of a file from _SplitNames once its new name is done, or None
+  """
+  if new_name is None or table is None:
+    return new_name
+
+  return table.Join( number, new_name )
+
+
+def _ApplyMany( actions, files, partial=False, remembered=None ):
+  """
+  Performs a list of actions on many file names, joined together when there
+  are enough of them (see batch.ApplyBatch). Keywords aren't replaced.
+
+  remembered | an optional memo.Memo of the actions, used instead
+
+  Returns a list of the new names, None where an action couldn't be done
+  """
+  if remembered is not None:
+    return remembered.ApplyMany( files )
+
+  # each action is only timed on its own name
+  if len( files ) < BATCH_MIN or stats.current is not None:
+    return [ ApplyActions( actions, file, partial=partial ) for file in files ]
+
+  import batch
+  return batch.ApplyBatch( actions, files, partial=partial )
+
+
+def _BatchedRenames( actions, files, partial=False, remembered=None, table=None ):
+  """
+  Generates renames BATCH_SIZE files at a time, see _ApplyMany.
+
+  table | an optional fs.DirectoryTable, if given the actions (and keywords)
+          are only done to the names of the files and not their directories
+
+  Yields ( file, rename ) in the same order as files, rename being None if
+  there isn't one
+  """
+  files = iter( files )
+
+  while True:
+    chunk = list( itertools.islice( files, BATCH_SIZE ) )
+    if len( chunk ) == 0:
+      return
+
+    numbers, names = _SplitNames( chunk, table )
+    new_names      = _ApplyMany( actions, names, partial=partial, remembered=remembered )
+
+    for file, number, new_name in zip( chunk, numbers, new_names ):
+      if new_name is not None:
+        new_name = keyword_replacer.ReplaceKeyWords( new_name, file )
+
+      new_file = _JoinName( table, number, new_name )
+      yield ( file, ( file, new_file ) if new_file is not None else None )
+
+
+def _ProbedRenames( actions, files, partial=False, jobs=1, remembered=None, table=None ):
+  """
+  Generates renames BATCH_SIZE files at a time like _BatchedRenames, probing
+  the files that need it for keywords on jobs threads, jobs * PROBE_BATCH
+  files at a time.
+
+  actions    | a list of actions.Action
+  files      | an iterable of file names or paths
+  remembered | an optional memo.Memo of the actions, see _ApplyMany
+  table      | an optional fs.DirectoryTable, see _BatchedRenames
+
+  Yields ( file, rename ) in the same order as files, rename being None if
+  there isn't one
+  """
+  files = iter( files )
+
+  while True:
+    chunk = list( itertools.islice( files, BATCH_SIZE ) )
+    if len( chunk ) == 0:
+      return
+
+    numbers, names = _SplitNames( chunk, table )
+    new_names      = _ApplyMany( actions, names, partial=partial, remembered=remembered )
+    probe          = jobs * PROBE_BATCH
+
+    for start in range( 0, len( chunk ), probe ):
+      end  = start + probe
+      part = list( zip( chunk[ start : end ], numbers[ start : end ], new_names[ start : end ] ) )
+
+      # only the files whose new name has a keyword need to be probed
+      need = [
+        file for file, number, new_name in part
+        if new_name is not None and keyword_replacer.HasKeyWords( new_name )
+      ]
+      records = keyword_replacer.ProbeFiles( need, jobs=jobs )
+
+      for file, number, new_name in part:
+        if new_name is not None:
+          new_name = keyword_replacer.ReplaceKeyWords( new_name, file, records=records )
+
+        new_file = _JoinName( table, number, new_name )
+        yield ( file, ( file, new_file ) if new_file is not None else None )
+
+
+def GenerateRenames( actions, files, partial=False, jobs=1, index=None, recursive=False, full_path=False ):
   """
   Performs a list of actions on a list of file names.
 
-  actions | a list of ( action_to_be_done, arguments_for_that_action )
-  files   | a list of file names or paths
+  actions   | a list of actions.Action
+  files     | an iterable of file names or paths
+  jobs      | how many files can be probed for keywords at the same time
+  index     | an fs.DirectoryIndex the new names are added to, made if not given
+  recursive | if true, the same names are expected in many directories, and
+              what the actions make of each is remembered when they can be (see memo.Memo)
+  full_path | if true, the actions are done to the whole path of each file
+              instead of only its name
+
+  Whether the new names are already taken by existing files is left to
+  planner.ResolveRenames, since those files could be renamed too.
 
   Returns a list of ( original_file_name, new_file_name )
   """
-  global verbose
-  renames = []
+  return list( IterRenames( actions, files, partial=partial, jobs=jobs, index=index, recursive=recursive,
+                            full_path=full_path ) )
 
-  for file in files:
-    # generate ( original_file_name, new_file_name )
-    rename = GenerateRename( actions, file, partial=partial )
 
+def IterRenames( actions, files, partial=False, jobs=1, index=None, recursive=False, full_path=False ):
+  """
+  Performs a list of actions on file names as they come in, see GenerateRenames.
+
+  Yields ( original_file_name, new_file_name )
+  """
+  if index is None:
+    index = fs.DirectoryIndex()
+
+  # the files are split into their directory and name once, each directory kept once
+  table = None if full_path else fs.DirectoryTable()
+
+  # whole paths can only be remembered in pieces, for some actions
+  remembered = None
+  if recursive:
+    import memo
+
+  if recursive and not full_path:
+    remembered = memo.Memo( actions, partial=partial, split=False )
+  elif recursive and memo.Usable( actions ):
+    remembered = memo.Memo( actions, partial=partial )
+
+  if jobs > 1:
+    generated = _ProbedRenames( actions, files, partial=partial, jobs=jobs, remembered=remembered, table=table )
+  else:
+    generated = _BatchedRenames( actions, files, partial=partial, remembered=remembered, table=table )
+
+  yield from _PlanGenerated( generated, index )
+
+
+def IterRuleRenames( rule_sets, files, index=None, full_path=False ):
+  """
+  Renames each file with the rule set its path matches, see rules.Dispatcher.
+  A file that no rule set's filter matches isn't renamed.
+
+  rule_sets | a list of rules.RuleSet
+  files     | an iterable of file names or paths
+  index     | an fs.DirectoryIndex the new names are added to, made if not given
+  full_path | see GenerateRenames
+
+  Yields ( original_file_name, new_file_name )
+  """
+  import rules
+
+  if index is None:
+    index = fs.DirectoryIndex()
+
+  dispatch = rules.Dispatcher( rule_sets )
+
+  def Generated():
+    for file in files:
+      i = dispatch.match( file )
+
+      if i is None:
+        log.File( log.DEBUG, "no rule set for '{}'", file )
+        continue
+
+      rule   = rule_sets[i]
+      rename = GenerateRename( rule.actions, file, partial=rule.partial, full_path=full_path )
+
+      if rename is not None and rule.result is not None and not rule.result.match( rename[1] ):
+        log.File( log.INFO, "rename doesn't match result '{}', dropping", rename[1] )
+        continue
+
+      yield ( file, rename )
+
+  yield from _PlanGenerated( Generated(), index )
+
+
+def _PlanGenerated( generated, index ):
+  """
+  Drops renames to bad names or to names another file is being renamed to.
+
+  generated | an iterable of ( file, rename ), rename being None if there isn't one
+  index     | an fs.DirectoryIndex the new names are planned in
+
+  Yields the renames that are kept
+  """
+  for file, rename in generated:
     # if the new file name is the same as the old,
     # don't touch that file.
     if rename is not None:
 
       # just an extra meassure. Don't rename something to some common mistake file names
-      if rename[1] not in [ '', '.', '..', '/' ]:
-
-        # if a file with the new name already exists, warn and skip this file
-        if not os.path.exists( rename[1] ):
-          renames.append( rename )
+      if not BadName( rename[1] ):
 
-        elif overwrite:
-          renames.append( rename )
-          print( "file being overwritten '{}'".format( rename[1] ) )
+        # never rename two files to the same name, even when overwriting
+        if index.Planned( rename[1] ):
+          log.File( log.INFO, "another file is being renamed to '{}', dropping", rename[1] )
 
-        elif verbose:
-          print( "file already exists '{}', dropping".format( rename[1] ) )
+        else:
+          index.Plan( rename[1] )
+          yield rename
 
       else:
-        print( "file's new name is '', dropping" )
+        log.File( log.INFO, "file's new name is '', dropping" )
+
+    else:
+      log.File( log.DEBUG, "skipping incomplete rename '{}'", file )
+
+
+def BadName( file ):
+  """
+  Returns True if a new file name is a common mistake: '', '.', '..' or a
+  path ending in one of them, like '/'
+  """
+  return file in [ '', '.', '..' ] or file.endswith( BAD_ENDINGS )
+
+
+def _PlanLine( rename ):
+  """
+  Returns the line a dry run prints for a rename
+  """
+  if json_lines:
+    import json
+    return json.dumps( { 'from': rename[0], 'to': rename[1] } )
+
+  return "{} -> {}".format( rename[0], rename[1] )
 
-    elif verbose:
-      print( "skipping incomplete rename '{}'".format( file ) )
 
-  return renames
+def PrintRenames( renames ):
+  """
+  Prints the renames a dry run would do, a batch of lines at a time.
+  With json_lines, each is printed as { "from": ..., "to": ... }.
+
+  renames | an iterable of ( current_name, desired_name )
+  """
+  lines = []
+
+  for rename in renames:
+    lines.append( _PlanLine( rename ) )
+
+    if len( lines ) >= log.BUFFER_LINES:
+      sys.stdout.write( '\n'.join( lines ) + '\n' )
+      lines = []
+
+  if len( lines ) > 0:
+    sys.stdout.write( '\n'.join( lines ) + '\n' )
+
+  sys.stdout.flush()
 
 
 def FilterRenames( renames, result_re ):
@@ -240,95 +494,404 @@ def FilterRenames( renames, result_re ):
   Remove any rename attempts that don't match the result expression
 
   renames   | an array of ( original_name, new_name )
-  result_re | a regular expression
+  result_re | a regular expression, or a list of them (any can match)
 
   Returns a list of renames that match the result expression
   """
-  global verbose
-  result = []
+  return list( IterFilterRenames( renames, result_re ) )
+
+
+def IterFilterRenames( renames, result_re ):
+  """
+  Remove any rename attempts that don't match the result expression, as they come in.
+
+  Yields the renames that match the result expression
+  """
+  match = filters.Filter( result_re ).match
 
   for rename in renames:
     # if the destination name matches the result expression
-    if re.match( result_re, rename[1] ):
-      result.append( rename )
+    if match( rename[1] ):
+      yield rename
 
     else:
-      print( "rename doesn't match result '{}', dropping".format( rename[1] ) )
+      log.File( log.INFO, "rename doesn't match result '{}', dropping", rename[1] )
 
-  return result
 
-
-def DoRenames( renames ):
+def DoRenames( renames, journal=None, state=None, overwrite=False, jobs=1 ):
   """
   Rename all the given files
 
-  renames | an array of ( current_name, desired_name )
+  renames   | an array of ( current_name, desired_name ), in the order to do them
+  journal   | an optional journal.Journal the renames have been planned in,
+              each rename is recorded in it once it is done
+  state     | an optional scan_state.ScanState to record the new names in, on
+              this thread once the renames are finished (its sqlite connection
+              can't be used from the others)
+  overwrite | if false, a file that has appeared at a new name since the
+              renames were planned is left alone and that rename is skipped
+  jobs      | how many directories can be renamed in at the same time, the
+              renames in each directory are still done in order
+
+  Returns the number of renames done
+  """
+  import threading
+
+  shards = executor.Shards( renames )
+  lock   = threading.Lock()
+  done   = [ 0 ]
+  moved  = []
+  start  = time.perf_counter()
+
+  def DoShard( shard ):
+    renamer = executor.Executor( overwrite=overwrite )
+
+    try:
+      for n, rename in shard:
+        log.File( log.DEBUG, "renaming '{}' -> '{}'", rename[0], rename[1] )
+
+        if not _Rename( renamer, rename ):
+          continue
+
+        with lock:
+          done[0] += 1
+
+          if journal is not None:
+            journal.Done( n )
+
+          if state is not None:
+            moved.append( ( n, rename ) )
+
+    finally:
+      renamer.Close()
+
+  try:
+    if jobs > 1 and len( shards ) > 1:
+      from concurrent.futures import ThreadPoolExecutor
+
+      with ThreadPoolExecutor( max_workers=jobs ) as pool:
+        futures = [ pool.submit( stats.Bound( DoShard ), shard ) for shard in shards ]
+
+      # the other directories are finished before the first error is raised
+      for future in futures:
+        future.result()
+
+    else:
+      for shard in shards:
+        DoShard( shard )
+
+  finally:
+    # in the order they were planned, so a file renamed twice ends up at its last name
+    for n, rename in sorted( moved, key=lambda done: done[0] ):
+      state.Moved( rename[0], rename[1] )
+
+    if len( renames ) > 0:
+      seconds = time.perf_counter() - start
+      log.Info( "renamed {} files in {:.2f}s ({:.0f} renames/s)",
+        done[0], seconds, done[0] / seconds if seconds > 0 else 0 )
+
+  return done[0]
+
+
+def _Rename( renamer, rename ):
+  """
+  Does a rename with an executor.Executor.
+
+  Returns False if it wasn't done because the new name was taken
+  """
+  try:
+    renamer.Rename( rename[0], rename[1] )
+
+  except FileExistsError:
+    # a file showed up there after the renames were planned. the renames
+    # after it that need this one out of the way will find it still there too
+    log.File( log.WARNING, "file already exists '{}', not renaming '{}'", rename[1], rename[0] )
+    return False
+
+  return True
+
+
+def StreamRenames( actions, files, index, result_re=None, partial=False, overwrite=False, jobs=1,
+                   dryrun=True, sort=False, state=None, recursive=False, full_path=False ):
+  """
+  Renames files as they are found, without keeping them all in memory.
+  Each rename is checked against the files there at the time, so a rename to
+  the name of a file that is renamed later is dropped (see planner.CheckRenames).
+
+  A dry run or one that overwrites keeps the new name of every rename, see
+  DoCheckedRenames.
+
+  actions   | a list of actions.Action
+  files     | an iterable of file names or paths
+  index     | an fs.DirectoryIndex of the files that exist now
+  dryrun    | if true, prints the renames instead of doing them
+  sort      | if true, the renames are done in order, sorted in temporary files if
+              there are too many. nothing is done until all the files are found.
+  state     | an optional scan_state.ScanState to record the new names in
+  recursive | see GenerateRenames
+  full_path | see GenerateRenames
 
   Returns None
   """
-  global verbose
+  if dryrun or overwrite:
+    log.Info( "every new name is kept in memory with --stream {}, to check the renames after it",
+              'on a dry run' if dryrun else 'and --overwrite' )
 
-  for rename in renames:
-    if verbose:
-      print( "renaming '{}' -> '{}'".format( rename[0], rename[1] ) )
+  renames = IterRenames( actions, files, partial=partial, jobs=jobs, index=index, recursive=recursive,
+                         full_path=full_path )
+
+  if result_re is not None:
+    renames = IterFilterRenames( renames, result_re )
+
+  if sort:
+    import external_sort
+    renames = external_sort.Sorted( renames )
+
+  for rename in DoCheckedRenames( renames, index, overwrite=overwrite, dryrun=dryrun, state=state ):
+    pass
+
+
+def DoCheckedRenames( renames, index, overwrite=False, dryrun=True, state=None ):
+  """
+  Checks each rename against the files there at the time and does it straight
+  away (see planner.CheckRenames).
+
+  Once a rename is done its new name is on disk, and is no longer kept as
+  planned in the index. A dry run, or one that overwrites, can't tell the
+  renames it made from the files that were there, so it keeps every new name.
+
+  renames | an iterable of ( current_name, desired_name )
+  index   | an fs.DirectoryIndex of the files that exist now
+  dryrun  | if true, prints the renames instead of doing them
+  state   | an optional scan_state.ScanState to record the new names in
+
+  Yields each rename once it is done (or printed)
+  """
+  renamer = executor.Executor( overwrite=overwrite )
+
+  try:
+    for rename in planner.CheckRenames( renames, index, overwrite=overwrite ):
+      if dryrun:
+        sys.stdout.write( _PlanLine( rename ) + '\n' )
+        yield rename
+        continue
+
+      log.File( log.DEBUG, "renaming '{}' -> '{}'", rename[0], rename[1] )
+
+      if not _Rename( renamer, rename ):
+        continue
 
-    os.rename( rename[0], rename[1] )
+      if state is not None:
+        state.Moved( rename[0], rename[1] )
+
+      if not overwrite:
+        index.Unplan( rename[1] )
+
+      yield rename
+
+  finally:
+    renamer.Close()
+
+
+def WatchRenames( actions, paths, filter_re=None, result_re=None, partial=False, overwrite=False,
+                  recursive=False, dryrun=True, full_path=False ):
+  """
+  Renames files as they arrive in directories, until interrupted (see watch.Watch).
+  The actions and filters are only prepared once.
+
+  actions   | a list of actions.Action
+  paths     | a list of directories to watch
+  full_path | see GenerateRenames
+
+  Returns None
+  """
+  import watch
+
+  file_filter = filters.Filter( filter_re ) if filter_re is not None else None
+
+  def Arrived( files ):
+    if file_filter is not None:
+      files = [ file for file in files if file_filter.match( file ) ]
+
+    # the directories are listed again for each batch, other things could
+    # have changed them in between
+    index   = fs.DirectoryIndex()
+    renames = IterRenames( actions, files, partial=partial, index=index, full_path=full_path )
+
+    if result_re is not None:
+      renames = IterFilterRenames( renames, result_re )
+
+    done = [ rename[1] for rename in DoCheckedRenames( renames, index, overwrite=overwrite, dryrun=dryrun ) ]
+    sys.stdout.flush()
+    log.Flush()
+
+    # a watch runs until it is stopped, the files probed so far are kept now
+    if keyword_replacer.cache is not None:
+      keyword_replacer.cache.Commit()
+
+    # nothing was moved on a dry run
+    return [] if dryrun else done
+
+  watch.Watch( paths, Arrived, recursive=recursive )
+
+
+# the command line options, for getopt and the help text
+OPTIONS = {
+  'short':'hvqdf:R:a:proj:',
+  'long' :[
+    'help',
+    'verbose',
+    'quiet',
+    'json',
+    'log-limit=',
+    'do',
+    'filter=',
+    'result=',
+    'action=',
+    'partial',
+    'recursive',
+    'full-path',
+    'overwrite',
+    'jobs=',
+    'no-cache',
+    'refresh-cache',
+    'journal=',
+    'resume=',
+    'undo=',
+    'stream',
+    'sort',
+    'prune=',
+    'state=',
+    'watch',
+    'rules=',
+    'stats=',
+    'profile=',
+  ],
+}
 
 
 def Main():
-  global verbose
-
-  # parse the command line options and arguments
-  options = {
-    'short':'hvdf:R:a:pro',
-    'long' :[
-      'help',
-      'verbose',
-      'do',
-      'filter=',
-      'result=',
-      'action=',
-      'partial',
-      'recursive',
-      'overwrite',
-    ],
-  }
-  opts, args = getopt( sys.argv[1:], options['short'], options['long'] )
+  """
+  Runs the command line, measuring the run with --stats and --profile.
+  """
+  opts, args = getopt( sys.argv[1:], OPTIONS['short'], OPTIONS['long'] )
+  stats_format = None
+  profile_path = None
+
+  for opt, arg in opts:
+    if opt == '--stats':
+      if arg not in [ 'table', 'json' ]:
+        raise Exception( "stats format must be 'table' or 'json'", arg )
+      stats_format = arg
+
+    elif opt == '--profile':
+      profile_path = arg
+
+  if stats_format is None and profile_path is None:
+    return _Main( opts, args )
+
+  collected = stats.Stats() if stats_format is not None else None
+  profiler  = None
+  if profile_path is not None:
+    import cProfile
+    profiler = cProfile.Profile()
+
+  try:
+    if collected is not None:
+      collected.Start()
+    if profiler is not None:
+      profiler.enable()
+
+    _Main( opts, args )
+
+  finally:
+    if profiler is not None:
+      profiler.disable()
+      profiler.dump_stats( profile_path )
+      log.Info( "profile written to '{}', see python -m pstats", profile_path )
+
+    if collected is not None:
+      collected.Stop()
+      log.Close()
+
+      if stats_format == 'json':
+        import json
+        print( json.dumps( collected.Report(), indent=2 ), file=sys.stderr )
+      else:
+        print( collected.Table(), file=sys.stderr )
+
+
+def _Main( opts, args ):
+  """
+  Runs the command line with the options getopt found, see OPTIONS.
+  """
+  global verbose, json_lines
+
   actions    = []
-  filter_re  = None
-  result_re  = None
+  filter_re  = []
+  prune_re   = []
+  state_path = None
+  watching   = False
+  rule_sets  = None
+  result_re  = []
   command    = None
   specific_files = False
   recursive      = False
+  full_path      = False
   partial        = False
   overwrite      = False
   dryrun         = True
+  jobs           = 1
+  cache          = True
+  refresh_cache  = False
+  journal_path   = None
+  stream         = False
+  sort           = False
 
   # parse command line arguments
   for opt, arg in opts:
     if opt in [ '-h', '--help' ]:
-      help_text.PrintHelp(options)
+      import help_text
+      help_text.PrintHelp( OPTIONS )
       exit(0)
 
     elif opt in [ '-v', '--verbose' ]:
       verbose = true
-      print( "verbose mode" )
+      planner.verbose = true
+      fs.verbose = true
+      log.level = log.DEBUG
+      log.Debug( "verbose mode" )
+
+    elif opt in [ '-q', '--quiet' ]:
+      log.level = log.WARNING
+
+    elif opt == '--json':
+      json_lines = True
+      log.json_lines = True
+
+    elif opt == '--log-limit':
+      try:
+        log.limit = int( arg )
+      except ValueError:
+        raise Exception( "log limit must be an integer", arg )
+
+      # no limit
+      if log.limit <= 0:
+        log.limit = None
 
     elif opt in [ '-d', '--do' ]:
       dryrun = False
 
     elif opt in [ '-f', '--filter' ]:
-      filter_re = arg
-      if verbose:
-        print( "file filter '{}'".format( filter_re ) )
+      filter_re.append( arg )
+      log.Debug( "file filter '{}'", arg )
 
     elif opt in [ '-R', '--result' ]:
-      result_re = arg
-      if verbose:
-        print( "resulting names must match '{}'".format( result_re ) )
+      result_re.append( arg )
+      log.Debug( "resulting names must match '{}'", arg )
 
     elif opt in [ '-a', '--action' ]:
-      # add ( action_type, action_arguments... ) to actions
+      # add the parsed action to actions
       actions.append( ParseAction( arg ) )
 
     elif opt in [ '-p', '--partial' ]:
@@ -337,57 +900,235 @@ def Main():
     elif opt in [ '-r', '--recursive' ]:
       recursive = True
 
+    elif opt == '--full-path':
+      full_path = True
+
     elif opt in [ '-o', '--overwrite' ]:
       overwrite = True
 
+    elif opt in [ '-j', '--jobs' ]:
+      try:
+        jobs = int( arg )
+      except ValueError:
+        raise Exception( "jobs must be a positive integer", arg )
+
+      if jobs < 1:
+        raise Exception( "jobs must be a positive integer", arg )
 
-  if verbose:
-    print( "getting files" )
+    elif opt == '--no-cache':
+      cache = False
+
+    elif opt == '--refresh-cache':
+      refresh_cache = True
+
+    elif opt == '--journal':
+      journal_path = arg
+
+    elif opt == '--resume':
+      import journal
+      journal.Resume( arg, verbose=verbose )
+      return
+
+    elif opt == '--undo':
+      import journal
+      journal.Undo( arg, verbose=verbose )
+      return
+
+    elif opt == '--stream':
+      stream = True
+
+    elif opt == '--sort':
+      sort = True
+
+    elif opt == '--watch':
+      watching = True
+
+    elif opt == '--rules':
+      import rules
+      rule_sets = rules.LoadRules( arg, ParseAction )
+      log.Debug( "rule sets {}", ', '.join( rule.name for rule in rule_sets ) )
+
+    elif opt == '--state':
+      state_path = arg
+
+    elif opt == '--prune':
+      prune_re.append( arg )
+      log.Debug( "not walking into directories that match '{}'", arg )
+
+    elif opt in [ '--stats', '--profile' ]:
+      # see Main
+      pass
+
+
+  log.Debug( "getting files" )
   # get the files that will be worked with
   if args == []:
     args = ['.']
-  files = fs.GetFiles( args, filter_re=filter_re, recursive=recursive )
-  if len( files ) == 0:
+  # several filters are combined, a file only has to match one of them
+  if filter_re == []:
+    filter_re = None
+  if prune_re == []:
+    prune_re = None
+  if result_re == []:
+    result_re = None
+  if stream and journal_path is not None:
+    raise Exception( "--journal needs the whole plan before renaming, it can't be used with --stream" )
+
+  if rule_sets is not None:
+    if len( actions ) > 0 or filter_re is not None or result_re is not None:
+      raise Exception( "actions, filters and results go in the rules file with --rules" )
+    if stream or watching:
+      raise Exception( "--rules can't be used with --stream or --watch" )
+
+    # only walk where some rule set's filter could match
+    import rules
+    filter_re = rules.Dispatcher( rule_sets ).patterns
+
+  if watching:
+    if len( actions ) == 0:
+      raise Exception( "no actions to do" )
+
+    if cache:
+      keyword_replacer.cache = metadata_cache.MetadataCache( refresh=refresh_cache )
+
+    try:
+      WatchRenames( actions, args, filter_re=filter_re, result_re=result_re, partial=partial,
+                    overwrite=overwrite, recursive=recursive, dryrun=dryrun, full_path=full_path )
+    finally:
+      if keyword_replacer.cache is not None:
+        keyword_replacer.cache.Close()
+        keyword_replacer.cache = None
+
+    return
+
+  # the directory listings are kept to check for existing files with.
+  # when streaming only the most recent ones are kept
+  index = fs.DirectoryIndex( max_dirs=STREAM_DIRS if stream else None )
+
+  # only files that are new since the last run with the state are used
+  state = None
+  if state_path is not None:
+    import scan_state
+    state = scan_state.ScanState( state_path )
+
+  files = fs.GetFiles( args, filter_re=filter_re, recursive=recursive, jobs=jobs, index=index,
+                       prune_re=prune_re, state=state )
+  files = stats.Timed( 'walk', files )
+
+  # the files are found as they are used, look at the first one to make sure there are any
+  first = next( files, None )
+  if first is None and state is not None:
+    log.Info( "no new files" )
+    state.Close( save=not dryrun )
+    return
+  if first is None:
     raise Exception( "no files found" )
+  files = itertools.chain( [ first ], files )
 
 
   # print errors if required arguments are missing
-  if len(actions) == 0:
+  if len(actions) == 0 and rule_sets is None:
     raise Exception( "no actions to do" )
 
 
   # print the files we will work with, if verbose is on
-  if verbose:
-    print( "files:" )
+  if verbose and not stream:
+    files = list( files )
+    log.Debug( "files:" )
     for file in files:
-      print( "  "+file )
+      log.File( log.DEBUG, "  {}", file )
+
+
+  log.Debug( "generating renames" )
+  # keyword values are kept between runs unless asked not to.
+  # the cache file is only opened if a keyword is used.
+  if cache:
+    keyword_replacer.cache = metadata_cache.MetadataCache( refresh=refresh_cache )
 
+  if stream:
+    with stats.Phase( 'stream' ):
+      StreamRenames( actions, files, index, result_re=result_re, partial=partial, overwrite=overwrite,
+                     jobs=jobs, dryrun=dryrun, sort=sort, state=state, recursive=recursive,
+                     full_path=full_path )
+
+    if keyword_replacer.cache is not None:
+      keyword_replacer.cache.Close()
+      keyword_replacer.cache = None
+
+    # the new files are only remembered once they have been renamed, so a dry
+    # run doesn't hide them from the real one
+    if state is not None:
+      state.Close( save=not dryrun )
+
+    return
 
-  if verbose:
-    print( "generating renames" )
   # generate a list of ( original_file_name, new_file_name )
-  renames = GenerateRenames( actions, files, partial=partial, overwrite=overwrite )
+  with stats.Phase( 'generate' ):
+    if rule_sets is not None:
+      renames = list( IterRuleRenames( rule_sets, files, index=index, full_path=full_path ) )
+    else:
+      renames = GenerateRenames( actions, files, partial=partial, jobs=jobs, index=index,
+                                 recursive=recursive, full_path=full_path )
 
-  if verbose:
-    print( "sorting renames" )
-  renames.sort()
+  if keyword_replacer.cache is not None:
+    keyword_replacer.cache.Close()
+    keyword_replacer.cache = None
 
-  if verbose:
-    print( "filtering renames" )
+  log.Debug( "sorting renames" )
+  with stats.Phase( 'sort' ):
+    renames.sort()
+
+  log.Debug( "filtering renames" )
   # filter out renames whose new_file_name doesn't match the result expression
   if result_re is not None:
-    renames = FilterRenames( renames, result_re )
+    with stats.Phase( 'filter' ):
+      renames = FilterRenames( renames, result_re )
+
+  log.Debug( "checking for existing files" )
+  # drop renames to names that are taken, unless the file there is being renamed too
+  with stats.Phase( 'check' ):
+    renames = planner.ResolveRenames( renames, index, overwrite=overwrite )
 
   if dryrun:
-    for rename in renames:
-      print( "{} -> {}".format( rename[0], rename[1] ) )
+    with stats.Phase( 'print' ):
+      PrintRenames( renames )
 
   else:
-    if verbose:
-      print( "doing renames" )
-    # actually rename all the files
-    DoRenames( renames )
+    log.Debug( "doing renames" )
+    # actually rename all the files, in an order where no file is overwritten
+    # by another being renamed
+    with stats.Phase( 'order' ):
+      renames = planner.OrderRenames( renames, index )
+
+    if journal_path is None:
+      with stats.Phase( 'rename' ):
+        DoRenames( renames, state=state, overwrite=overwrite, jobs=jobs )
+
+    else:
+      # write down everything that is going to be done before doing it
+      import journal
+      with stats.Phase( 'journal' ):
+        record = journal.Journal( journal_path, overwrite=overwrite )
+        record.Plan( renames )
+
+      try:
+        with stats.Phase( 'rename' ):
+          DoRenames( renames, journal=record, state=state, overwrite=overwrite, jobs=jobs )
+
+      except:
+        record.Close( complete=False )
+        raise
+
+      record.Close()
+
+  # see --stream above
+  if state is not None:
+    state.Close( save=not dryrun )
 
 
 if __name__ == '__main__':
-  Main()
+  try:
+    Main()
+  finally:
+    # before any traceback
+    log.Close()
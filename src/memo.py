@@ -0,0 +1,214 @@
+#!/bin/python3
+
+"""
+Does actions to paths, remembering what each directory and file name became.
+With -r the same names (cover.jpg, Season 01, ...) are in thousands of
+directories, and every file in a directory has the same directory, so most of
+the actions don't need to be done again.
+
+This only works for actions that do the same to a path as to its directory and
+its file name on their own: regexes that can't match a path separator and
+don't look behind or ahead (see batch.Local). A path is split at its last
+separator, and the two pieces are given the actions with the separator still
+on the side it was, so ^ and $ only match where they would in the whole path.
+The pieces that aren't remembered are given the actions joined together, like
+batch.ApplyBatch.
+
+When the actions are only given file names (without --full-path), there is
+nothing to split and any actions can be remembered.
+"""
+
+
+from collections import OrderedDict
+import os
+
+from actions import Remove, Replace
+import batch
+import stats
+import fs
+
+
+# the most directories and file names remembered, of each
+MEMO_SIZE = 65536
+
+# when fewer than this much of the file names in a batch were remembered, the
+# names are mostly different and the next MEMO_SKIP batches aren't remembered,
+# since batch.ApplyBatch does them faster
+MEMO_MIN_HITS = 0.5
+MEMO_SKIP     = 8
+
+SEPARATORS = [ sep for sep in ( os.sep, os.altsep ) if sep is not None ]
+
+
+def _Usable( action ):
+  """
+  Returns True if an action does the same to a path as to its pieces
+  """
+  if type( action ) not in ( Remove, Replace ):
+    return False
+
+  regex = action.regex
+  if not all( batch.Local( regex, sep ) for sep in SEPARATORS ):
+    return False
+
+  # the pieces have a separator where the rest of the path was. the regex
+  # can't match it, but could match nothing before it or after it
+  return regex.match( os.sep ) is None and regex.search( os.sep, 1 ) is None
+
+
+def Usable( actions ):
+  """
+  Returns True if a Memo can do a list of actions
+  """
+  return len( actions ) > 0 and all( _Usable( action ) for action in actions )
+
+
+class Memo:
+  """
+  Does a list of actions to paths, see main.ApplyActions. Keywords aren't replaced.
+  """
+
+  def __init__( self, actions, partial=False, size=MEMO_SIZE, split=True ):
+    """
+    actions | a list of actions.Action, that Usable says can be split if split is on
+    partial | if false, a path an action doesn't change isn't renamed
+    size    | the most directories and file names remembered, of each
+    split   | if false, paths are remembered whole
+    """
+    self.actions = actions
+    self.partial = partial
+    self.size    = size
+    self.split   = split
+
+    # how many pieces of paths were remembered, and how many had the actions done
+    self.hits   = 0
+    self.misses = 0
+
+    # how many more batches go to batch.ApplyBatch, see MEMO_SKIP
+    self.skip = 0
+
+    # each action that changes a path sets its bit
+    self.changed = ( 1 << len( actions ) ) - 1
+
+    # { piece: ( new_piece, the bits of the actions that changed it ) }, the
+    # least recently used first. a path without a separator is done as a whole
+    self.directories = OrderedDict()
+    self.names       = OrderedDict()
+    self.wholes      = OrderedDict()
+
+  def _Do( self, texts ):
+    """
+    Does the actions to a list of texts, see batch.ApplyEach.
+
+    Returns a list of ( new_text, the bits of the actions that changed it )
+    """
+    texts, changed = batch.ApplyEach( self.actions, texts, collected=stats.current )
+    return list( zip( texts, changed ) )
+
+  def _Look( self, remembered, pieces, frame ):
+    """
+    Makes sure what pieces become is remembered, doing the actions to the ones
+    that aren't. The least recently used are forgotten later, see _Forget.
+
+    remembered | one of the OrderedDicts
+    pieces     | the pieces to find, without repeats
+    frame      | ( text before, text after ) each piece when doing the actions
+
+    Returns how many pieces weren't remembered
+    """
+    missing = []
+    move    = remembered.move_to_end
+
+    for piece in pieces:
+      if piece in remembered:
+        move( piece )
+      else:
+        missing.append( piece )
+
+    self.misses += len( missing )
+
+    if len( missing ) == 0:
+      return 0
+
+    before, after = frame
+    done  = self._Do( [ before + piece + after for piece in missing ] )
+    start = len( before )
+    end   = -len( after ) or None
+
+    for piece, ( text, changed ) in zip( missing, done ):
+      remembered[piece] = ( text[ start : end ], changed )
+
+    return len( missing )
+
+  def _Forget( self ):
+    """
+    Forgets the least recently used pieces past size.
+    """
+    for remembered in ( self.directories, self.names, self.wholes ):
+      while len( remembered ) > self.size:
+        remembered.popitem( last=False )
+
+  def ApplyMany( self, paths ):
+    """
+    Does the actions to many paths, counting how many pieces were remembered
+    in the stats (see stats.Stats.Count).
+
+    Returns a list of the new paths, None where an action didn't change it
+    """
+    if self.skip > 0:
+      self.skip -= 1
+      return batch.ApplyBatch( self.actions, paths, partial=self.partial )
+
+    misses = self.misses
+    sep    = os.sep
+
+    if self.split:
+      split = [ fs.LastSeparator( path ) for path in paths ]
+    else:
+      split = [ -1 ] * len( paths )
+
+    # a path without a separator is kept whole, with no directory
+    heads = [ path[:i] if i >= 0 else None for path, i in zip( paths, split ) ]
+    tails = [ path[i + 1:] if i >= 0 else path for path, i in zip( paths, split ) ]
+
+    directories = set( heads )
+    directories.discard( None )
+    names  = set( tail for head, tail in zip( heads, tails ) if head is not None )
+    wholes = set( tail for head, tail in zip( heads, tails ) if head is None )
+
+    self._Look( self.directories, directories, ( '', sep ) )
+    new_names = self._Look( self.names, names, ( sep, '' ) ) + self._Look( self.wholes, wholes, ( '', '' ) )
+
+    # each path is a file name, with a directory or without one
+    pieces = len( paths ) + len( paths ) - split.count( -1 )
+    if len( paths ) - new_names < MEMO_MIN_HITS * len( paths ):
+      self.skip = MEMO_SKIP
+
+    directories = self.directories
+    names       = self.names
+    results     = []
+    partial     = self.partial
+    every       = self.changed
+
+    for path, i, head, tail in zip( paths, split, heads, tails ):
+      if head is None:
+        new, changed = self.wholes[tail]
+      else:
+        directory, dir_changed = directories[head]
+        name, name_changed     = names[tail]
+
+        new     = directory + path[i] + name
+        changed = dir_changed | name_changed
+
+      results.append( new if partial or changed == every else None )
+
+    self._Forget()
+
+    misses     = self.misses - misses
+    self.hits += pieces - misses
+
+    if stats.current is not None:
+      stats.current.Count( 'memo hits', pieces - misses )
+      stats.current.Count( 'memo misses', misses )
+
+    return results
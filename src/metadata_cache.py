@@ -0,0 +1,197 @@
+#!/bin/python3
+
+"""
+Remembers what ffprobe found in files between runs, so files that haven't
+changed don't have to be probed again.
+"""
+
+
+import time
+import os
+
+import stats
+import log
+
+
+DEFAULT_MAX_ENTRIES = 200000
+
+
+def DefaultPath():
+  """
+  Returns the path of the cache file in the user's cache directory
+  """
+  cache_dir = os.environ.get( 'XDG_CACHE_HOME', os.path.join( os.path.expanduser( '~' ), '.cache' ) )
+  return os.path.join( cache_dir, 'renamer', 'metadata.sqlite' )
+
+
+class MetadataCache:
+  """
+  An sqlite file of probe records for files.
+
+  Files are known by ( device, inode ) and a record is only used while the file's
+  size and modification time are the same as when it was stored.
+  """
+  # how many changes to keep before writing them to the file
+  COMMIT_EVERY = 1000
+
+  def __init__( self, path=None, max_entries=DEFAULT_MAX_ENTRIES, refresh=False ):
+    """
+    path        | the cache file, created if it doesn't exist
+    max_entries | the most files to remember, the least recently used are forgotten first
+    refresh     | if true, never use stored records but still store new ones
+    """
+    self.path        = path if path is not None else DefaultPath()
+    self.max_entries = max_entries
+    self.refresh     = refresh
+    self.db          = None
+    self.failed      = False
+    self.changes     = 0
+    self.used        = {}
+
+  def _Open( self ):
+    """
+    Opens the cache file the first time it is needed.
+
+    Returns False if the cache can't be used
+    """
+    if self.db is not None:
+      return True
+
+    if self.failed:
+      return False
+
+    # sqlite is only loaded once a keyword needs the cache
+    import sqlite3
+
+    try:
+      os.makedirs( os.path.dirname( os.path.abspath( self.path ) ), exist_ok=True )
+      self.db = sqlite3.connect( self.path )
+      self.db.execute( """
+        CREATE TABLE IF NOT EXISTS probes (
+          dev   INTEGER,
+          ino   INTEGER,
+          size  INTEGER,
+          mtime INTEGER,
+          data  TEXT,
+          used  INTEGER,
+          PRIMARY KEY ( dev, ino )
+        )""" )
+      self.db.execute( "CREATE INDEX IF NOT EXISTS probes_used ON probes ( used )" )
+
+    except ( sqlite3.Error, OSError ) as e:
+      log.Warn( "can't use metadata cache '{}': {}", self.path, e )
+      self.db = None
+      self.failed = True
+      return False
+
+    return True
+
+  def _Key( self, file ):
+    """
+    Returns ( device, inode, size, mtime ) of file, or None if it can't be found
+    """
+    try:
+      st = os.stat( file )
+    except OSError:
+      return None
+
+    return ( st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns )
+
+  def Get( self, file ):
+    """
+    Looks up a stored probe record.
+
+    file | the file path
+
+    Returns ( True, record ) if it was stored, ( False, None ) if it wasn't
+    """
+    if self.refresh or not self._Open():
+      return ( False, None )
+
+    key = self._Key( file )
+    if key is None:
+      return ( False, None )
+
+    row = self.db.execute(
+      "SELECT size, mtime, data FROM probes WHERE dev = ? AND ino = ?", key[0:2] ).fetchone()
+
+    if row is None or row[0] != key[2] or row[1] != key[3]:
+      if stats.current is not None:
+        stats.current.Count( 'cache misses' )
+      return ( False, None )
+
+    if stats.current is not None:
+      stats.current.Count( 'cache hits' )
+
+    # remember it was used, written out with the next commit
+    self.used[ key[0:2] ] = int( time.time() )
+
+    import json
+    return ( True, json.loads( row[2] ) )
+
+  def Put( self, file, record ):
+    """
+    Stores a probe record for a file.
+
+    file   | the file path
+    record | a dict of what was found, or None if the file couldn't be probed
+    """
+    if not self._Open():
+      return
+
+    key = self._Key( file )
+    if key is None:
+      return
+
+    import json
+    self.db.execute(
+      "INSERT OR REPLACE INTO probes ( dev, ino, size, mtime, data, used ) VALUES ( ?, ?, ?, ?, ?, ? )",
+      ( *key, json.dumps( record ), int( time.time() ) ) )
+
+    self.changes += 1
+    if self.changes >= self.COMMIT_EVERY:
+      self.Commit()
+
+  def Commit( self ):
+    """
+    Writes out all the changes so far.
+    """
+    if self.db is None:
+      return
+
+    if len( self.used ) > 0:
+      self.db.executemany(
+        "UPDATE probes SET used = ? WHERE dev = ? AND ino = ?",
+        [ ( used, *key ) for key, used in self.used.items() ] )
+      self.used = {}
+
+    self.db.commit()
+    self.changes = 0
+
+  def Evict( self ):
+    """
+    Forgets the least recently used files until there are at most max_entries.
+    """
+    if self.db is None:
+      return
+
+    count = self.db.execute( "SELECT COUNT(*) FROM probes" ).fetchone()[0]
+    if count <= self.max_entries:
+      return
+
+    self.db.execute(
+      "DELETE FROM probes WHERE rowid IN ( SELECT rowid FROM probes ORDER BY used LIMIT ? )",
+      ( count - self.max_entries, ) )
+
+  def Close( self ):
+    """
+    Writes out all the changes, trims the cache to size and closes it.
+    """
+    if self.db is None:
+      return
+
+    self.Commit()
+    self.Evict()
+    self.db.commit()
+    self.db.close()
+    self.db = None
@@ -0,0 +1,194 @@
+#!/bin/python3
+
+"""
+Decides which renames can be done safely and the order to do them in.
+
+A batch of renames can rename a file to the name of another file in the same
+batch (E1 -> E2, E2 -> E3), or swap names around (E1 -> E2, E2 -> E1).
+Every file is renamed at most once and no two files get the same new name, so
+the renames make simple chains and loops, which are gone through in O(n).
+"""
+
+
+import os
+
+import log
+
+
+global verbose
+try:
+  verbose
+except NameError:
+  verbose = False
+
+
+def _Taken( rename, overwrite, report=True ):
+  """
+  Decides a rename to a name that is taken by a file that isn't moving.
+
+  report | if false, nothing is printed
+
+  Returns True if it is kept
+  """
+  global verbose
+
+  if overwrite:
+    if report:
+      log.File( log.INFO, "file being overwritten '{}'", rename[1] )
+    return True
+
+  if verbose and report:
+    log.File( log.DEBUG, "file already exists '{}', dropping", rename[1] )
+
+  return False
+
+
+def ResolveRenames( renames, index, overwrite=False, report=True ):
+  """
+  Drops renames to names that are already taken, unless the file with that name
+  is being renamed out of the way in the same batch.
+
+  renames   | a list of ( current_name, desired_name ), no two with the same desired_name
+  index     | an fs.DirectoryIndex of the files that exist now
+  overwrite | if true, renames to taken names are kept and overwrite those files
+  report    | if false, nothing is printed about dropped or overwriting renames
+
+  Returns the renames that can be done, in the same order
+  """
+  sources = {}
+  for i, rename in enumerate( renames ):
+    sources[ os.path.normpath( rename[0] ) ] = i
+
+  # None until decided, then True to keep or False to drop
+  keep = [ None ] * len( renames )
+
+  # renaming a file to its own name does nothing
+  for i, rename in enumerate( renames ):
+    if sources.get( os.path.normpath( rename[1] ) ) == i:
+      keep[i] = False
+
+  for start in range( len( renames ) ):
+    # follow the chain of renames whose new names have to be moved out of the
+    # way first, until one that is decided, one that doesn't need another, or a loop
+    chain = []
+    i = start
+
+    while i is not None and keep[i] is None:
+      keep[i] = 'checking'
+      chain.append( i )
+
+      i = sources.get( os.path.normpath( renames[i][1] ) )
+
+    if len( chain ) == 0:
+      continue
+
+    if i is None:
+      # the end of the chain goes to a name no file in the batch has now
+      last = chain.pop()
+      keep[last] = not index.Exists( renames[last][1] ) or _Taken( renames[last], overwrite, report )
+      moved = keep[last]
+
+    elif keep[i] == 'checking':
+      # a loop, every file in it is moving out of the way of another
+      moved = True
+
+    else:
+      moved = keep[i]
+
+    # each rename in the chain is going to the name of the one after it
+    for j in reversed( chain ):
+      keep[j] = moved or _Taken( renames[j], overwrite, report )
+      moved = keep[j]
+
+  return [ rename for rename, kept in zip( renames, keep ) if kept ]
+
+
+def CheckRenames( renames, index, overwrite=False ):
+  """
+  Drops renames to names that are already taken, one rename at a time, for when
+  the whole batch isn't known ahead of time (see main --stream).
+  The index is updated as if each rename is done as soon as it is checked, so
+  a name can be taken once its file has been renamed, but a rename can't wait
+  for a file later in the batch to be renamed out of the way. A dropped
+  rename's planned name is forgotten (see fs.DirectoryIndex.Unplan).
+
+  renames   | an iterable of ( current_name, desired_name )
+  index     | an fs.DirectoryIndex of the files that exist now
+  overwrite | if true, renames to taken names are kept and overwrite those files
+
+  Yields the renames that can be done, in the same order
+  """
+  for rename in renames:
+    if os.path.normpath( rename[0] ) == os.path.normpath( rename[1] ):
+      index.Unplan( rename[1] )
+      continue
+
+    if index.Exists( rename[1] ) and not _Taken( rename, overwrite ):
+      index.Unplan( rename[1] )
+      continue
+
+    index.Moved( rename[0], rename[1] )
+    yield rename
+
+
+def TempName( path, index ):
+  """
+  Returns a name next to path that isn't used by anything
+  """
+  directory, name = os.path.split( path )
+  i = 0
+
+  while True:
+    temp = os.path.join( directory, '.{}.renamer-{}'.format( name, i ) )
+    if not index.Exists( temp ) and not index.Planned( temp ):
+      index.Plan( temp )
+      return temp
+
+    i += 1
+
+
+def OrderRenames( renames, index ):
+  """
+  Orders renames so that no file is renamed onto a file that hasn't been moved
+  out of the way yet. Loops are broken by moving one file to a temporary name.
+
+  renames | a list of ( current_name, desired_name ), see ResolveRenames
+  index   | an fs.DirectoryIndex, used to find unused temporary names
+
+  Returns a list of ( current_name, desired_name ) in the order they should be done
+  """
+  sources = {}
+  targets = {}
+  for i, rename in enumerate( renames ):
+    sources[ os.path.normpath( rename[0] ) ] = i
+    targets[ os.path.normpath( rename[1] ) ] = i
+
+  done  = [ False ] * len( renames )
+  order = []
+
+  def Unwind( i, stop=None ):
+    # do i, then the rename waiting on the name i has just moved out of, and so on
+    while i is not None and i != stop and not done[i]:
+      done[i] = True
+      order.append( renames[i] )
+
+      i = targets.get( os.path.normpath( renames[i][0] ) )
+
+  # chains start with a rename to a name nothing in the batch has
+  for i, rename in enumerate( renames ):
+    if os.path.normpath( rename[1] ) not in sources:
+      Unwind( i )
+
+  # everything left is in a loop
+  for i, rename in enumerate( renames ):
+    if done[i]:
+      continue
+
+    temp = TempName( rename[0], index )
+    done[i] = True
+    order.append( ( rename[0], temp ) )
+
+    Unwind( targets.get( os.path.normpath( rename[0] ) ), stop=i )
+    order.append( ( temp, rename[1] ) )
+
+  return order
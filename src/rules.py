@@ -0,0 +1,193 @@
+#!/bin/python3
+
+r"""
+Reads many named rule sets from one file, so a tree is walked once and each
+file is renamed by the rule set its path matches.
+
+A rules file is JSON, or TOML if its name ends in '.toml':
+
+  {
+    "rules": {
+      "dexter": {
+        "filter": "shows/dexter/",
+        "actions": [ "r:dexter episode ([0-9]+):Dexter E\\1" ],
+        "result": ".*E[0-9]+",
+        "partial": false
+      },
+      "everything else": { "actions": [ "d: \\[random crap\\]" ] }
+    }
+  }
+
+  [rules.dexter]
+  filter  = "shows/dexter/"
+  actions = [ 'r:dexter episode ([0-9]+):Dexter E\1' ]
+
+filter and result can be a regex or a list of them. A file goes to the first
+rule set whose filter matches it; a rule set without a filter takes every file.
+"""
+
+
+from collections import namedtuple
+import json
+import re
+
+import filters
+
+
+# name      | what the rule set is called in the rules file
+# actions   | a list of actions.Action
+# filter_re | a list of regular expressions the files have to match, or None for every file
+# result    | a filters.Filter new names have to match, or None
+# partial   | if true, files are renamed even if some actions didn't change them
+RuleSet = namedtuple( 'RuleSet', [ 'name', 'actions', 'filter_re', 'result', 'partial' ] )
+
+KEYS = set( [ 'actions', 'filter', 'result', 'partial' ] )
+
+
+def _Patterns( value, name, key ):
+  """
+  Returns a regex or list of regexes from a rules file as a list, or None if not given
+  """
+  if value is None:
+    return None
+
+  if isinstance( value, str ):
+    return [ value ]
+
+  if isinstance( value, list ) and len( value ) > 0 and all( isinstance( p, str ) for p in value ):
+    return value
+
+  raise Exception( "rule set's {} must be a regex or a list of them".format( key ), name )
+
+
+def ParseRules( data, parse_action ):
+  """
+  Makes the rule sets from what was read from a rules file.
+
+  data         | a dict with a 'rules' table of { name: rule set }
+  parse_action | a function that parses an action like -a does (see main.ParseAction)
+
+  Returns a list of RuleSet, in the order they were in the file
+  """
+  if not isinstance( data, dict ) or not isinstance( data.get( 'rules' ), dict ):
+    raise Exception( "rules file needs a 'rules' table of named rule sets" )
+
+  rule_sets = []
+
+  for name, rule in data['rules'].items():
+    if not isinstance( rule, dict ):
+      raise Exception( "rule set must be a table", name )
+
+    unknown = set( rule ) - KEYS
+    if len( unknown ) > 0:
+      raise Exception( "unknown keys in rule set", name, sorted( unknown ) )
+
+    actions = rule.get( 'actions' )
+    if not isinstance( actions, list ) or len( actions ) == 0 or not all( isinstance( a, str ) for a in actions ):
+      raise Exception( "rule set needs a list of actions", name )
+
+    result = _Patterns( rule.get( 'result' ), name, 'result' )
+
+    rule_sets.append( RuleSet(
+      name,
+      [ parse_action( action ) for action in actions ],
+      _Patterns( rule.get( 'filter' ), name, 'filter' ),
+      filters.Filter( result ) if result is not None else None,
+      bool( rule.get( 'partial', False ) ),
+    ) )
+
+  if len( rule_sets ) == 0:
+    raise Exception( "rules file has no rule sets" )
+
+  return rule_sets
+
+
+def LoadRules( path, parse_action ):
+  """
+  Reads a rules file, see ParseRules.
+  """
+  if path.endswith( '.toml' ):
+    try:
+      import tomllib
+    except ImportError:
+      raise Exception( "TOML rules files need python 3.11 or newer, use JSON instead", path )
+
+    with open( path, 'rb' ) as f:
+      data = tomllib.load( f )
+
+  else:
+    with open( path ) as f:
+      data = json.load( f )
+
+  return ParseRules( data, parse_action )
+
+
+class Dispatcher:
+  """
+  Finds the rule set for a file with one regex, made from all the filters.
+  """
+  __slots__ = ( 'regex', 'groups', 'separate', 'patterns' )
+
+  def __init__( self, rule_sets ):
+    """
+    rule_sets | a list of RuleSet, earlier ones win
+    """
+    self.regex    = None
+    self.groups   = {}
+    self.separate = []
+
+    # every file has to match one of these to go to any rule set
+    self.patterns = []
+    for rule in rule_sets:
+      if rule.filter_re is None:
+        self.patterns = None
+        break
+      self.patterns.extend( rule.filter_re )
+
+    alternatives = []
+    for i, rule in enumerate( rule_sets ):
+      patterns = rule.filter_re if rule.filter_re is not None else [ '' ]
+
+      # back references are numbered across the whole regex, see filters.Filter
+      if any( re.search( r'\\[1-9]|\(\?P=', p ) for p in patterns ):
+        self.separate.append( ( i, [ re.compile( p ) for p in patterns ] ) )
+        continue
+
+      group = '_rule{}'.format( i )
+      self.groups[group] = i
+      alternatives.append( '(?P<{}>{})'.format( group, '|'.join( '(?:{})'.format( p ) for p in patterns ) ) )
+
+    if len( alternatives ) > 0:
+      try:
+        # the first alternative that matches wins, like the rule sets
+        self.regex = re.compile( '|'.join( alternatives ) )
+
+      except re.error:
+        # flags or group names that clash, check each rule set on its own
+        self.regex    = None
+        self.groups   = {}
+        self.separate = [
+          ( i, [ re.compile( p ) for p in rule.filter_re or [ '' ] ] )
+          for i, rule in enumerate( rule_sets ) ]
+
+    self.separate.sort( key=lambda s: s[0] )
+
+  def match( self, file ):
+    """
+    Returns the index of the first rule set whose filter matches file, or None
+    """
+    found = None
+
+    if self.regex is not None:
+      match = self.regex.match( file )
+      if match is not None:
+        found = self.groups[ match.lastgroup ]
+
+    for i, regexes in self.separate:
+      if found is not None and i >= found:
+        break
+
+      if any( regex.match( file ) for regex in regexes ):
+        return i
+
+    return found
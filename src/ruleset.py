@@ -0,0 +1,160 @@
+#!/bin/python3
+
+"""
+Renames files from other programs without going through the command line.
+
+  rules = ruleset.RenameRuleSet( [ 'r:episode ([0-9]+):E\\1' ], filter_re=r'.*\\.mkv$' )
+  plan  = rules.plan( [ 'downloads/show episode 01.mkv' ] )
+  done  = rules.apply( plan )
+
+A RenameRuleSet parses its actions and compiles its patterns once. It doesn't
+change after it is made and each plan keeps its own directory listings, so one
+rule set can be used from many threads at once. Nothing is printed; what was
+dropped and why is returned instead.
+
+Keywords are probed without the metadata cache the command line uses, since
+its sqlite connection can't be shared between threads.
+"""
+
+
+from collections import namedtuple
+import os
+
+from actions import Action
+import executor
+import filters
+import planner
+import main
+import fs
+
+
+# why a file isn't renamed
+UNCHANGED = 'unchanged'   # the actions didn't change it, or it was renamed to its own name
+BAD_NAME  = 'bad name'    # the new name is '', '.', '..' or ends in one of them (see main.BadName)
+DUPLICATE = 'duplicate'   # another file is being renamed to the same name
+RESULT    = 'result'      # the new name doesn't match result_re
+EXISTS    = 'exists'      # a file that isn't being renamed already has the new name
+
+
+# a file that won't be renamed. new_file is None if the actions couldn't be done
+Drop = namedtuple( 'Drop', [ 'file', 'new_file', 'reason' ] )
+
+# renames   | ( current_name, desired_name ) in the order they have to be done,
+#             including moves to and from temporary names to swap files
+# drops     | a list of Drop
+# overwrite | the renames that replace a file that isn't being renamed
+Plan = namedtuple( 'Plan', [ 'renames', 'drops', 'overwrite' ] )
+
+# done      | the renames that were done, in order
+# error     | ( rename, OSError ) for the rename that failed, or None
+# remaining | the renames that weren't tried after it failed
+Applied = namedtuple( 'Applied', [ 'done', 'error', 'remaining' ] )
+
+
+class RenameRuleSet:
+  """
+  Actions, filters and options prepared once, to rename any number of batches of files.
+  """
+  __slots__ = ( 'actions', 'filter_re', 'result', 'partial', 'overwrite', 'recursive', 'full_path' )
+
+  def __init__( self, actions, filter_re=None, result_re=None, partial=False, overwrite=False,
+                recursive=False, full_path=False ):
+    """
+    actions   | a list of actions.Action, or of actions as given to -a ('r:a:b')
+    filter_re | a regular expression, or a list of them, files have to match
+    result_re | a regular expression, or a list of them, new names have to match
+    partial   | if true, files are renamed even if some actions didn't change them
+    overwrite | if true, renames can replace files that aren't being renamed
+    recursive | if true, directories given to plan are walked all the way down
+    full_path | if true, the actions are done to the whole path of each file instead of only its name
+    """
+    self.actions   = tuple( a if isinstance( a, Action ) else main.ParseAction( a ) for a in actions )
+    self.filter_re = filters.Filter( filter_re ) if filter_re is not None else None
+    self.result    = filters.Filter( result_re ) if result_re is not None else None
+    self.partial   = partial
+    self.overwrite = overwrite
+    self.recursive = recursive
+    self.full_path = full_path
+
+    if len( self.actions ) == 0:
+      raise Exception( "no actions to do" )
+
+  def plan( self, paths ):
+    """
+    Works out how to rename some files, without renaming anything.
+
+    paths | a list of file and directory paths
+
+    Returns a Plan
+    """
+    index = fs.DirectoryIndex()
+    files = fs.GetFiles( list( paths ), filter_re=self.filter_re, recursive=self.recursive, index=index )
+    drops = []
+    renames = []
+
+    for file in files:
+      rename = main.GenerateRename( self.actions, file, partial=self.partial, full_path=self.full_path )
+
+      if rename is None:
+        drops.append( Drop( file, None, UNCHANGED ) )
+
+      elif os.path.normpath( rename[0] ) == os.path.normpath( rename[1] ):
+        # the name stays taken
+        index.Plan( rename[1] )
+        drops.append( Drop( file, rename[1], UNCHANGED ) )
+
+      elif main.BadName( rename[1] ):
+        drops.append( Drop( file, rename[1], BAD_NAME ) )
+
+      elif index.Planned( rename[1] ):
+        drops.append( Drop( file, rename[1], DUPLICATE ) )
+
+      elif self.result is not None and not self.result.match( rename[1] ):
+        drops.append( Drop( file, rename[1], RESULT ) )
+
+      else:
+        index.Plan( rename[1] )
+        renames.append( rename )
+
+    renames.sort()
+    kept = planner.ResolveRenames( renames, index, overwrite=self.overwrite, report=False )
+
+    sources = set( os.path.normpath( rename[0] ) for rename in renames )
+    dropped = set( renames ) - set( kept )
+
+    for rename in renames:
+      if rename in dropped:
+        drops.append( Drop( rename[0], rename[1], EXISTS ) )
+
+    overwrite = [
+      rename for rename in kept
+      if os.path.normpath( rename[1] ) not in sources and index.Exists( rename[1] ) ]
+
+    return Plan( planner.OrderRenames( kept, index ), drops, overwrite )
+
+  def apply( self, plan ):
+    """
+    Does the renames in a plan, stopping at the first one that fails. Unless
+    overwrite is on, a file that appeared at a new name since the plan was
+    made is never replaced; that rename fails with FileExistsError.
+
+    plan | a Plan from plan()
+
+    Returns Applied
+    """
+    done    = []
+    renamer = executor.Executor( overwrite=self.overwrite )
+
+    try:
+      for i, rename in enumerate( plan.renames ):
+        try:
+          renamer.Rename( rename[0], rename[1] )
+        except OSError as e:
+          return Applied( done, ( rename, e ), plan.renames[ i+1: ] )
+
+        done.append( rename )
+
+    finally:
+      renamer.Close()
+
+    return Applied( done, None, [] )
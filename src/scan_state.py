@@ -0,0 +1,139 @@
+#!/bin/python3
+
+"""
+Remembers each directory's modification time and listing between runs, so a
+walk only has to list the directories that changed since the last one and only
+finds the files that are new in them (see fs.WalkChanges).
+
+A directory's modification time changes when a name in it is added, removed or
+renamed, but not when a file's contents change or something changes further
+down the tree. So every directory is still checked with one stat, but only the
+changed ones are listed.
+"""
+
+
+import sqlite3
+import json
+import os
+
+
+# modification times this close to the walk aren't trusted, the directory
+# could change again within the same tick of the file system's clock
+RACY_SECONDS = 2
+
+
+class ScanState:
+  """
+  An sqlite file of directory listings, keyed by the directory's absolute path.
+  """
+  def __init__( self, path ):
+    """
+    path | the state file, created if it doesn't exist
+    """
+    self.path  = path
+    self.db    = sqlite3.connect( path )
+    # directories with files renamed in them, { path: ( mtime, { name: kind } ) }
+    self.moved = {}
+    self.db.execute( """
+      CREATE TABLE IF NOT EXISTS dirs (
+        path    TEXT PRIMARY KEY,
+        mtime   INTEGER,
+        entries TEXT
+      )""" )
+
+  def Get( self, directory ):
+    """
+    Looks up what a directory had in it last time.
+
+    directory | the directory path
+
+    Returns ( mtime, entries ), entries being a list of ( kind, name ) (see
+    fs._ScanDirectory) and mtime None if it has to be listed again anyway.
+    Returns None if the directory hasn't been seen before.
+    """
+    row = self.db.execute(
+      "SELECT mtime, entries FROM dirs WHERE path = ?", ( os.path.abspath( directory ), ) ).fetchone()
+
+    if row is None:
+      return None
+
+    return ( row[0], [ tuple( entry ) for entry in json.loads( row[1] ) ] )
+
+  def Put( self, directory, mtime, entries, now ):
+    """
+    Stores what is in a directory now.
+
+    directory | the directory path
+    mtime     | its modification time in nanoseconds
+    entries   | a list of ( kind, name )
+    now       | the time the walk started, in seconds
+    """
+    if now - mtime / 1e9 < RACY_SECONDS:
+      mtime = None
+
+    self.db.execute(
+      "INSERT OR REPLACE INTO dirs ( path, mtime, entries ) VALUES ( ?, ?, ? )",
+      ( os.path.abspath( directory ), mtime, json.dumps( entries ) ) )
+
+  def Forget( self, directory ):
+    """
+    Forgets a directory that is gone, along with everything under it.
+    """
+    directory = os.path.abspath( directory )
+    under     = os.path.join( directory, '' )
+
+    # everything starting with under, '0' being the character after '/'
+    self.db.execute(
+      "DELETE FROM dirs WHERE path = ? OR ( path >= ? AND path < ? )",
+      ( directory, under, under[:-1] + chr( ord( os.sep ) + 1 ) ) )
+
+  def _Moving( self, directory ):
+    """
+    Returns the entries of a directory something is being renamed in or out of,
+    as { name: kind }, or None if it isn't known.
+    """
+    directory = os.path.abspath( directory )
+
+    if directory not in self.moved:
+      stored = self.Get( directory )
+      if stored is None:
+        return None
+
+      self.moved[directory] = ( stored[0], { name: kind for kind, name in stored[1] } )
+
+    return self.moved[directory][1]
+
+  def Moved( self, old, new ):
+    """
+    Records that a file was renamed, so the next walk doesn't take its new
+    name for a new file. The directories keep their old modification time, so
+    they are still listed again to find anything else that changed.
+    """
+    old_dir, old_name = os.path.split( old )
+    new_dir, new_name = os.path.split( new )
+
+    kind = 'file'
+    entries = self._Moving( old_dir or '.' )
+    if entries is not None:
+      kind = entries.pop( old_name, 'file' )
+
+    entries = self._Moving( new_dir or '.' )
+    if entries is not None:
+      entries[new_name] = kind
+
+  def Close( self, save=True ):
+    """
+    Closes the state file.
+
+    save | if false, nothing from this run is kept
+    """
+    if save:
+      self.db.executemany(
+        "UPDATE dirs SET mtime = ?, entries = ? WHERE path = ?",
+        [ ( mtime, json.dumps( [ ( kind, name ) for name, kind in entries.items() ] ), directory )
+          for directory, ( mtime, entries ) in self.moved.items() ] )
+      self.db.commit()
+    else:
+      self.db.rollback()
+
+    self.db.close()
@@ -0,0 +1,328 @@
+#!/bin/python3
+
+"""
+Measures where the time of a run goes: how long each phase took, how often the
+file system and ffprobe were used, and how long each action takes on a name.
+
+Nothing is measured unless a Stats is being collected, with --stats or from
+another program:
+
+  with stats.Stats() as collected:
+    ...
+  print( collected.Table() )
+
+The other modules only check stats.current before measuring anything, so a
+run without it costs next to nothing.
+"""
+
+
+from collections import OrderedDict
+import time
+
+
+# the Stats being collected, or None
+current = None
+
+# how many times of each action are kept to find the percentiles from
+SAMPLES = 10000
+
+PERCENTILES = ( 50, 90, 99 )
+
+# the phase of what's counted outside of every phase
+NO_PHASE = 'other'
+
+# said with every report, the actions are timed differently than they are usually done
+NOTE = "actions were done to one name at a time to time them, without stats they are joined in batches"
+
+
+class _Phase:
+  """
+  Times one phase while it is entered, see Stats.Phase.
+  """
+  __slots__ = ( 'stats', 'name' )
+
+  def __init__( self, stats, name ):
+    self.stats = stats
+    self.name  = name
+
+  def __enter__( self ):
+    # [ name, wall start, cpu start, wall in phases inside it, cpu in phases inside it ]
+    self.stats.stack.append( [ self.name, time.perf_counter(), time.process_time(), 0.0, 0.0 ] )
+
+  def __exit__( self, *exc ):
+    name, wall, cpu, inner_wall, inner_cpu = self.stats.stack.pop()
+    wall = time.perf_counter() - wall
+    cpu  = time.process_time() - cpu
+
+    # a phase's time doesn't include the phases inside it
+    phase = self.stats.phases.setdefault( name, [ 0.0, 0.0 ] )
+    phase[0] += wall - inner_wall
+    phase[1] += cpu - inner_cpu
+
+    if len( self.stats.stack ) > 0:
+      self.stats.stack[-1][3] += wall
+      self.stats.stack[-1][4] += cpu
+
+
+class _Nothing:
+  """
+  A phase that isn't timed, when nothing is being measured.
+  """
+  __slots__ = ()
+
+  def __enter__( self ):
+    pass
+
+  def __exit__( self, *exc ):
+    pass
+
+
+NOTHING = _Nothing()
+
+
+def Phase( name ):
+  """
+  Returns a context manager that adds the time inside it to phase name, if
+  anything is being measured
+  """
+  if current is None:
+    return NOTHING
+
+  return current.Phase( name )
+
+
+def Bound( func ):
+  """
+  Returns func, counting into the phase it was handed out in if anything is
+  being measured (see Stats.Bound)
+  """
+  if current is None:
+    return func
+
+  return current.Bound( func )
+
+
+def Timed( name, iterable ):
+  """
+  Returns iterable, timing it as phase name if anything is being measured (see Stats.Timed)
+  """
+  if current is None:
+    return iterable
+
+  return current.Timed( name, iterable )
+
+
+class Stats:
+  """
+  What was measured during a run.
+
+  Phases are only timed from the main thread, counts can come from any thread
+  and go to the phase the work was handed out in (see Bound).
+
+  Actions are only timed one name at a time, so while a Stats is being
+  collected they are never joined together in batches (see batch.ApplyBatch)
+  like they are in a run without one.
+  """
+  def __init__( self ):
+    import threading
+    import random
+
+    self.phases   = OrderedDict()
+    self.stack    = []
+    self.counts   = OrderedDict()
+    self.actions  = OrderedDict()
+    self.lock     = threading.Lock()
+    self.local    = threading.local()
+    self.random   = random.Random( 0 )
+    self.start    = time.perf_counter()
+    self.seconds  = None
+    self.previous = None
+
+  def Start( self ):
+    """
+    Starts measuring into this Stats, until Stop.
+    """
+    global current
+    self.previous = current
+    self.start    = time.perf_counter()
+    current = self
+
+  def Stop( self ):
+    global current
+    current = self.previous
+    self.seconds = time.perf_counter() - self.start
+
+  def __enter__( self ):
+    self.Start()
+    return self
+
+  def __exit__( self, *exc ):
+    self.Stop()
+
+  def Phase( self, name ):
+    """
+    Returns a context manager that adds the time inside it to phase name
+    """
+    return _Phase( self, name )
+
+  def Timed( self, name, iterable ):
+    """
+    Adds the time spent getting each item of iterable to phase name, for things
+    like the walk that happen a bit at a time while other phases use them.
+
+    Yields the items of iterable
+    """
+    iterator = iter( iterable )
+    phase    = _Phase( self, name )
+
+    while True:
+      with phase:
+        try:
+          item = next( iterator )
+        except StopIteration:
+          return
+
+      yield item
+
+  def _Current( self ):
+    """
+    Returns the phase counts go to: the one the function running was given
+    for (see Bound), or else the one the main thread is in (NO_PHASE outside of them)
+    """
+    phase = getattr( self.local, 'phase', None )
+    if phase is not None:
+      return phase
+
+    try:
+      return self.stack[-1][0]
+    except IndexError:
+      # the main thread can leave the last phase while another thread counts
+      return NO_PHASE
+
+  def Bound( self, func ):
+    """
+    Returns func, counting into the phase the main thread is in now wherever
+    and whenever it runs. For work handed to other threads, so it isn't
+    counted in whatever phase the main thread has moved on to.
+    """
+    phase = self._Current()
+    local = self.local
+
+    def Run( *args, **kwargs ):
+      outer       = getattr( local, 'phase', None )
+      local.phase = phase
+      try:
+        return func( *args, **kwargs )
+      finally:
+        local.phase = outer
+
+    return Run
+
+  def Count( self, name, n=1 ):
+    """
+    Adds n to the counter called name, in the current phase (see _Current)
+    """
+    phase = self._Current()
+
+    with self.lock:
+      counts = self.counts.get( phase )
+      if counts is None:
+        counts = self.counts[phase] = {}
+
+      counts[name] = counts.get( name, 0 ) + n
+
+  def Counted( self, name ):
+    """
+    Returns the counter called name, added up over every phase
+    """
+    with self.lock:
+      return sum( counts.get( name, 0 ) for counts in self.counts.values() )
+
+  def Sample( self, action, seconds ):
+    """
+    Records how long an action took on one name.
+
+    Only SAMPLES times are kept for each action, picked at random from all of them.
+    """
+    record = self.actions.get( action )
+    if record is None:
+      # [ count, total seconds, slowest, samples ]
+      record = [ 0, 0.0, 0.0, [] ]
+      self.actions[action] = record
+
+    record[0] += 1
+    record[1] += seconds
+    if seconds > record[2]:
+      record[2] = seconds
+
+    if len( record[3] ) < SAMPLES:
+      record[3].append( seconds )
+    else:
+      i = self.random.randrange( record[0] )
+      if i < SAMPLES:
+        record[3][i] = seconds
+
+  def Report( self ):
+    """
+    Returns everything measured as a dict, ready for json
+    """
+    seconds = self.seconds if self.seconds is not None else time.perf_counter() - self.start
+
+    actions = []
+    for action, ( count, total, slowest, samples ) in self.actions.items():
+      samples = sorted( samples )
+      record  = OrderedDict( [
+        ( 'action', repr( action ) ),
+        ( 'count', count ),
+        ( 'seconds', total ),
+      ] )
+
+      for p in PERCENTILES:
+        record[ 'p{}'.format( p ) ] = samples[ min( len( samples ) - 1, len( samples ) * p // 100 ) ]
+      record['max'] = slowest
+
+      actions.append( record )
+
+    return OrderedDict( [
+      ( 'seconds', seconds ),
+      ( 'phases', OrderedDict(
+        ( name, { 'seconds': wall, 'cpu': cpu } ) for name, ( wall, cpu ) in self.phases.items() ) ),
+      ( 'counts', OrderedDict(
+        ( phase, OrderedDict( sorted( counts.items() ) ) ) for phase, counts in self.counts.items() ) ),
+      ( 'actions', actions ),
+      ( 'note', NOTE ),
+    ] )
+
+  def Table( self ):
+    """
+    Returns everything measured as text for people
+    """
+    report = self.Report()
+    lines  = []
+
+    lines.append( "{:<24} {:>10} {:>10}".format( 'phase', 'seconds', 'cpu' ) )
+    for name, phase in report['phases'].items():
+      lines.append( "{:<24} {:>10.3f} {:>10.3f}".format( name, phase['seconds'], phase['cpu'] ) )
+    lines.append( "{:<24} {:>10.3f}".format( 'total', report['seconds'] ) )
+
+    if len( report['counts'] ) > 0:
+      lines.append( "" )
+      lines.append( "{:<24} {:<24} {:>10}".format( 'phase', 'counter', 'count' ) )
+      for phase, counts in report['counts'].items():
+        for name, count in counts.items():
+          lines.append( "{:<24} {:<24} {:>10}".format( phase, name, count ) )
+
+    if len( report['actions'] ) > 0:
+      lines.append( "" )
+      lines.append( "{:>10}".format( 'count' ) +
+        ''.join( " {:>9}".format( 'p{}'.format( p ) ) for p in PERCENTILES ) + " {:>9}  action".format( 'max' ) )
+
+      for action in report['actions']:
+        lines.append( "{:>10}".format( action['count'] ) +
+          ''.join( " {:>7.1f}us".format( action[ 'p{}'.format( p ) ] * 1e6 ) for p in PERCENTILES ) +
+          " {:>7.1f}us  {}".format( action['max'] * 1e6, action['action'] ) )
+
+      lines.append( "" )
+      lines.append( report['note'] )
+
+    return '\n'.join( lines )
@@ -1,8 +1,34 @@
 #!/bin/python3
 
+import subprocess
+import contextlib
+import tempfile
 import unittest
-import renamer
+import json
+import time
+import sys
+import io
 import os
+import re
+
+from actions import Remove, Replace, Insert, Append
+import main as renamer
+import keyword_replacer
+import metadata_cache
+import external_sort
+import scan_state
+import executor
+import ruleset
+import rules
+import planner
+import batch
+import memo
+import stats
+import log
+import journal
+import filters
+import watch
+import fs
 
 
 def CreateFile( path ):
@@ -48,7 +74,7 @@ class TestGetFiles( unittest.TestCase ):
     # needs a list of valid files
     args = self.files
 
-    files = renamer.GetFiles( args )
+    files = fs.GetFiles( args )
     self.assertCountEqual( files, self.files )
 
 
@@ -57,7 +83,7 @@ class TestGetFiles( unittest.TestCase ):
     args = self.files
     filter_re = '.* .*'
 
-    files = renamer.GetFiles( args, filter_re=filter_re )
+    files = fs.GetFiles( args, filter_re=filter_re )
 
     # creates a list of all files that contain a space
     correct_files = [ f if Contains( ' ', f ) else None for f in args ]
@@ -71,7 +97,7 @@ class TestGetFiles( unittest.TestCase ):
     args = [ *self.files, 'invalid file.file' ]
     filter_re = '.* .*'
 
-    files = renamer.GetFiles( args, filter_re=filter_re )
+    files = fs.GetFiles( args, filter_re=filter_re )
 
     correct_files = [ f if Contains( ' ', f ) else None for f in self.files ]
     RemoveNones( correct_files )
@@ -82,33 +108,33 @@ class TestGetFiles( unittest.TestCase ):
 class TestParseAction( unittest.TestCase ):
   def test_remove( self ):
     action = renamer.ParseAction( 'd:a.c' )
-    self.assertEqual( action, ( 'remove', 'a.c' ) )
+    self.assertEqual( action, Remove( 'a.c' ) )
 
 
   def test_replace( self ):
-    action = renamer.ParseAction( 'r:lang.*\:eng.*:eng')
-    self.assertEqual( action, ( 'replace', 'lang.*:eng.*', 'eng' ) )
+    action = renamer.ParseAction( r'r:lang.*\:eng.*:eng')
+    self.assertEqual( action, Replace( 'lang.*:eng.*', 'eng' ) )
 
 
   def test_insert( self ):
     action = renamer.ParseAction( 'i:hello world' )
-    self.assertEqual( ( 'insert', 0, 'hello world' ), action, "insert string generated an incorrect action" )
+    self.assertEqual( Insert( 0, 'hello world' ), action, "insert string generated an incorrect action" )
 
     action = renamer.ParseAction( 'i:10:hello world' )
-    self.assertEqual( ( 'insert', 10, 'hello world' ), action, "insert position is incorrect" )
+    self.assertEqual( Insert( 10, 'hello world' ), action, "insert position is incorrect" )
 
     action = renamer.ParseAction( 'i:-10:hello world' )
-    self.assertEqual( ( 'insert', -10, 'hello world' ), action, "negative insert position is incorrect" )
+    self.assertEqual( Insert( -10, 'hello world' ), action, "negative insert position is incorrect" )
 
 
   def test_append( self ):
     action = renamer.ParseAction( 'a:end' )
-    self.assertEqual( ( 'append', 'end' ), action )
+    self.assertEqual( Append( 'end' ), action )
 
 
 class TestDoAction( unittest.TestCase ):
   def test_remove( self ):
-    action = ( 'remove', 'll' )
+    action = Remove( 'll' )
     file   = 'hello world'
 
     new_file = renamer.DoAction( action, file )
@@ -116,7 +142,7 @@ class TestDoAction( unittest.TestCase ):
 
 
   def test_replace( self ):
-    action = ( 'replace', 'll', '!!' )
+    action = Replace( 'll', '!!' )
     file   = 'hello world'
 
     new_file = renamer.DoAction( action, file )
@@ -124,13 +150,13 @@ class TestDoAction( unittest.TestCase ):
 
 
   def test_insert( self ):
-    action = ( 'insert', 1, 'HA' )
+    action = Insert( 1, 'HA' )
     file   = 'hello world'
 
     new_file = renamer.DoAction( action, file )
     self.assertEqual( 'hHAello world', new_file )
 
-    action = ( 'insert', -1, 'HA' )
+    action = Insert( -1, 'HA' )
     file   = 'hello world'
 
     new_file = renamer.DoAction( action, file )
@@ -138,7 +164,7 @@ class TestDoAction( unittest.TestCase ):
 
 
   def test_append( self ):
-    action = ( 'append', 'EOF' )
+    action = Append( 'EOF' )
     file   = 'hello world.ext'
 
     new_file = renamer.DoAction( action, file )
@@ -150,8 +176,8 @@ class TestGenerateRename( unittest.TestCase ):
   def test_order( self ):
     # should rename a-file.file to ile.file only if done in the correct order
     actions = [
-      ( 'remove', '-' ),
-      ( 'remove', 'af' ),
+      Remove( '-' ),
+      Remove( 'af' ),
     ]
     file = 'a-file.file'
     correct_rename = ( file, 'ile.file' )
@@ -163,8 +189,8 @@ class TestGenerateRename( unittest.TestCase ):
   def test_incomplete( self ):
     # should fail and return None because the second action can't be done
     actions = [
-      ( 'remove', '-' ),
-      ( 'remove', ' ' ),
+      Remove( '-' ),
+      Remove( ' ' ),
     ]
     file = 'a-file.file'
 
@@ -181,8 +207,8 @@ class TestGenerateRenames( unittest.TestCase ):
       'd file.file',
     ]
     actions = [
-      ( 'remove', '-' ),
-      ( 'remove', 'af'),
+      Remove( '-' ),
+      Remove( 'af'),
     ]
     correct_renames = [ ( 'a-file.file', 'ile.file' ) ]
 
@@ -191,6 +217,158 @@ class TestGenerateRenames( unittest.TestCase ):
     self.assertEqual( renames[0], correct_renames[0] )
 
 
+class TestFullPath( unittest.TestCase ):
+  FILES = [ 'shows/x 1/episode 1.mkv', 'shows/x 1/episode 2.mkv', 'episode 3.mkv' ]
+
+
+  def test_names( self ):
+    renames = renamer.GenerateRenames( [ Insert( 0, 'new ' ), Remove( ' [0-9]' ) ], self.FILES )
+
+    self.assertEqual( renames, [
+      ( 'shows/x 1/episode 1.mkv', 'shows/x 1/new episode.mkv' ),
+      ( 'episode 3.mkv', 'new episode.mkv' ),
+    ] )
+
+
+  def test_full_path( self ):
+    renames = renamer.GenerateRenames( [ Insert( 0, 'new ' ), Remove( ' [0-9]' ) ], self.FILES, full_path=True )
+
+    # the directory is changed too, so both episodes end up with the same name
+    self.assertEqual( renames, [
+      ( 'shows/x 1/episode 1.mkv', 'new shows/x/episode.mkv' ),
+      ( 'episode 3.mkv', 'new episode.mkv' ),
+    ] )
+
+
+  def test_empty_name( self ):
+    # the directory is left, but the file has no name
+    self.assertEqual( renamer.GenerateRenames( [ Remove( '.*' ) ], self.FILES ), [] )
+
+
+  def test_keywords_in_directory( self ):
+    # a directory that looks like it has a keyword in it isn't probed
+    files = [ 'x 50%res/a.mkv', 'x 50%res/b.mkv' ]
+
+    def Probe( file ):
+      raise AssertionError( "probed '{}'".format( file ) )
+
+    probe = keyword_replacer.Probe
+    keyword_replacer.Probe = Probe
+    try:
+      for jobs in [ 1, 2 ]:
+        self.assertEqual( renamer.GenerateRenames( [ Replace( 'a', 'c' ) ], files, jobs=jobs ),
+                          [ ( 'x 50%res/a.mkv', 'x 50%res/c.mkv' ) ] )
+
+      self.assertEqual( renamer.GenerateRename( [ Replace( 'a', 'c' ) ], files[0] ), ( 'x 50%res/a.mkv', 'x 50%res/c.mkv' ) )
+    finally:
+      keyword_replacer.Probe = probe
+
+
+  def test_table( self ):
+    self.assertEqual( fs.LastSeparator( 'shows/x 1/episode 1.mkv' ), 9 )
+    self.assertEqual( fs.LastSeparator( 'episode 1.mkv' ), -1 )
+
+    table = fs.DirectoryTable()
+
+    self.assertEqual( table.Split( 'shows/x 1/episode 1.mkv' ), ( 0, 'episode 1.mkv' ) )
+    self.assertEqual( table.Split( 'episode 3.mkv' ), ( 1, 'episode 3.mkv' ) )
+    self.assertEqual( table.Split( 'shows/x 1/episode 2.mkv' ), ( 0, 'episode 2.mkv' ) )
+    self.assertEqual( table.Join( 0, 'E2.mkv' ), 'shows/x 1/E2.mkv' )
+    self.assertEqual( table.Join( 1, 'E3.mkv' ), 'E3.mkv' )
+    self.assertEqual( table.paths, [ 'shows/x 1/', '' ] )
+
+    table.Clear()
+    self.assertEqual( table.Split( 'episode 3.mkv' ), ( 0, 'episode 3.mkv' ) )
+    self.assertEqual( table.paths, [ '' ] )
+
+
+class TestGenerateRenamesCollisions( unittest.TestCase ):
+  @classmethod
+  def setUpClass( cls ):
+    cls.files = [ 'collide one.file', 'collide two.file', 'collide.file' ]
+    CreateFiles( cls.files )
+
+
+  @classmethod
+  def tearDownClass( cls ):
+    for file in cls.files:
+      os.remove( file )
+
+
+  def test_existing( self ):
+    # 'collide one.file' -> 'collide.file' which is already there
+    actions = [ Remove( ' one' ) ]
+    index   = fs.DirectoryIndex()
+
+    renames = renamer.GenerateRenames( actions, self.files, index=index )
+    self.assertEqual( planner.ResolveRenames( renames, index ), [] )
+
+
+  def test_same_target( self ):
+    # both would become 'collide_.file', only the first one can
+    actions = [ Replace( ' (one|two)', '_' ) ]
+
+    renames = renamer.GenerateRenames( actions, self.files )
+    self.assertEqual( renames, [ ( 'collide one.file', 'collide_.file' ) ] )
+
+
+class TestPlanner( unittest.TestCase ):
+  def setUp( self ):
+    self.files = [ 'plan E1.file', 'plan E2.file', 'plan E3.file' ]
+    CreateFiles( self.files )
+
+    # remember which file is which by its contents
+    for file in self.files:
+      with open( file, 'w' ) as f:
+        f.write( file )
+
+
+  def tearDown( self ):
+    for file in self.files:
+      os.remove( file )
+
+
+  def Contents( self, file ):
+    with open( file ) as f:
+      return f.read()
+
+
+  def test_chain( self ):
+    # E1 -> E2, E2 -> E3 has to rename E2 first
+    index   = fs.DirectoryIndex()
+    renames = [ ( 'plan E1.file', 'plan E2.file' ), ( 'plan E2.file', 'plan E4.file' ) ]
+    renames = planner.ResolveRenames( renames, index )
+    self.assertEqual( len( renames ), 2 )
+
+    renamer.DoRenames( planner.OrderRenames( renames, index ) )
+    self.files = [ 'plan E2.file', 'plan E3.file', 'plan E4.file' ]
+    self.assertEqual( self.Contents( 'plan E2.file' ), 'plan E1.file' )
+    self.assertEqual( self.Contents( 'plan E4.file' ), 'plan E2.file' )
+
+
+  def test_chain_blocked( self ):
+    # E2 can't move onto E3, so E1 can't move onto E2
+    index   = fs.DirectoryIndex()
+    renames = [ ( 'plan E1.file', 'plan E2.file' ), ( 'plan E2.file', 'plan E3.file' ) ]
+    self.assertEqual( planner.ResolveRenames( renames, index ), [] )
+
+
+  def test_rotate( self ):
+    index   = fs.DirectoryIndex()
+    renames = [
+      ( 'plan E1.file', 'plan E2.file' ),
+      ( 'plan E2.file', 'plan E3.file' ),
+      ( 'plan E3.file', 'plan E1.file' ),
+    ]
+    renames = planner.ResolveRenames( renames, index )
+    self.assertEqual( len( renames ), 3 )
+
+    renamer.DoRenames( planner.OrderRenames( renames, index ) )
+    self.assertEqual( self.Contents( 'plan E1.file' ), 'plan E3.file' )
+    self.assertEqual( self.Contents( 'plan E2.file' ), 'plan E1.file' )
+    self.assertEqual( self.Contents( 'plan E3.file' ), 'plan E2.file' )
+
+
 class TestFilterRenames( unittest.TestCase ):
   def test_( self ):
     renames = [
@@ -206,6 +384,1320 @@ class TestFilterRenames( unittest.TestCase ):
 
     self.assertEqual( renames, correct_renames )
 
+  def test_several( self ):
+    renames = [
+      ( 'abc name 01.file', 'name E01.file' ),
+      ( 'abc name 02.file', 'name 02.file' ),
+      ( 'abc name 03.srt', 'name 03.srt' ),
+    ]
+    result_re = [ 'name E[0-9]{2}.file', r'.*\.srt$' ]
+
+    renames = renamer.FilterRenames( renames, result_re )
+    correct_renames = [
+      ( 'abc name 01.file', 'name E01.file' ),
+      ( 'abc name 03.srt', 'name 03.srt' ),
+    ]
+
+    self.assertEqual( renames, correct_renames )
+
+
+class TestJournal( unittest.TestCase ):
+  def setUp( self ):
+    self.dir = tempfile.TemporaryDirectory()
+    self.journal = os.path.join( self.dir.name, 'renames.journal' )
+
+    for name in [ 'E1', 'E2' ]:
+      with open( os.path.join( self.dir.name, name ), 'w' ) as f:
+        f.write( name )
+
+
+  def tearDown( self ):
+    self.dir.cleanup()
+
+
+  def Contents( self ):
+    contents = {}
+    for name in os.listdir( self.dir.name ):
+      if name.startswith( 'E' ):
+        with open( os.path.join( self.dir.name, name ) ) as f:
+          contents[name] = f.read()
+
+    return contents
+
+
+  def test_resume_and_undo( self ):
+    record = journal.Journal( self.journal, cwd=self.dir.name )
+    record.Plan( [ ( 'E2', 'E3' ), ( 'E1', 'E2' ) ] )
+
+    # stopped after the first rename, before its record was written
+    os.rename( os.path.join( self.dir.name, 'E2' ), os.path.join( self.dir.name, 'E3' ) )
+    record.Close( complete=False )
+
+    self.assertEqual( journal.Resume( self.journal ), 1 )
+    self.assertEqual( self.Contents(), { 'E2': 'E1', 'E3': 'E2' } )
+    self.assertTrue( journal.Status( self.journal )[3] )
+
+    self.assertEqual( journal.Undo( self.journal ), 2 )
+    self.assertEqual( self.Contents(), { 'E1': 'E1', 'E2': 'E2' } )
+
+
+  def test_resume_out_of_order( self ):
+    record = journal.Journal( self.journal, cwd=self.dir.name )
+    record.Plan( [ ( 'E1', 'E3' ), ( 'E2', 'E4' ) ] )
+
+    # done on another thread before the first rename
+    os.rename( os.path.join( self.dir.name, 'E2' ), os.path.join( self.dir.name, 'E4' ) )
+    record.Done( 1 )
+    record.Close( complete=False )
+
+    self.assertEqual( list( journal.Status( self.journal )[2] ), [ 1 ] )
+    self.assertEqual( journal.Resume( self.journal ), 1 )
+    self.assertEqual( self.Contents(), { 'E3': 'E1', 'E4': 'E2' } )
+
+
+  def test_resume_taken( self ):
+    record = journal.Journal( self.journal, cwd=self.dir.name )
+    record.Plan( [ ( 'E1', 'E3' ) ] )
+    record.Close( complete=False )
+
+    # a file shows up at E3 after it was checked, it isn't replaced
+    rename = executor.Executor.Rename
+    def Rename( renamer, old, new ):
+      CreateFile( new )
+      return rename( renamer, old, new )
+
+    executor.Executor.Rename = Rename
+    try:
+      self.assertEqual( journal.Resume( self.journal ), 0 )
+    finally:
+      executor.Executor.Rename = rename
+
+    self.assertEqual( self.Contents(), { 'E1': 'E1', 'E2': 'E2', 'E3': '' } )
+
+
+  def test_resume_overwrite( self ):
+    record = journal.Journal( self.journal, overwrite=True, cwd=self.dir.name )
+    record.Plan( [ ( 'E1', 'E2' ) ] )
+    record.Close( complete=False )
+
+    self.assertEqual( journal.Resume( self.journal ), 1 )
+    self.assertEqual( self.Contents(), { 'E2': 'E1' } )
+
+
+class TestRenameRuleSet( unittest.TestCase ):
+  def setUp( self ):
+    self.dir = tempfile.TemporaryDirectory()
+    CreateFiles( [ os.path.join( self.dir.name, name ) for name in
+      [ 'show ep 1.mkv', 'show ep 2.mkv', 'show ep 3.mkv', 'show E3.mkv', 'notes.txt' ] ] )
+
+    self.rules = ruleset.RenameRuleSet(
+      [ 'r:ep ([0-9]+):E\\1', Replace( 'E2', 'E1' ) ], filter_re=r'.*\.mkv$', partial=True )
+
+
+  def tearDown( self ):
+    self.dir.cleanup()
+
+
+  def Path( self, name ):
+    return os.path.join( self.dir.name, name )
+
+
+  def test_plan_and_apply( self ):
+    plan = self.rules.plan( sorted( self.Path( name ) for name in os.listdir( self.dir.name ) ) )
+
+    self.assertEqual( plan.renames, [ ( self.Path( 'show ep 1.mkv' ), self.Path( 'show E1.mkv' ) ) ] )
+    self.assertEqual( sorted( plan.drops ), [
+      ruleset.Drop( self.Path( 'show E3.mkv' ), self.Path( 'show E3.mkv' ), ruleset.UNCHANGED ),
+      ruleset.Drop( self.Path( 'show ep 2.mkv' ), self.Path( 'show E1.mkv' ), ruleset.DUPLICATE ),
+      ruleset.Drop( self.Path( 'show ep 3.mkv' ), self.Path( 'show E3.mkv' ), ruleset.DUPLICATE ),
+    ] )
+    self.assertEqual( plan.overwrite, [] )
+
+    # a file that isn't being renamed is in the way
+    CreateFile( self.Path( 'show E1.mkv' ) )
+    self.assertEqual( self.rules.plan( [ self.Path( 'show ep 1.mkv' ) ] ).drops, [
+      ruleset.Drop( self.Path( 'show ep 1.mkv' ), self.Path( 'show E1.mkv' ), ruleset.EXISTS ) ] )
+    os.remove( self.Path( 'show E1.mkv' ) )
+
+    applied = self.rules.apply( plan )
+    self.assertEqual( applied, ruleset.Applied( plan.renames, None, [] ) )
+    self.assertTrue( os.path.exists( self.Path( 'show E1.mkv' ) ) )
+
+
+  def test_apply_error( self ):
+    plan = self.rules.plan( [ self.dir.name ] )
+    os.remove( self.Path( 'show ep 1.mkv' ) )
+
+    applied = self.rules.apply( plan )
+    self.assertEqual( applied.done, [] )
+    self.assertEqual( applied.error[0], plan.renames[0] )
+    self.assertIsInstance( applied.error[1], FileNotFoundError )
+
+
+class TestFilter( unittest.TestCase ):
+  NAMES = [
+    'shows/dexter/E01.mkv',
+    'shows/dexter/E01.srt',
+    'shows/other/E01.mkv',
+    'movies/a sample.mkv',
+    'music/song.mp3',
+    'music/song.mp3\n',
+    'EXACT',
+  ]
+
+  def Check( self, patterns ):
+    # must agree with re.match on every name
+    expected = [ n for n in self.NAMES if any( re.match( p, n ) for p in patterns ) ]
+    self.assertEqual( expected, list( filters.Filter( patterns ).filter( self.NAMES ) ), patterns )
+
+  def test_shapes( self ):
+    self.assertEqual( ( 'prefix', 'shows/' ), filters._Shape( '^shows/' ) )
+    self.assertEqual( ( 'prefix', 'shows/' ), filters._Shape( 'shows/.*' ) )
+    self.assertEqual( ( 'suffix', '.mkv' ), filters._Shape( r'.*\.mkv$' ) )
+    self.assertEqual( ( 'contains', 'sample' ), filters._Shape( '.*sample' ) )
+    self.assertEqual( ( 'equal', 'EXACT' ), filters._Shape( 'EXACT$' ) )
+    self.assertIsNone( filters._Shape( r'.*\.mkv?' ) )
+    self.assertIsNone( filters._Shape( r'E\d+' ) )
+
+  def test_same_as_re( self ):
+    self.Check( [ '^shows/' ] )
+    self.Check( [ r'.*\.mkv$', r'.*\.mp3$' ] )
+    self.Check( [ '.*sample', 'EXACT$' ] )
+    self.Check( [ r'.*E[0-9]+\.srt', 'music/.*' ] )
+    self.Check( [ r'shows/(\w+)/.*\1', r'(?P<a>m)' ] )
+    self.Check( [ 'music/song.mp3$' ] )
+
+  def test_literal_prefix( self ):
+    self.assertEqual( 'shows/dexter/', filters.LiteralPrefix( '^shows/dexter/.*' ) )
+    self.assertEqual( 'shows/dexter', filters.LiteralPrefix( 'shows/dextera*' ) )
+    self.assertEqual( 'shows/dextera', filters.LiteralPrefix( 'shows/dextera+' ) )
+    self.assertEqual( '', filters.LiteralPrefix( 'shows|movies' ) )
+    self.assertEqual( '', filters.LiteralPrefix( r'\w+' ) )
+
+
+class TestWalkFiles(unittest.TestCase):
+  def test_recursive(self):
+    # Assert that there are more than 5 files in the parent directory.
+    # This is used to ensure that recursive mode is actually traversing directories.
+    self.assertTrue(len(list(fs.GetFiles("../tests", recursive=True))) > len(list(fs.GetFiles("../tests", recursive=False))))
+
+  def test_recursive_nested(self):
+    # the recursive walk used to drop the recursive argument; make sure nested
+    # directories are still walked all the way down
+    files = list(fs.GetFiles("../tests", recursive=True))
+    self.assertIn(os.path.join("../tests", "sub_directory", "empty_file_5"), files)
+
+  def test_current_directory(self):
+    # files in '.' have never had a './' in front of them
+    files = list(fs.WalkDirectory(".", recursive=False))
+    self.assertIn("fs.py", files)
+
+  def test_jobs_order(self):
+    # reading directories at the same time mustn't change the order files come out in
+    serial = list(fs.GetFiles("../tests", recursive=True))
+    self.assertEqual(serial, list(fs.GetFiles("../tests", recursive=True, jobs=4)))
+
+  def test_filter_prunes(self):
+    # sub_directory can't have files starting with '../tests/empty' in it
+    walked = []
+    descend = fs.DirectoryFilter(r"\.\./tests/empty_file_[12]")
+    files = list(fs.WalkDirectory("../tests", descend=lambda d: walked.append(d) or descend(d)))
+
+    self.assertEqual(walked, [os.path.join("../tests", "sub_directory")])
+    self.assertNotIn(os.path.join("../tests", "sub_directory", "empty_file_1"), files)
+    self.assertEqual(
+      sorted(fs.GetFiles("../tests", filter_re=r"\.\./tests/empty_file_[12]", recursive=True)),
+      ["../tests/empty_file_1", "../tests/empty_file_2"])
+
+  def test_filter_walks_into(self):
+    self.assertIsNone(fs.DirectoryFilter(["../tests", "nothing"]))
+    files = list(fs.GetFiles("../tests", filter_re=[r"\.\./tests/sub_directory/empty_file_5", "nothing"], recursive=True))
+    self.assertEqual(files, [os.path.join("../tests", "sub_directory", "empty_file_5")])
+
+  def test_prune(self):
+    files = list(fs.GetFiles("../tests", recursive=True, prune_re=".*/sub_directory$"))
+    self.assertTrue(len(files) > 0)
+    self.assertFalse(any("sub_directory" in file for file in files))
+
+
+class TestWalkChanges(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.TemporaryDirectory()
+    self.root = self.dir.name
+    os.mkdir(os.path.join(self.root, "sub"))
+    open(os.path.join(self.root, "a"), "w").close()
+    open(os.path.join(self.root, "sub", "b"), "w").close()
+    self.Age(100)
+
+    self.state_dir = tempfile.TemporaryDirectory()
+    self.state = scan_state.ScanState(os.path.join(self.state_dir.name, "state.sqlite"))
+
+  def tearDown(self):
+    self.state.Close()
+    self.state_dir.cleanup()
+    self.dir.cleanup()
+
+  def Age(self, seconds):
+    # changes made just now aren't trusted, make them look old
+    then = time.time() - seconds
+    for directory in [self.root, os.path.join(self.root, "sub")]:
+      os.utime(directory, (then, then))
+
+  def Walk(self):
+    return sorted(fs.WalkChanges(self.root, self.state))
+
+  def test_only_new(self):
+    self.assertEqual(self.Walk(), [os.path.join(self.root, "a"), os.path.join(self.root, "sub", "b")])
+    self.assertEqual(self.Walk(), [])
+
+    open(os.path.join(self.root, "sub", "c"), "w").close()
+    self.Age(50)
+    self.assertEqual(self.Walk(), [os.path.join(self.root, "sub", "c")])
+
+  def test_racy(self):
+    self.Age(0)
+    mtime = os.stat(self.root).st_mtime_ns
+    self.assertEqual(len(self.Walk()), 2)
+
+    # a change in the same tick of the clock doesn't change the time, so a
+    # directory changed just before the walk is listed again next time
+    open(os.path.join(self.root, "d"), "w").close()
+    os.utime(self.root, ns=(mtime, mtime))
+    self.assertEqual(self.Walk(), [os.path.join(self.root, "d")])
+
+
+class TestDirectoryIndex(unittest.TestCase):
+  def test_walked(self):
+    index = fs.DirectoryIndex()
+    files = list(fs.GetFiles("../tests", recursive=True, index=index))
+
+    for file in files:
+      self.assertTrue(index.Exists(file))
+    self.assertTrue(index.Exists("../tests/sub_directory"))
+    self.assertFalse(index.Exists("../tests/sub_directory/not_a_file"))
+
+  def test_not_walked(self):
+    index = fs.DirectoryIndex()
+    self.assertTrue(index.Exists("../tests/empty_file_1"))
+    self.assertTrue(index.Exists("./fs.py"))
+    self.assertFalse(index.Exists("../not_a_directory/empty_file_1"))
+
+  def test_planned(self):
+    index = fs.DirectoryIndex()
+    self.assertFalse(index.Exists("../tests/new_file"))
+    index.Plan("../tests/new_file")
+    self.assertFalse(index.Exists("../tests/new_file"))
+    self.assertTrue(index.Planned("../tests/./new_file"))
+
+  def test_max_dirs(self):
+    index = fs.DirectoryIndex(max_dirs=1)
+    index.Plan("../tests/new_file")
+    self.assertTrue(index.Exists("../tests/empty_file_1"))
+    self.assertTrue(index.Exists("./fs.py"))
+
+    # ../tests was forgotten, but not what was planned for it
+    self.assertEqual(list(index.dirs), ["."])
+    self.assertTrue(index.Planned("../tests/new_file"))
+
+  def test_moved(self):
+    index = fs.DirectoryIndex()
+    index.Moved("../tests/empty_file_1", "../tests/sub_directory/moved")
+    self.assertFalse(index.Exists("../tests/empty_file_1"))
+    self.assertTrue(index.Exists("../tests/sub_directory/moved"))
+
+
+class TestCheckRenames( unittest.TestCase ):
+  def setUp( self ):
+    self.dir = tempfile.TemporaryDirectory()
+    self.a, self.b, self.c = [ os.path.join( self.dir.name, name ) for name in [ 'a', 'b', 'c' ] ]
+    CreateFiles( [ self.a, self.b ] )
+
+
+  def tearDown( self ):
+    self.dir.cleanup()
+
+
+  def Check( self, renames, overwrite=False ):
+    return list( planner.CheckRenames( renames, fs.DirectoryIndex(), overwrite=overwrite ) )
+
+
+  def test_taken( self ):
+    self.assertEqual( self.Check( [ ( self.a, self.b ) ] ), [] )
+    self.assertEqual( self.Check( [ ( self.a, self.b ) ], overwrite=True ), [ ( self.a, self.b ) ] )
+
+
+  def test_freed( self ):
+    # b is moved out of the way first, so a can have its name
+    renames = [ ( self.b, self.c ), ( self.a, self.b ) ]
+    self.assertEqual( self.Check( renames ), renames )
+
+    # but not the other way around, or to a name that was just taken
+    self.assertEqual( self.Check( [ ( self.a, self.b ), ( self.b, self.c ) ] ), [ ( self.b, self.c ) ] )
+    self.assertEqual( self.Check( [ ( self.a, self.c ), ( self.b, self.c ) ] ), [ ( self.a, self.c ) ] )
+
+
+  def test_same_name( self ):
+    self.assertEqual( self.Check( [ ( self.a, os.path.join( self.dir.name, '.', 'a' ) ) ] ), [] )
+
+
+class TestStreamRenames( unittest.TestCase ):
+  def setUp( self ):
+    self.dir = tempfile.TemporaryDirectory()
+    for d in [ 'D', 'E' ]:
+      os.mkdir( os.path.join( self.dir.name, d ) )
+
+    self.files = [ os.path.join( self.dir.name, *name ) for name in [ ( 'D', 'a1' ), ( 'E', 'x1' ), ( 'D', 'a2' ) ] ]
+    for file, contents in zip( self.files, [ 'one', 'x', 'two' ] ):
+      with open( file, 'w' ) as f:
+        f.write( contents )
+
+    self.actions = [ Remove( '[0-9]$' ) ]
+
+
+  def tearDown( self ):
+    self.dir.cleanup()
+
+
+  def Stream( self, dryrun, overwrite=False, max_dirs=None ):
+    self.index = fs.DirectoryIndex( max_dirs=max_dirs )
+    stdout     = io.StringIO()
+
+    with contextlib.redirect_stdout( stdout ):
+      renamer.StreamRenames( self.actions, self.files, self.index, overwrite=overwrite, dryrun=dryrun )
+
+    return stdout.getvalue().splitlines()
+
+
+  def test_renamed( self ):
+    self.assertEqual( self.Stream( dryrun=False ), [] )
+
+    with open( os.path.join( self.dir.name, 'D', 'a' ) ) as f:
+      self.assertEqual( f.read(), 'one' )
+    self.assertTrue( os.path.exists( os.path.join( self.dir.name, 'E', 'x' ) ) )
+    self.assertTrue( os.path.exists( self.files[2] ) )
+
+
+  def test_dry_run( self ):
+    lines = self.Stream( dryrun=True, max_dirs=1 )
+
+    self.assertEqual( lines, [
+      '{} -> {}'.format( self.files[0], os.path.join( self.dir.name, 'D', 'a' ) ),
+      '{} -> {}'.format( self.files[1], os.path.join( self.dir.name, 'E', 'x' ) ),
+    ] )
+    self.assertTrue( all( os.path.exists( file ) for file in self.files ) )
+
+
+  def test_forgotten_overwrite( self ):
+    # D is forgotten while E is renamed in, a2 still can't overwrite what a1 became
+    self.Stream( dryrun=False, overwrite=True, max_dirs=1 )
+
+    with open( os.path.join( self.dir.name, 'D', 'a' ) ) as f:
+      self.assertEqual( f.read(), 'one' )
+    self.assertTrue( os.path.exists( self.files[2] ) )
+
+
+  def test_planned_forgotten( self ):
+    # the done renames are on disk, a2 is still dropped once D is forgotten
+    self.Stream( dryrun=False, max_dirs=1 )
+
+    self.assertEqual( self.index.planned, {} )
+    self.assertTrue( os.path.exists( self.files[2] ) )
+
+    # a dry run can only check against the names it planned
+    self.Stream( dryrun=True )
+    self.assertEqual( self.index.planned, {} )
+
+    self.files = [ os.path.join( self.dir.name, 'D', name ) for name in [ 'a2', 'b1' ] ]
+    self.Stream( dryrun=True )
+    self.assertEqual( self.index.planned, { os.path.join( self.dir.name, 'D' ): { 'b' } } )
+
+
+class TestFilterFiles(unittest.TestCase):
+  def test_filter(self):
+    files = [
+      'file_one.jpeg',
+      'file_two.jpeg',
+      'file_three.jpg',
+      ]
+    self.assertTrue(len(list(fs.FilterFiles(files, '[a-z_]+\.jpeg'))) == 2)
+
+
+class TestSongTitle(unittest.TestCase):
+  SONG_TITLE_FILE = "tests/test_song.mp3"
+
+  @classmethod
+  def setUpClass(cls):
+    if not os.path.exists(cls.SONG_TITLE_FILE):
+      raise Exception(f"Missing test file '{cls.SONG_TITLE_FILE}'")
+
+  def test_song_title(self):
+    res = keyword_replacer.SongTitle(keyword_replacer.Probe(self.SONG_TITLE_FILE))
+    self.assertEqual("Example Title", res)
+
+
+class TestParseProbe(unittest.TestCase):
+  PROBE = {
+    'streams': [
+      { 'codec_type': 'video', 'codec_name': 'h264', 'width': 1920, 'height': 1080 },
+      { 'codec_type': 'audio', 'codec_name': 'aac', 'tags': { 'TITLE': 'Stream Title' } },
+    ],
+    'format': {
+      'duration': '3723.500000',
+      'bit_rate': '1500123',
+      'tags': { 'title': 'Example Title/Part 2' },
+    },
+  }
+
+  def test_keywords(self):
+    record = keyword_replacer.ParseProbe(self.PROBE)
+    self.assertEqual('1920x1080', keyword_replacer.VideoResolution(record))
+    self.assertEqual('Example Title', keyword_replacer.SongTitle(record))
+    self.assertEqual('h264', keyword_replacer.Codec(record))
+    self.assertEqual('1h02m03s', keyword_replacer.Duration(record))
+    self.assertEqual('1500kbps', keyword_replacer.BitRate(record))
+
+  def test_missing(self):
+    record = keyword_replacer.ParseProbe({ 'streams': [ { 'codec_type': 'audio', 'codec_name': 'mp3' } ] })
+    self.assertIsNone(keyword_replacer.VideoResolution(record))
+    self.assertEqual('', keyword_replacer.SongTitle(record))
+    self.assertEqual('mp3', keyword_replacer.Codec(record))
+    self.assertIsNone(keyword_replacer.Duration(record))
+
+
+class TestMetadataCache( unittest.TestCase ):
+  def setUp( self ):
+    self.dir  = tempfile.TemporaryDirectory()
+    self.file = os.path.join( self.dir.name, 'video.mkv' )
+    with open( self.file, 'w' ) as f:
+      f.write( 'video' )
+
+    self.cache = metadata_cache.MetadataCache( os.path.join( self.dir.name, 'cache.sqlite' ) )
+
+  def tearDown( self ):
+    self.cache.Close()
+    self.dir.cleanup()
+
+  def test_stored( self ):
+    self.assertEqual( ( False, None ), self.cache.Get( self.file ) )
+    self.cache.Put( self.file, { 'width': 1920 } )
+    self.assertEqual( ( True, { 'width': 1920 } ), self.cache.Get( self.file ) )
+
+    # None is a real record, the file couldn't be probed
+    self.cache.Put( self.file, None )
+    self.assertEqual( ( True, None ), self.cache.Get( self.file ) )
+
+  def test_changed_file( self ):
+    self.cache.Put( self.file, { 'width': 1920 } )
+
+    with open( self.file, 'a' ) as f:
+      f.write( ' and more video' )
+
+    self.assertEqual( ( False, None ), self.cache.Get( self.file ) )
+
+  def test_other_tables( self ):
+    # the cache can be any sqlite file, nothing else in it is touched
+    import sqlite3
+    path = os.path.join( self.dir.name, 'other.sqlite' )
+    db   = sqlite3.connect( path )
+    db.execute( "CREATE TABLE files ( name TEXT )" )
+    db.execute( "INSERT INTO files VALUES ( 'kept' )" )
+    db.commit()
+    db.close()
+
+    cache = metadata_cache.MetadataCache( path )
+    cache.Put( self.file, { 'width': 1920 } )
+    self.assertEqual( ( True, { 'width': 1920 } ), cache.Get( self.file ) )
+    self.assertEqual( [ ( 'kept', ) ], cache.db.execute( "SELECT name FROM files" ).fetchall() )
+    cache.Close()
+
+  def test_refresh( self ):
+    self.cache.Put( self.file, { 'width': 1920 } )
+    self.cache.refresh = True
+    self.assertEqual( ( False, None ), self.cache.Get( self.file ) )
+
+  def test_evict( self ):
+    self.cache.max_entries = 2
+    for i in range( 4 ):
+      path = os.path.join( self.dir.name, str( i ) )
+      open( path, 'w' ).close()
+      self.cache.Put( path, { 'width': i } )
+
+    self.cache.Commit()
+    self.cache.Evict()
+    count = self.cache.db.execute( "SELECT COUNT(*) FROM probes" ).fetchone()[0]
+    self.assertEqual( 2, count )
+
+
+class TestProbeFiles( unittest.TestCase ):
+  def setUp( self ):
+    self.dir   = tempfile.TemporaryDirectory()
+    self.files = [ os.path.join( self.dir.name, 'E{}.mkv'.format( i ) ) for i in range( 10 ) ]
+    CreateFiles( self.files )
+
+    # E3 can't be probed
+    self.probed = []
+    def Probe( path ):
+      self.probed.append( path )
+      if path.endswith( 'E3.mkv' ):
+        return None
+
+      width = int( os.path.basename( path )[1:-4] )
+      return keyword_replacer.ProbeRecord( width, 1, None, None, None, None, None )
+
+    self.probe       = keyword_replacer.Probe
+    self.probe_batch = renamer.PROBE_BATCH
+    keyword_replacer.Probe = Probe
+    keyword_replacer.cache = metadata_cache.MetadataCache( os.path.join( self.dir.name, 'cache.sqlite' ) )
+
+    # the files are probed a few at a time
+    renamer.PROBE_BATCH = 2
+
+  def tearDown( self ):
+    keyword_replacer.cache.Close()
+    keyword_replacer.cache = None
+    keyword_replacer.Probe = self.probe
+    renamer.PROBE_BATCH    = self.probe_batch
+    self.dir.cleanup()
+
+  def Expected( self ):
+    return [
+      ( file, os.path.join( self.dir.name, '{}x1.mkv'.format( i ) ) )
+      for i, file in enumerate( self.files ) if i != 3
+    ]
+
+  def test_jobs( self ):
+    actions = [ Replace( '^E[0-9]*', '%res' ) ]
+
+    for jobs in [ 1, 2, 4 ]:
+      self.probed = []
+      keyword_replacer.cache.refresh = True
+
+      # the renames are in the same order as the files, and each file is probed once
+      self.assertEqual( renamer.GenerateRenames( actions, self.files, jobs=jobs ), self.Expected() )
+      self.assertEqual( sorted( self.probed ), sorted( self.files ) )
+
+  def test_cached( self ):
+    actions = [ Replace( '^E[0-9]*', '%res' ) ]
+    self.assertEqual( renamer.GenerateRenames( actions, self.files[:4], jobs=2 ), self.Expected()[:3] )
+
+    # only the files that weren't probed before are probed
+    self.probed = []
+    self.assertEqual( renamer.GenerateRenames( actions, self.files, jobs=2 ), self.Expected() )
+    self.assertEqual( sorted( self.probed ), sorted( self.files[4:] ) )
+
+    self.probed = []
+    records = keyword_replacer.ProbeFiles( self.files, jobs=2 )
+    self.assertEqual( self.probed, [] )
+    self.assertIsNone( records[ self.files[3] ] )
+    self.assertEqual( records[ self.files[5] ].width, 5 )
+
+
+class TestScanState( unittest.TestCase ):
+  def setUp( self ):
+    self.dir   = tempfile.TemporaryDirectory()
+    self.state = scan_state.ScanState( os.path.join( self.dir.name, 'state.sqlite' ) )
+
+  def tearDown( self ):
+    self.state.Close()
+    self.dir.cleanup()
+
+  def test_stored( self ):
+    self.assertIsNone( self.state.Get( 'a' ) )
+    self.state.Put( 'a', 5 * 10**9, [ ( 'file', 'b' ) ], now=100 )
+    self.assertEqual( ( 5 * 10**9, [ ( 'file', 'b' ) ] ), self.state.Get( 'a' ) )
+
+  def test_racy( self ):
+    self.state.Put( 'a', 99 * 10**9, [], now=100 )
+    self.assertEqual( ( None, [] ), self.state.Get( 'a' ) )
+
+  def test_forget( self ):
+    for directory in [ 'a', 'a/b', 'a/b/c', 'a0', 'ab' ]:
+      self.state.Put( directory, 0, [], now=100 )
+
+    self.state.Forget( 'a' )
+    self.assertIsNone( self.state.Get( 'a' ) )
+    self.assertIsNone( self.state.Get( 'a/b/c' ) )
+    self.assertIsNotNone( self.state.Get( 'a0' ) )
+    self.assertIsNotNone( self.state.Get( 'ab' ) )
+
+  def test_moved( self ):
+    self.state.Put( 'a', 0, [ ( 'file', 'b' ), ( 'link', 'c' ) ], now=100 )
+    self.state.Moved( 'a/b', 'a/d' )
+    self.state.Moved( 'a/c', 'a/b' )
+    self.state.Close()
+
+    self.state = scan_state.ScanState( self.state.path )
+    self.assertEqual( ( 0, [ ( 'file', 'd' ), ( 'link', 'b' ) ] ), self.state.Get( 'a' ) )
+
+
+class TestSorted( unittest.TestCase ):
+  def test_chunks( self ):
+    items = [ ( str( i % 7 ), str( i ) ) for i in range( 50 ) ]
+    self.assertEqual( sorted( items ), list( external_sort.Sorted( items, chunk_size=8 ) ) )
+
+  def test_in_memory( self ):
+    items = [ ( 'b', 'c' ), ( 'a', 'b' ) ]
+    self.assertEqual( sorted( items ), list( external_sort.Sorted( items ) ) )
+
+
+@unittest.skipUnless( sys.platform.startswith( 'linux' ), "inotify is only on Linux" )
+class TestWatcher( unittest.TestCase ):
+  def setUp( self ):
+    self.dir = tempfile.TemporaryDirectory()
+    self.watcher = watch.Watcher( [ self.dir.name ], recursive=True )
+
+  def tearDown( self ):
+    self.watcher.Close()
+    self.dir.cleanup()
+
+  def Create( self, *names ):
+    path = os.path.join( self.dir.name, *names )
+    with open( path, 'w' ) as f:
+      f.write( 'episode' )
+    return path
+
+  def test_arrived( self ):
+    a = self.Create( 'a.mkv' )
+    b = self.Create( 'b.mkv' )
+    self.assertEqual( [ a, b ], self.watcher.Wait( timeout=5 ) )
+    self.assertEqual( [], self.watcher.Wait( timeout=0.1 ) )
+
+  def test_ignored( self ):
+    a = self.Create( 'a.mkv' )
+    self.assertEqual( [ a ], self.watcher.Wait( timeout=5 ) )
+
+    renamed = os.path.join( self.dir.name, 'E01.mkv' )
+    self.watcher.Ignore( [ renamed ] )
+    os.rename( a, renamed )
+    b = self.Create( 'b.mkv' )
+    self.assertEqual( [ b ], self.watcher.Wait( timeout=5 ) )
+
+  def test_new_directory( self ):
+    os.mkdir( os.path.join( self.dir.name, 'season 1' ) )
+    a = self.Create( 'season 1', 'a.mkv' )
+    self.assertEqual( [ a ], self.watcher.Wait( timeout=5 ) )
+
+  def test_cache_committed( self ):
+    # the probes are written out after each batch, a watch is only stopped by killing it
+    a = self.Create( 'a.mkv' )
+
+    def Probe( path ):
+      return keyword_replacer.ProbeRecord( 1920, 1080, None, None, None, None, None )
+
+    def Watch( paths, handle, recursive=False ):
+      self.assertEqual( handle( [ a ] ), [ os.path.join( self.dir.name, 'a 1920x1080.mkv' ) ] )
+
+    path  = os.path.join( self.dir.name, 'cache.sqlite' )
+    probe = keyword_replacer.Probe
+    keyword_replacer.Probe = Probe
+    keyword_replacer.cache = metadata_cache.MetadataCache( path )
+    watch_files = watch.Watch
+    watch.Watch = Watch
+    try:
+      renamer.WatchRenames( [ Replace( '\\.mkv$', ' %res.mkv' ) ], [ self.dir.name ], dryrun=False )
+
+      self.assertEqual( keyword_replacer.cache.changes, 0 )
+    finally:
+      keyword_replacer.cache.Close()
+      keyword_replacer.cache = None
+      keyword_replacer.Probe = probe
+      watch.Watch = watch_files
+
+
+class TestExecutor( unittest.TestCase ):
+  def setUp( self ):
+    self.dir = tempfile.TemporaryDirectory()
+    os.mkdir( self.Path( 'sub' ) )
+    for name in [ 'a', 'b', os.path.join( 'sub', 'c' ) ]:
+      with open( self.Path( name ), 'w' ) as f:
+        f.write( name )
+
+
+  def tearDown( self ):
+    executor._renameat2 = None
+    self.dir.cleanup()
+
+
+  def Path( self, name ):
+    return os.path.join( self.dir.name, name )
+
+
+  def Read( self, name ):
+    with open( self.Path( name ) ) as f:
+      return f.read()
+
+
+  def Check( self ):
+    renamer = executor.Executor()
+    try:
+      renamer.Rename( self.Path( 'a' ), self.Path( os.path.join( 'sub', 'a2' ) ) )
+      self.assertEqual( 'a', self.Read( os.path.join( 'sub', 'a2' ) ) )
+
+      # never replaces a file, even one that wasn't there when planning
+      with self.assertRaises( FileExistsError ):
+        renamer.Rename( self.Path( 'b' ), self.Path( os.path.join( 'sub', 'c' ) ) )
+      self.assertEqual( 'b', self.Read( 'b' ) )
+      self.assertEqual( os.path.join( 'sub', 'c' ), self.Read( os.path.join( 'sub', 'c' ) ) )
+
+    finally:
+      renamer.Close()
+
+
+  def test_no_replace( self ):
+    self.Check()
+
+
+  def test_no_renameat2( self ):
+    executor._renameat2 = False
+    self.Check()
+
+
+  def test_overwrite( self ):
+    renamer = executor.Executor( overwrite=True )
+    renamer.Rename( self.Path( 'b' ), self.Path( 'a' ) )
+    renamer.Close()
+
+    self.assertEqual( 'b', self.Read( 'a' ) )
+    self.assertFalse( os.path.exists( self.Path( 'b' ) ) )
+
+
+class TestJournalDone( unittest.TestCase ):
+  def test_done( self ):
+    done = journal.Done( 20 )
+    self.assertEqual( len( done.bits ), 3 )
+
+    for n in [ 19, 0, 9 ]:
+      done.add( n )
+
+    self.assertEqual( list( done ), [ 0, 9, 19 ] )
+    self.assertIn( 9, done )
+    self.assertNotIn( 10, done )
+    self.assertNotIn( 100, done )
+
+    # past what was planned
+    done.add( 100 )
+    self.assertIn( 100, done )
+
+
+class TestShards( unittest.TestCase ):
+  def setUp( self ):
+    self.dir = tempfile.TemporaryDirectory()
+    for d in [ 'x', 'y', 'z' ]:
+      os.mkdir( os.path.join( self.dir.name, d ) )
+
+    self.names = []
+    for d in [ 'x', 'y', 'z' ]:
+      for i in range( 20 ):
+        self.names.append( os.path.join( self.dir.name, d, str( i ) ) )
+    CreateFiles( self.names )
+
+
+  def tearDown( self ):
+    self.dir.cleanup()
+
+
+  def test_shards( self ):
+    renames = [
+      ( 'x/1', 'x/2' ),
+      ( 'y/1', 'y/2' ),
+      ( 'x/0', 'x/1' ),
+      ( 'z/1', 'y/1' ),
+      ( 'w/1', 'w/2' ),
+    ]
+
+    # y and z are linked by a move between them
+    self.assertEqual( executor.Shards( renames ), [
+      [ ( 0, renames[0] ), ( 2, renames[2] ) ],
+      [ ( 1, renames[1] ), ( 3, renames[3] ) ],
+      [ ( 4, renames[4] ) ],
+    ] )
+
+
+  def test_parallel_chains( self ):
+    # every file moves up one, which only works if each directory is done in order
+    renames = []
+    for d in [ 'x', 'y', 'z' ]:
+      for i in reversed( range( 20 ) ):
+        renames.append( ( os.path.join( self.dir.name, d, str( i ) ), os.path.join( self.dir.name, d, str( i + 1 ) ) ) )
+
+    self.assertEqual( renamer.DoRenames( renames, jobs=3 ), 60 )
+
+    for d in [ 'x', 'y', 'z' ]:
+      self.assertEqual( sorted( os.listdir( os.path.join( self.dir.name, d ) ), key=int ), [ str( i ) for i in range( 1, 21 ) ] )
+
+
+  def test_parallel_state( self ):
+    # the state's sqlite connection can only be used on this thread
+    state_dir = tempfile.TemporaryDirectory()
+    self.addCleanup( state_dir.cleanup )
+
+    # changes made just now aren't trusted, make them look old
+    then = time.time() - 100
+    for d in [ '', 'x', 'y', 'z' ]:
+      os.utime( os.path.join( self.dir.name, d ), ( then, then ) )
+
+    state = scan_state.ScanState( os.path.join( state_dir.name, 'state.sqlite' ) )
+    self.assertEqual( len( list( fs.WalkChanges( self.dir.name, state ) ) ), 60 )
+
+    renames = [ ( name, name + '.new' ) for name in self.names ]
+    self.assertEqual( renamer.DoRenames( renames, state=state, jobs=3 ), 60 )
+    state.Close()
+
+    # the new names aren't taken for new files
+    state = scan_state.ScanState( state.path )
+    self.assertEqual( list( fs.WalkChanges( self.dir.name, state ) ), [] )
+    state.Close()
+
+
+class TestRules( unittest.TestCase ):
+  RULES = {
+    'rules': {
+      'dexter': { 'filter': 'shows/dexter/', 'actions': [ 'r:episode ([0-9]+):E\\1' ], 'result': r'.*E[0-9]+\.mkv$' },
+      'repeat': { 'filter': r'shows/(\w+)/\1', 'actions': [ 'i:0:x' ] },
+      'shows': { 'filter': [ 'shows/', 'series/' ], 'actions': [ 'a: (show)' ] },
+      'rest': { 'actions': [ 'd:junk' ] },
+    }
+  }
+
+
+  def setUp( self ):
+    self.rule_sets = rules.ParseRules( self.RULES, renamer.ParseAction )
+
+
+  def test_parse( self ):
+    self.assertEqual( [ 'dexter', 'repeat', 'shows', 'rest' ], [ rule.name for rule in self.rule_sets ] )
+    self.assertEqual( [ Replace( 'episode ([0-9]+)', 'E\\1' ) ], self.rule_sets[0].actions )
+    self.assertIsNone( self.rule_sets[3].filter_re )
+
+    with self.assertRaises( Exception ):
+      rules.ParseRules( { 'rules': { 'bad': { 'actions': [ 'r:a:b' ], 'filters': 'typo' } } }, renamer.ParseAction )
+
+
+  def test_dispatch( self ):
+    dispatch = rules.Dispatcher( self.rule_sets )
+    self.assertIsNone( dispatch.patterns )
+
+    self.assertEqual( 0, dispatch.match( 'shows/dexter/episode 1.mkv' ) )
+    self.assertEqual( 1, dispatch.match( 'shows/house/house 1.mkv' ) )
+    self.assertEqual( 2, dispatch.match( 'shows/other/episode 1.mkv' ) )
+    self.assertEqual( 2, dispatch.match( 'series/other/episode 1.mkv' ) )
+    self.assertEqual( 3, dispatch.match( 'movies/junk.mkv' ) )
+    self.assertIsNone( rules.Dispatcher( self.rule_sets[0:3] ).match( 'movies/junk.mkv' ) )
+
+
+  def test_renames( self ):
+    files = [ 'shows/dexter/episode 1.mkv', 'shows/dexter/other.mkv', 'shows/house/house 1.mkv', 'movies/junk.mkv' ]
+    renames = list( renamer.IterRuleRenames( self.rule_sets, files ) )
+
+    self.assertEqual( renames, [
+      ( 'shows/dexter/episode 1.mkv', 'shows/dexter/E1.mkv' ),
+      ( 'shows/house/house 1.mkv', 'shows/house/xhouse 1.mkv' ),
+      ( 'movies/junk.mkv', 'movies/.mkv' ),
+    ] )
+
+    renames = list( renamer.IterRuleRenames( self.rule_sets, files, full_path=True ) )
+    self.assertEqual( renames[1], ( 'shows/house/house 1.mkv', 'xshows/house/house 1.mkv' ) )
+
+
+class TestBatch( unittest.TestCase ):
+  NAMES = [
+    'show name episode 1 [random crap].mkv',
+    'show name episode 22.srt',
+    'other/show name episode 3 [random crap].mkv',
+    'notes',
+    'x',
+    '',
+    'episode 4 episode 5',
+  ]
+
+
+  def Check( self, raw_actions, names=NAMES ):
+    actions = [ renamer.ParseAction( raw ) for raw in raw_actions ]
+
+    for partial in [ False, True ]:
+      self.assertEqual(
+        batch.ApplyBatch( actions, names, partial=partial ),
+        [ renamer.ApplyActions( actions, name, partial=partial ) for name in names ],
+        ( raw_actions, partial ) )
+
+
+  def test_safe( self ):
+    for pattern in [ 'episode ([0-9]+)', '^show', 'mkv$', '\\[.*\\]', '[a-z]+', '\\bx\\b', 'e?', '(a|b)\\1', '\\d+' ]:
+      self.assertIsNotNone( batch.JoinedRegex( renamer.ParseAction( 'd:' + pattern ) ), pattern )
+
+    self.assertIsNotNone( batch.JoinedRegex( renamer.ParseAction( 'r:episode ([0-9]+):E\\1' ) ) )
+
+
+  def test_unsafe( self ):
+    for pattern in [ '\\s', '[^a]', '\\W', '\\D', '(?s).', '(?<=a)b', 'a(?!b)', '\\Aa', 'a\\Z', '[\\x00-\\x7f]', '\\n' ]:
+      self.assertIsNone( batch.JoinedRegex( renamer.ParseAction( 'd:' + pattern ) ), pattern )
+
+    # a replacement that could make a new line
+    self.assertIsNone( batch.JoinedRegex( renamer.ParseAction( 'r:a:\\n' ) ) )
+
+
+  def test_same_as_each( self ):
+    self.Check( [ 'r:episode ([0-9]+):E\\1', 'd: \\[random crap\\]' ] )
+    self.Check( [ 'd:^show ', 'r:mkv$:mp4' ] )
+    self.Check( [ 'd:e*' ] )
+    self.Check( [ 'd:\\s', 'd:[^a-z]' ] )
+    self.Check( [ 'r:episode:E', 'i:0:new ', 'a:!', 'd:x' ] )
+    self.Check( [ 'd:\\bx\\b', 'r:^$:empty' ] )
+
+
+  def test_changed( self ):
+    # joined or timed one name at a time, the same actions are found to change each name
+    actions = [ renamer.ParseAction( raw ) for raw in [ 'r:episode ([0-9]+):E\\1', 'd:\\s', 'a:!' ] ]
+
+    joined = batch.ApplyEach( actions, self.NAMES )
+    with stats.Stats() as collected:
+      timed = batch.ApplyEach( actions, self.NAMES, collected=collected )
+
+    self.assertEqual( joined, timed )
+    self.assertEqual( joined[1], [ 7, 7, 7, 4, 4, 4, 7 ] )
+    self.assertEqual( len( collected.actions ), 3 )
+
+    # a dropped name isn't given the actions after it
+    self.assertEqual( batch.ApplyEach( actions, self.NAMES, partial=False )[1], [ 7, 7, 7, 0, 0, 0, 7 ] )
+    self.assertEqual( batch.ApplyEach( actions, self.NAMES, bits=False )[1], None )
+
+
+  def test_newlines( self ):
+    # names with newlines can't be joined
+    self.Check( [ 'd:^a', 'r:b$:c' ], [ 'ab', 'a\nb', 'b\na' ] )
+
+
+  def test_generate( self ):
+    files   = [ 'E{}'.format( i ) for i in range( renamer.BATCH_MIN * 2 ) ]
+    actions = [ Replace( '^E([0-9]*5)$', 'S\\1' ) ]
+
+    self.assertEqual(
+      renamer.GenerateRenames( actions, files ),
+      [ ( file, 'S' + file[1:] ) for file in files if file.endswith( '5' ) ] )
+
+
+  def test_generate_jobs( self ):
+    # files are given actions in big batches with -j too, only probing is split up
+    files   = [ 'E{}'.format( i ) for i in range( renamer.BATCH_MIN * 2 ) ]
+    actions = [ Replace( '^E([0-9]*5)$', 'S\\1' ) ]
+    sizes   = []
+
+    apply_batch = batch.ApplyBatch
+    def ApplyBatch( actions, names, partial=False ):
+      sizes.append( len( names ) )
+      return apply_batch( actions, names, partial=partial )
+
+    batch.ApplyBatch = ApplyBatch
+    try:
+      renames = renamer.GenerateRenames( actions, files, jobs=2 )
+    finally:
+      batch.ApplyBatch = apply_batch
+
+    self.assertEqual( renames, [ ( file, 'S' + file[1:] ) for file in files if file.endswith( '5' ) ] )
+    self.assertEqual( sizes, [ len( files ) ] )
+
+
+class TestMemo( unittest.TestCase ):
+  PATHS = [
+    'show/Season 01/cover.jpg',
+    'show/Season 02/cover.jpg',
+    'other show/Season 01/cover.jpg',
+    'show/Season 01/show episode 1.mkv',
+    '/show/x',
+    'cover.jpg',
+    'x/',
+    'a\nb/cover.jpg',
+  ]
+
+
+  def Check( self, raw_actions, paths=PATHS ):
+    actions = [ renamer.ParseAction( raw ) for raw in raw_actions ]
+    self.assertTrue( memo.Usable( actions ), raw_actions )
+
+    for partial in [ False, True ]:
+      remembered = memo.Memo( actions, partial=partial )
+
+      # the second time everything is remembered
+      for i in range( 2 ):
+        self.assertEqual(
+          remembered.ApplyMany( paths ),
+          [ renamer.ApplyActions( actions, path, partial=partial ) for path in paths ],
+          ( raw_actions, partial, i ) )
+
+
+  def test_usable( self ):
+    for raw in [ 'd:cover', 'r:\\.jpg$:.png', 'r:^show:Show', 'd:\\bx\\b', 'r:Season ([0-9]+):S\\1', 'd:\\s' ]:
+      self.assertTrue( memo.Usable( [ renamer.ParseAction( raw ) ] ), raw )
+
+    # can match a separator, looks around, matches nothing at a separator, or isn't a regex
+    for raw in [ 'd:.', 'd:[^a]', 'd:\\W', 'd:(?<=a)b', 'd:^', 'd:$', 'd:x*', 'i:0:a', 'a:b' ]:
+      self.assertFalse( memo.Usable( [ renamer.ParseAction( raw ) ] ), raw )
+
+
+  def test_same_as_each( self ):
+    self.Check( [ 'r:\\.jpg$:.png' ] )
+    self.Check( [ 'r:^show:Show', 'r:Season ([0-9]+):S\\1' ] )
+    self.Check( [ 'd:\\bx\\b', 'r:cover:c/' ] )
+    self.Check( [ 'r:o:0', 'd:\\s', 'r:\\Ash:SH', 'r:g\\Z:G' ] )
+
+
+  def test_counted( self ):
+    actions = [ Replace( '\\.jpg$', '.png' ) ]
+    paths   = [ 'show/Season {:02}/cover.jpg'.format( i ) for i in range( 50 ) ]
+
+    with stats.Stats() as collected:
+      memo.Memo( actions, partial=True ).ApplyMany( paths )
+
+    # each directory and the one file name are done once
+    self.assertEqual( collected.Counted( 'memo misses' ), 51 )
+    self.assertEqual( collected.Counted( 'memo hits' ), 49 )
+
+
+  def test_bounded( self ):
+    actions    = [ Remove( 'e' ) ]
+    remembered = memo.Memo( actions, size=10 )
+    paths      = [ 'd{}/name{}'.format( i, i ) for i in range( 100 ) ]
+
+    self.assertEqual( remembered.ApplyMany( paths ), [ renamer.ApplyActions( actions, path ) for path in paths ] )
+    self.assertEqual( len( remembered.directories ), 10 )
+    self.assertEqual( len( remembered.names ), 10 )
+
+
+  def test_names( self ):
+    # only given file names, any actions can be remembered
+    actions    = [ Insert( 0, 'new ' ), Append( '!' ), Remove( 'x' ) ]
+    remembered = memo.Memo( actions, split=False )
+    names      = [ 'cover.jpg', 'x', 'cover.jpg', 'a/b', 'y' ]
+
+    self.assertEqual( remembered.ApplyMany( names ), [ renamer.ApplyActions( actions, name ) for name in names ] )
+    self.assertEqual( len( remembered.directories ), 0 )
+
+
+  def test_generate( self ):
+    files = [ 'show/Season {}/cover.jpg'.format( i ) for i in range( 10 ) ] + [ 'show/cover.png' ]
+
+    for actions in [ [ Replace( '^cover', 'folder' ) ], [ Insert( 0, 'new ' ) ] ]:
+      for full_path in [ False, True ]:
+        self.assertEqual(
+          renamer.GenerateRenames( actions, files, recursive=True, full_path=full_path ),
+          renamer.GenerateRenames( actions, files, full_path=full_path ) )
+
+
+class TestStats( unittest.TestCase ):
+  def setUp( self ):
+    self.dir = tempfile.TemporaryDirectory()
+    CreateFiles( [ os.path.join( self.dir.name, name ) for name in [ 'E1', 'E2', 'notes' ] ] )
+
+
+  def tearDown( self ):
+    self.dir.cleanup()
+
+
+  def test_nothing_measured( self ):
+    self.assertIsNone( stats.current )
+    self.assertIs( stats.Phase( 'walk' ), stats.NOTHING )
+
+    files = [ 'a', 'b' ]
+    self.assertIs( stats.Timed( 'walk', files ), files )
+
+
+  def test_phases( self ):
+    with stats.Stats() as collected:
+      self.assertIs( stats.current, collected )
+
+      with stats.Phase( 'generate' ):
+        files = list( stats.Timed( 'walk', fs.GetFiles( [ self.dir.name ] ) ) )
+        renames = renamer.GenerateRenames( [ Replace( 'E', 'S' ) ], files )
+
+      with stats.Phase( 'rename' ):
+        renamer.DoRenames( renames )
+
+    self.assertIsNone( stats.current )
+    self.assertEqual( sorted( os.listdir( self.dir.name ) ), [ 'S1', 'S2', 'notes' ] )
+
+    report = collected.Report()
+    self.assertEqual( list( report['phases'] ), [ 'walk', 'generate', 'rename' ] )
+    self.assertEqual( list( report['counts'] ), [ 'walk', 'rename' ] )
+    self.assertEqual( report['counts']['rename']['renames'], 2 )
+    self.assertEqual( report['counts']['walk']['directories listed'], 1 )
+    self.assertEqual( collected.Counted( 'renames' ), 2 )
+
+    # every file was tried, and only two made it through
+    self.assertEqual( len( report['actions'] ), 1 )
+    self.assertEqual( report['actions'][0]['count'], 3 )
+
+    # the walk's time isn't counted again in generate
+    self.assertLessEqual( sum( p['seconds'] for p in report['phases'].values() ), report['seconds'] )
+    self.assertIn( 'directories listed', collected.Table() )
+    self.assertIn( stats.NOTE, collected.Table() )
+
+
+  def test_percentiles( self ):
+    collected = stats.Stats()
+    for i in range( 1, 101 ):
+      collected.Sample( 'a', i )
+
+    action = collected.Report()['actions'][0]
+    self.assertEqual( ( action['p50'], action['p90'], action['p99'], action['max'] ), ( 51, 91, 100, 100 ) )
+
+
+  def test_counts_outside_phases( self ):
+    collected = stats.Stats()
+    collected.Count( 'stat calls' )
+    with collected.Phase( 'walk' ):
+      collected.Count( 'stat calls', 2 )
+
+    self.assertEqual( collected.Report()['counts'], { stats.NO_PHASE: { 'stat calls': 1 }, 'walk': { 'stat calls': 2 } } )
+    self.assertEqual( collected.Counted( 'stat calls' ), 3 )
+
+
+  def test_bound( self ):
+    import threading
+
+    with stats.Stats() as collected:
+      with stats.Phase( 'walk' ):
+        listed = stats.Bound( lambda: collected.Count( 'directories listed' ) )
+
+      # the listing is read after the walk has moved on, it's still counted in it
+      with stats.Phase( 'generate' ):
+        for count in [ listed, lambda: collected.Count( 'stat calls' ) ]:
+          thread = threading.Thread( target=count )
+          thread.start()
+          thread.join()
+
+    self.assertEqual( collected.Report()['counts'], {
+      'walk': { 'directories listed': 1 },
+      'generate': { 'stat calls': 1 },
+    } )
+    self.assertIs( stats.Bound( len ), len )
+
+
+class TestLog( unittest.TestCase ):
+  def setUp( self ):
+    log.Close()
+    self.stderr = sys.stderr
+    sys.stderr  = io.StringIO()
+
+
+  def tearDown( self ):
+    log.Close()
+    sys.stderr     = self.stderr
+    log.level      = log.INFO
+    log.limit      = 100
+    log.json_lines = False
+
+
+  def Written( self ):
+    log.Flush()
+    return sys.stderr.getvalue().splitlines()
+
+
+  def test_levels( self ):
+    log.level = log.WARNING
+    log.Info( "not written {}", 1 )
+    log.Warn( "written {}", 2 )
+    self.assertEqual( self.Written(), [ "written 2" ] )
+
+
+  def test_buffered( self ):
+    log.Info( "kept" )
+    self.assertEqual( sys.stderr.getvalue(), "" )
+    self.assertEqual( self.Written(), [ "kept" ] )
+
+
+  def test_summarized( self ):
+    log.limit = 2
+    for i in range( 5 ):
+      log.File( log.INFO, "dropping '{}'", i )
+    log.File( log.DEBUG, "not counted '{}'", 0 )
+    log.Close()
+
+    self.assertEqual( self.Written(), [
+      "dropping '0'",
+      "dropping '1'",
+      'and 3 more like "dropping \'{}\'"',
+    ] )
+
+
+  def test_json( self ):
+    log.json_lines = True
+    log.Warn( "file already exists '{}'", 'E1' )
+
+    self.assertEqual( [ json.loads( line ) for line in self.Written() ], [ {
+      'level': 'warning',
+      'message': "file already exists 'E1'",
+      'kind': "file already exists '{}'",
+      'args': [ 'E1' ],
+    } ] )
+
+
+  def test_plan_json( self ):
+    stdout = sys.stdout
+    sys.stdout = io.StringIO()
+    renamer.json_lines = True
+
+    try:
+      renamer.PrintRenames( [ ( 'a', 'b' ), ( 'c', 'd' ) ] )
+      lines = sys.stdout.getvalue().splitlines()
+    finally:
+      renamer.json_lines = False
+      sys.stdout = stdout
+
+    self.assertEqual( [ json.loads( line ) for line in lines ], [ { 'from': 'a', 'to': 'b' }, { 'from': 'c', 'to': 'd' } ] )
+
+
+class TestImportTime( unittest.TestCase ):
+  # microseconds `import main` can take, it took about 30ms when this was added.
+  # how long it takes depends on the machine, so it's only checked when asked for
+  BUDGET = 60000
+
+  # only loaded by the options or keywords that need them
+  LAZY = [
+    'unittest', 'textwrap', 'shutil', 'tempfile', 'subprocess', 'sqlite3', 'json', 'ctypes',
+    'concurrent.futures', 'help_text', 'journal', 'external_sort', 'scan_state', 'watch',
+    'cProfile', 'random', 'batch', 'memo',
+  ]
+
+
+  def Run( self, *args ):
+    """
+    Returns what a fresh python printed to stdout and stderr, run where main is
+    """
+    p = subprocess.run(
+      [ sys.executable ] + list( args ),
+      cwd=os.path.dirname( os.path.abspath( __file__ ) ), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+      check=True )
+
+    return ( p.stdout.decode(), p.stderr.decode() )
+
+
+  def ImportTimes( self ):
+    """
+    Returns { module: cumulative microseconds } for a fresh `import main`
+    """
+    times = {}
+    for line in self.Run( '-X', 'importtime', '-c', 'import main' )[1].splitlines():
+      match = re.match( r'import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)', line )
+      if match is not None:
+        times[ match.group( 4 ) ] = int( match.group( 2 ) )
+
+    return times
+
+
+  def test_lazy( self ):
+    modules = self.Run( '-c', 'import sys, main; print( "\\n".join( sys.modules ) )' )[0].splitlines()
+    self.assertIn( 'main', modules )
+
+    for module in self.LAZY:
+      self.assertNotIn( module, modules )
+
+
+  @unittest.skipUnless( os.environ.get( 'TEST_IMPORT_TIME' ), "set TEST_IMPORT_TIME to time importing main" )
+  def test_budget( self ):
+    # the fastest of a few, the others are mostly noise from whatever else is running
+    fastest = min( self.ImportTimes()[ 'main' ] for i in range( 3 ) )
+    self.assertLess( fastest, self.BUDGET )
+
 
 def Main():
   unittest.main( verbosity=2 )
@@ -0,0 +1,279 @@
+#!/bin/python3
+
+"""
+Watches directories for files that arrive in them, using Linux's inotify
+through ctypes.
+
+A file has arrived once it has been written and closed, or moved in from
+somewhere else. Files that arrive close together are handed over together, once
+nothing else has happened for DEBOUNCE seconds.
+"""
+
+
+import ctypes.util
+import ctypes
+import select
+import struct
+import time
+import os
+
+import log
+import fs
+
+
+# the events, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_ISDIR       = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC  = os.O_CLOEXEC
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+# struct inotify_event { int wd; uint32_t mask, cookie, len; char name[]; }
+EVENT = struct.Struct( 'iIII' )
+
+# how long nothing has to happen before the files that arrived are handed over
+DEBOUNCE = 0.05
+
+# the longest files are held back while other files keep arriving
+MAX_DELAY = 1.0
+
+
+_libc = None
+
+
+def _Libc():
+  """
+  Loads the C library the first time it is needed
+  """
+  global _libc
+
+  if _libc is None:
+    _libc = ctypes.CDLL( ctypes.util.find_library( 'c' ), use_errno=True )
+    _libc.inotify_init1.argtypes     = [ ctypes.c_int ]
+    _libc.inotify_add_watch.argtypes = [ ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32 ]
+
+  return _libc
+
+
+class Inotify:
+  """
+  An inotify instance; directories are added to it and their events read from it.
+  """
+  def __init__( self ):
+    self.fd = _Libc().inotify_init1( IN_NONBLOCK | IN_CLOEXEC )
+    if self.fd < 0:
+      e = ctypes.get_errno()
+      raise OSError( e, "inotify_init1: " + os.strerror( e ) )
+
+  def fileno( self ):
+    return self.fd
+
+  def Add( self, path, mask=WATCH_MASK ):
+    """
+    Starts watching a directory.
+
+    Returns the watch descriptor, which events for the directory come with
+    """
+    wd = _Libc().inotify_add_watch( self.fd, os.fsencode( path ), mask )
+    if wd < 0:
+      e = ctypes.get_errno()
+      raise OSError( e, os.strerror( e ), path )
+
+    return wd
+
+  def Read( self ):
+    """
+    Reads the events that are waiting, without blocking.
+
+    Returns a list of ( wd, mask, cookie, name )
+    """
+    events = []
+
+    while True:
+      try:
+        data = os.read( self.fd, 1 << 16 )
+      except BlockingIOError:
+        return events
+
+      offset = 0
+      while offset < len( data ):
+        wd, mask, cookie, length = EVENT.unpack_from( data, offset )
+        offset += EVENT.size
+
+        name = os.fsdecode( data[ offset : offset+length ].rstrip( b'\0' ) )
+        offset += length
+
+        events.append( ( wd, mask, cookie, name ) )
+
+  def Close( self ):
+    os.close( self.fd )
+
+
+class Watcher:
+  """
+  Collects the files that arrive in some directories.
+  """
+  def __init__( self, paths, recursive=False ):
+    """
+    paths     | a list of directory paths to watch
+    recursive | if true, the directories inside them are watched too, including new ones
+    """
+    self.paths     = paths
+    self.recursive = recursive
+    self.inotify   = Inotify()
+    self.dirs      = {}
+    # files that arrived, in order, { path: None }
+    self.pending   = {}
+    self.since     = None
+    # names the caller renamed files to, which aren't new files
+    self.ignored   = set()
+
+    for path in paths:
+      if not os.path.isdir( path ):
+        raise Exception( "can only watch directories", path )
+
+      self._AddTree( path )
+
+  def _AddTree( self, path ):
+    """
+    Watches a directory, and the ones in it if recursive.
+    """
+    try:
+      self.dirs[ self.inotify.Add( path ) ] = path
+    except OSError as e:
+      log.Warn( "can't watch '{}': {}", path, e.strerror )
+      return
+
+    if not self.recursive:
+      return
+
+    try:
+      with os.scandir( path ) as entries:
+        subdirs = [ entry.name for entry in entries if entry.is_dir( follow_symlinks=False ) ]
+    except OSError:
+      return
+
+    for name in subdirs:
+      self._AddTree( fs.Join( path, name ) )
+
+  def _Arrived( self, path ):
+    if path in self.ignored:
+      self.ignored.discard( path )
+      return
+
+    if len( self.pending ) == 0:
+      self.since = time.monotonic()
+
+    self.pending[path] = None
+
+  def _Handle( self, events ):
+    """
+    Adds the files that arrived to pending.
+    """
+    for wd, mask, cookie, name in events:
+      if mask & IN_Q_OVERFLOW:
+        # events were lost, anything could have arrived
+        log.Warn( "too many events at once, looking at every file again" )
+        for path in self.paths:
+          for file in fs.WalkDirectory( path, recursive=self.recursive ):
+            self._Arrived( file )
+        continue
+
+      if mask & IN_IGNORED:
+        # the directory is gone
+        self.dirs.pop( wd, None )
+        continue
+
+      directory = self.dirs.get( wd )
+      if directory is None or name == '':
+        continue
+
+      path = fs.Join( directory, name )
+
+      if mask & IN_ISDIR:
+        if self.recursive and mask & ( IN_CREATE | IN_MOVED_TO ):
+          # files could have been put in it before it was watched
+          self._AddTree( path )
+          for file in fs.WalkDirectory( path, recursive=True ):
+            self._Arrived( file )
+
+      elif mask & ( IN_CLOSE_WRITE | IN_MOVED_TO ):
+        self._Arrived( path )
+
+  def Ignore( self, paths ):
+    """
+    Doesn't count files moved to these paths as arriving, for the renames done
+    to files that arrived.
+    """
+    self.ignored.update( paths )
+
+  def Wait( self, timeout=None ):
+    """
+    Waits for files to arrive.
+
+    timeout | the most seconds to wait, forever if None
+
+    Returns a list of the files that arrived and are still there, in the order
+    they arrived. Empty if the timeout was reached first.
+    """
+    end = None if timeout is None else time.monotonic() + timeout
+
+    while True:
+      now  = time.monotonic()
+      wait = None
+
+      if len( self.pending ) > 0:
+        wait = max( 0, min( DEBOUNCE, self.since + MAX_DELAY - now ) )
+
+      if end is not None:
+        wait = max( 0, end - now if wait is None else min( wait, end - now ) )
+
+      readable, _, _ = select.select( [ self.inotify ], [], [], wait )
+
+      if readable:
+        self._Handle( self.inotify.Read() )
+
+        # keep waiting until things are quiet, unless files have waited too long
+        if len( self.pending ) == 0 or time.monotonic() - self.since < MAX_DELAY:
+          continue
+
+      if len( self.pending ) > 0 or ( end is not None and time.monotonic() >= end ):
+        files = [ file for file in self.pending if os.path.lexists( file ) ]
+        self.pending = {}
+        return files
+
+  def Close( self ):
+    self.inotify.Close()
+
+
+def Watch( paths, handle, recursive=False ):
+  """
+  Hands over files as they arrive in directories, until interrupted.
+
+  paths     | a list of directory paths
+  handle    | a function taking a list of files that arrived, returning the paths
+              it renamed files to (so they aren't taken as arriving)
+  recursive | if true, the directories inside paths are watched too
+  """
+  watcher = Watcher( paths, recursive=recursive )
+
+  try:
+    while True:
+      files = watcher.Wait()
+      if len( files ) > 0:
+        watcher.Ignore( handle( files ) )
+
+  except KeyboardInterrupt:
+    pass
+
+  finally:
+    watcher.Close()